@@ -2,11 +2,13 @@ import asyncio
 import nonebot
 import datetime
 import inspect
+import json
 import os
+import re
 import sys
 
 from typing import ForwardRef, _eval_type  # type: ignore
-from typing import Any, List, Dict, Type, Union, Optional, TYPE_CHECKING
+from typing import Any, List, Dict, Type, Union, Optional, Tuple, TYPE_CHECKING
 
 from playhouse.shortcuts import model_to_dict
 from pydantic import BaseModel, conset
@@ -14,18 +16,25 @@ from pydantic import BaseModel, conset
 from nonebot.adapters.onebot.v11 import Bot, Event, MessageEvent
 from nonebot.adapters.onebot.v11.event import PrivateMessageEvent, GroupMessageEvent, PrivateMessageEvent
 from nonebot.adapters.onebot.v11.message import Message, MessageSegment
-from nonebot.plugin import on, on_command, on_message, MatcherGroup, on_regex
 from nonebot.typing import T_State
+from nonebot.log import logger
 
 
 from fastapi import FastAPI, Request, Path, Response, Cookie, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
 from fastapi.staticfiles import StaticFiles
-from starlette.responses import FileResponse
+from starlette.responses import FileResponse, StreamingResponse
 
-from .utils import BossStatus, ClanBattle, ClanBattleData, CommitBattlrOnTreeResult, CommitInProgressResult, CommitRecordResult, CommitSLResult, CommitSubscribeResult, WebAuth
-from .utils import Tools
+from .utils import BossStatus, ClanBattle, ClanBattleData, AsyncClanBattleData, CommitBattlrOnTreeResult, CommitInProgressResult, CommitRecordResult, CommitSLResult, CommitSubscribeResult, WebAuth
+from .utils import Tools, run_in_db_thread, shutdown_db_executor
+from .db import BattleRecord, run_maintenance, close_db
+from .push import push_hub
+from .shared import shared_state, create_shared_backend
+from .dispatcher import message_dispatcher
+from .command import CommandDispatcher
+from .export import TableExporter, export_models
 
-from .exception import WebsocketResloveException, WebsocketAuthException
+from .exception import WebsocketResloveException, WebsocketAuthException, ClanBattleException
 
 from .config import load_config, get_config
 
@@ -66,6 +75,40 @@ if not "pytest" in sys.modules:
         if os.path.isdir(static_file_path):
             app.mount("/", StaticFiles(directory=static_file_path, html=True),
                       name="static")
+
+    @driver.on_startup
+    async def start_shared_state():
+        if url := get_config().shared_cache_url:
+            await asyncio.get_running_loop().run_in_executor(None, shared_state.start, create_shared_backend(url))
+
+    @driver.on_shutdown
+    async def drain_message_queue():
+        # 退出前尽量发送完队列中的提醒消息
+        await message_dispatcher.drain(timeout=10)
+
+    db_maintenance_task: asyncio.Task = None
+
+    async def db_maintenance_loop():
+        while True:
+            await asyncio.sleep(get_config().db_maintenance_interval)
+            try:
+                await run_in_db_thread(run_maintenance)
+            except Exception as e:
+                logger.warning(f"数据库维护失败：{e}")
+
+    @driver.on_startup
+    async def start_db_maintenance():
+        global db_maintenance_task
+        if get_config().db_maintenance_interval > 0:
+            db_maintenance_task = asyncio.create_task(db_maintenance_loop())
+
+    @driver.on_shutdown
+    async def close_db_connections():
+        if db_maintenance_task:
+            db_maintenance_task.cancel()
+        await asyncio.get_running_loop().run_in_executor(None, shutdown_db_executor)
+        shared_state.stop()
+        close_db()
 else:
     load_config()
     Tools.update_boss_info()
@@ -94,6 +137,17 @@ class WebReportRecord(WebPostBase):
     comment: Optional[str]
 
 
+class WebBatchRecordItem(BaseModel):
+    member: str
+    target_boss: Optional[str]
+    damage: Optional[str]
+    is_kill_boss: bool
+
+
+class WebReportRecords(WebPostBase):
+    records: List[WebBatchRecordItem]
+
+
 class WebReportQueue(WebPostBase):
     target_boss: str
     comment: Optional[str]
@@ -122,6 +176,17 @@ class WebQueryReport(WebPostBase):
     member: Optional[str]
     boss: Optional[str]
     cycle: Optional[str]
+    # 以下为可选的分页参数，不指定 limit 时返回全部记录
+    cursor: Optional[str] = None
+    limit: Optional[int] = None
+    fields: Optional[List[str]] = None
+    stream: bool = False
+
+
+class WebExportData(WebPostBase):
+    table: str = "battle_record"
+    format: str = "csv"
+    data_num: Optional[int] = None  # 不指定时导出当前档案
 
 
 class WebSetClanbattleData(WebPostBase):
@@ -146,32 +211,39 @@ class WebChangeBossStatus(WebPostBase):
     remain_hp: str
 
 
+async def get_web_session(session: str) -> Tuple[str, List[str]]:
+    # 命中缓存时无需进入数据库线程
+    if session and (cached := WebAuth.session_cache.get_local(session)):
+        return cached
+    return await run_in_db_thread(WebAuth.load_session, session)
+
+
 class WebGetRoute:
     @staticmethod
     async def get_joined_clan(uid: str):
-        clan_list = clanbattle.get_joined_clan(uid)
+        clan_list = await run_in_db_thread(clanbattle.get_joined_clan, uid)
         return {"err_code": 0, "clan_list": clan_list}
 
     @staticmethod
     async def boss_status(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
+        clan = await clanbattle.get_clan_data_async(clan_gid)
         if clan.clan_info.clan_type != "cn":
-            boss_status = clan.get_current_boss_state()
+            boss_status = await clan.get_current_boss_state()
             return {"err_code": 0, "boss_status": boss_status}
         else:
-            boss_status = clan.get_current_boss_state_cn()
+            boss_status = await clan.get_current_boss_state_cn()
             return {"err_code": 0, "boss_status": boss_status}
 
     @staticmethod
     async def member_list(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
-        member_list = clan.get_clan_members_with_info()
+        clan = await clanbattle.get_clan_data_async(clan_gid)
+        member_list = await clan.get_clan_members_with_info()
         return {"err_code": 0, "member_list": member_list}
 
     @staticmethod
     async def report_unqueue(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
-        result = clan.delete_battle_in_progress(uid)
+        clan = await clanbattle.get_clan_data_async(clan_gid)
+        result = await clan.delete_battle_in_progress(uid)
         if result:
             return {"err_code": 0}
         else:
@@ -179,11 +251,11 @@ class WebGetRoute:
 
     @staticmethod
     async def get_in_queue(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
+        clan = await clanbattle.get_clan_data_async(clan_gid)
         in_process_list_dict = {}
         for i in range(1, 6):
             in_process_list = []
-            in_processes = clan.get_battle_in_progress(boss=i)
+            in_processes = await clan.get_battle_in_progress(boss=i)
             for process in in_processes:
                 in_process_list.append(model_to_dict(process))
             in_process_list_dict[str(i)] = in_process_list
@@ -191,11 +263,11 @@ class WebGetRoute:
 
     @staticmethod
     async def on_tree_list(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
+        clan = await clanbattle.get_clan_data_async(clan_gid)
         on_tree_list_dict = {}
         for i in range(1, 6):
             on_tree_list = []
-            on_trees = clan.get_battle_on_tree(boss=i)
+            on_trees = await clan.get_battle_on_tree(boss=i)
             for on_tree in on_trees:
                 on_tree_list.append(model_to_dict(on_tree))
             on_tree_list_dict[str(i)] = on_tree_list
@@ -203,11 +275,11 @@ class WebGetRoute:
 
     @staticmethod
     async def subscribe_list(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
+        clan = await clanbattle.get_clan_data_async(clan_gid)
         subscribe_list_dict = {}
         for i in range(1, 6):
             subscribe_list = []
-            subscribes = clan.get_battle_subscribe(boss=i)
+            subscribes = await clan.get_battle_subscribe(boss=i)
             for subscribe in subscribes:
                 subscribe_list.append(model_to_dict(subscribe))
             subscribe_list_dict[str(i)] = subscribe_list
@@ -215,25 +287,98 @@ class WebGetRoute:
 
     @staticmethod
     async def current_clanbattle_data_num(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
-        data_num = clan.get_current_clanbattle_data()
+        clan = await clanbattle.get_clan_data_async(clan_gid)
+        data_num = await clan.get_current_clanbattle_data()
         return {"err_code": 0, "data_num": data_num}
 
     @staticmethod
     async def clan_area(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
+        clan = await clanbattle.get_clan_data_async(clan_gid)
         return {"err_code": 0, "area": clan.clan_info.clan_type}
 
     @staticmethod
     async def clan_name(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
+        clan = await clanbattle.get_clan_data_async(clan_gid)
         return {"err_code": 0, "clan_name": clan.clan_info.clan_name}
 
+    @staticmethod
+    async def clan_statistics(uid: str, clan_gid: str):
+        clan = await clanbattle.get_clan_data_async(clan_gid)
+        try:
+            statistics = await clan.get_clan_statistics()
+        except ClanBattleException as e:
+            return {"err_code": 403, "msg": str(e)}
+        return {"err_code": 0, "statistics": statistics}
+
+    @staticmethod
+    async def cache_stats(uid: str, clan_gid: str):
+        clan = await clanbattle.get_clan_data_async(clan_gid)
+        if not await clan.check_admin_permission(uid):
+            return {"err_code": -2, "msg": "您不是会战管理员，无权查看缓存统计"}
+        return {"err_code": 0, "cache": await clan.get_cache_stats(), "registry": clanbattle.get_registry_stats()}
+
+
+# 分页查询出刀记录时每页的最大记录数，流式返回时也按此大小分批读取
+max_record_page_size = 1000
+
+record_field_names = set(BattleRecord._meta.fields)
+
+
+def format_record_cursor(record: dict) -> str:
+    return f"{record['record_time'].isoformat()}|{record['id']}"
+
+
+def parse_record_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    record_time, record_id = cursor.split("|")
+    return datetime.datetime.fromisoformat(record_time), int(record_id)
+
+
+async def stream_records(clan: AsyncClanBattleData, query_kwargs: dict, cursor: Tuple[datetime.datetime, int]):
+    # 每行一条 JSON 格式的记录，分批读取，不会一次性加载全部记录
+    while True:
+        record_list = await clan.get_record_dicts(**query_kwargs, cursor=cursor, limit=max_record_page_size)
+        if record_list:
+            yield "".join(json.dumps(jsonable_encoder(record), ensure_ascii=False) + "\n" for record in record_list)
+        if len(record_list) < max_record_page_size:
+            break
+        cursor = (record_list[-1]["record_time"], record_list[-1]["id"])
+
+
+async def stream_export(exporter: TableExporter):
+    # 每批数据在数据库线程池中读取和编码，导出大量数据时也不会阻塞事件循环
+    while (chunk := await run_in_db_thread(exporter.next_chunk)) is not None:
+        yield chunk
+
+
+# 单次批量上报的最大记录数
+max_batch_record_num = 100
+
+commit_record_result_msg = {
+    CommitRecordResult.illegal_damage_inpiut: "上报的伤害格式不合法",
+    CommitRecordResult.damage_out_of_hp: "上报的伤害超出了boss血量，如已击杀请标记为尾刀",
+    CommitRecordResult.check_record_legal_failed: "上报数据合法性检查错误，请检查是否正确上报",
+    CommitRecordResult.member_not_in_clan: "该成员还未加入公会",
+    CommitRecordResult.boss_not_challengeable: "当时无法挑战这个boss",
+    CommitRecordResult.on_another_tree: "该成员还挂在其他树上",
+    CommitRecordResult.boss_cycle_already_killed: "该周目的boss已被击破",
+}
+
+
+async def get_batch_record_summary(clan: AsyncClanBattleData, count: int) -> str:
+    msg = f"已补报{count}条出刀记录\n当前状态："
+    if clan.clan_info.clan_type != "cn":
+        for boss_status in await clan.get_current_boss_state():
+            msg += f"\n{boss_status.target_cycle}周目{boss_status.target_boss}王，生命值{Tools.get_num_str_with_dot(boss_status.boss_hp)}"
+    else:
+        boss_status = await clan.get_current_boss_state_cn()
+        msg += f"\n{boss_status.target_cycle}周目{boss_status.target_boss}王，生命值{Tools.get_num_str_with_dot(boss_status.boss_hp)}"
+    return msg
+
 
 class WebPostRoute:
     @staticmethod
     async def login(item: WebLoginPost, request: Request, response: Response):
-        login_item = WebAuth.login(item.qq_uid, item.password)
+        login_item = await run_in_db_thread(WebAuth.login, item.qq_uid, item.password)
         if login_item[0] == 404:
             return {"err_code": 404, "msg": "找不到该用户"}
         elif login_item[0] == 403:
@@ -244,31 +389,27 @@ class WebPostRoute:
 
     @staticmethod
     async def report_record(item: WebReportRecord, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
+        uid = (await get_web_session(session))[0]
         if item.is_proxy_report:
-            joined_clan = clanbattle.get_joined_clan(item.proxy_report_member)
+            joined_clan = await run_in_db_thread(clanbattle.get_joined_clan, item.proxy_report_member)
             if not item.clan_gid in joined_clan:
                 return {"err_code": 403, "msg": "您还没有加入该公会"}
-        clan = clanbattle.get_clan_data(item.clan_gid)
+        clan = await clanbattle.get_clan_data_async(item.clan_gid)
         challenge_boss = int(item.target_boss)
         proxy_report_uid = item.proxy_report_member if item.is_proxy_report else None
         comment = item.comment if item.comment else None
         force_use_full_chance = item.froce_use_full_chance
-        if not item.is_kill_boss:
-            challenge_damage = item.damage
-        else:
-            boss_status = clan.get_current_boss_state()[challenge_boss-1]
-            challenge_damage = str(boss_status.boss_hp)
+        target_cycle = (await clan.get_current_boss_state())[challenge_boss-1].target_cycle if item.is_kill_boss else None
         if item.is_proxy_report:
-            result = await clan.commit_record(proxy_report_uid, challenge_boss, challenge_damage, comment, uid, force_use_full_chance)
+            result = await clan.commit_record(proxy_report_uid, challenge_boss, item.damage, comment, uid, force_use_full_chance, item.is_kill_boss, target_cycle)
             uid = proxy_report_uid
         else:
-            result = await clan.commit_record(uid, challenge_boss, challenge_damage, comment, None, force_use_full_chance)
+            result = await clan.commit_record(uid, challenge_boss, item.damage, comment, None, force_use_full_chance, item.is_kill_boss, target_cycle)
         bot: Bot = list(nonebot.get_bots().values())[0]
         if result == CommitRecordResult.success:
-            record = clan.get_recent_record(uid)[0]
-            today_status = clan.get_today_record_status(uid)
-            boss_status = clan.get_current_boss_state()[challenge_boss-1]
+            record = (await clan.get_recent_record(uid))[0]
+            today_status = await clan.get_today_record_status(uid)
+            boss_status = (await clan.get_current_boss_state())[challenge_boss-1]
             if today_status.last_is_addition:
                 record_type = "补偿刀"
             else:
@@ -286,14 +427,32 @@ class WebPostRoute:
             return {"err_code": 403, "msg": "上报数据合法性检查错误，请检查是否正确上报"}
         elif result == CommitRecordResult.member_not_in_clan:
             return {"err_code": 403, "msg": "您还未加入公会，请发送“加入公会”加入"}
+        elif result == CommitRecordResult.boss_cycle_already_killed:
+            return {"err_code": 403, "msg": "该周目的boss已被其他成员击破，请确认后重新上报"}
+
+    @staticmethod
+    async def report_records(item: WebReportRecords, session: str = Cookie(None)):
+        uid = (await get_web_session(session))[0]
+        clan = await clanbattle.get_clan_data_async(item.clan_gid)
+        if not await clan.check_admin_permission(str(uid)):
+            return {"err_code": -2, "msg": "您不是会战管理员，无权批量上报出刀记录"}
+        if not item.records or len(item.records) > max_batch_record_num:
+            return {"err_code": 403, "msg": f"每次可上报1至{max_batch_record_num}条出刀记录"}
+        records = [(record.member, int(record.target_boss) if record.target_boss else None, record.damage, record.is_kill_boss)
+                   for record in item.records]
+        result, index = await clan.commit_records(records, str(uid))
+        if result != CommitRecordResult.success:
+            return {"err_code": 403, "msg": f"第{index + 1}条记录：{commit_record_result_msg[result]}，本次上报的记录均未保存", "index": index}
+        message_dispatcher.send(item.clan_gid, "网页批量上报数据：\n" + await get_batch_record_summary(clan, len(records)))
+        return {"err_code": 0, "count": len(records)}
 
     @staticmethod
     async def report_queue(item: WebReportQueue, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
+        uid = (await get_web_session(session))[0]
+        clan = await clanbattle.get_clan_data_async(item.clan_gid)
         challenge_boss = int(item.target_boss)
         comment = item.comment if item.comment else None
-        result = clan.commit_battle_in_progress(uid, challenge_boss, comment)
+        result = await clan.commit_battle_in_progress(uid, challenge_boss, comment)
         bot: Bot = list(nonebot.get_bots().values())[0]
         if result == CommitInProgressResult.success:
             await bot.send_group_msg(group_id=item.clan_gid, message=MessageSegment.at(uid) + f"开始挑战{challenge_boss}王")
@@ -307,12 +466,12 @@ class WebPostRoute:
 
     @staticmethod
     async def report_subscribe(item: WebReportSubscribe, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
+        uid = (await get_web_session(session))[0]
+        clan = await clanbattle.get_clan_data_async(item.clan_gid)
         challenge_boss = int(item.target_boss)
         cycle = int(item.target_cycle)
         comment = item.comment if item.comment else None
-        result = clan.commit_batle_subscribe(
+        result = await clan.commit_batle_subscribe(
             uid, challenge_boss, cycle, comment)
         bot: Bot = list(nonebot.get_bots().values())[0]
         if result == CommitSubscribeResult.success:
@@ -329,11 +488,11 @@ class WebPostRoute:
 
     @staticmethod
     async def report_unsubscribe(item: WebReportSubscribe, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
+        uid = (await get_web_session(session))[0]
+        clan = await clanbattle.get_clan_data_async(item.clan_gid)
         challenge_boss = int(item.target_boss)
         cycle = int(item.target_cycle)
-        result = clan.delete_battle_subscribe(uid, challenge_boss, cycle)
+        result = await clan.delete_battle_subscribe(uid, challenge_boss, cycle)
         if result:
             return {"err_code": 0}
         else:
@@ -341,11 +500,11 @@ class WebPostRoute:
 
     @staticmethod
     async def report_ontree(item: WebReportOnTree, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
+        uid = (await get_web_session(session))[0]
+        clan = await clanbattle.get_clan_data_async(item.clan_gid)
         boss = int(item.boss)
         comment = item.comment if item.comment else None
-        result = clan.commit_battle_on_tree(uid, boss, comment)
+        result = await clan.commit_battle_on_tree(uid, boss, comment)
         if result == CommitBattlrOnTreeResult.success:
             return {"err_code": 0}
         elif result == CommitBattlrOnTreeResult.already_in_other_boss_progress:
@@ -357,16 +516,16 @@ class WebPostRoute:
 
     @staticmethod
     async def report_sl(item: WebReportSL, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
+        uid = (await get_web_session(session))[0]
+        clan = await clanbattle.get_clan_data_async(item.clan_gid)
         boss = int(item.boss)
         proxy_report_uid = item.proxy_report_uid if item.is_proxy_report else None
         comment = item.comment if item.comment else None
         if item.is_proxy_report:
-            result = clan.commit_battle_sl(
+            result = await clan.commit_battle_sl(
                 proxy_report_uid, boss, comment, uid)
         else:
-            result = clan.commit_battle_sl(
+            result = await clan.commit_battle_sl(
                 uid, boss, comment, proxy_report_uid)
         if result == CommitSLResult.success:
             return {"err_code": 0}
@@ -379,7 +538,7 @@ class WebPostRoute:
 
     @staticmethod
     async def query_record(item: WebQueryReport, session: str = Cookie(None)):
-        clan = clanbattle.get_clan_data(item.clan_gid)
+        clan = await clanbattle.get_clan_data_async(item.clan_gid)
         uid = item.member if item.member != '' else None
         boss = int(item.boss) if item.boss != '' else None
         cycle = int(item.cycle) if item.cycle != '' else None
@@ -394,22 +553,43 @@ class WebPostRoute:
         else:
             start_time = None
             end_time = None
-        record_list = []
-        records = clan.get_record(uid=uid, boss=boss, cycle=cycle,
-                                  start_time=start_time, end_time=end_time, time_desc=True)
-        if not records:
-            return {"err_code": 0, "record": []}
-        for record in records:
-            record_list.append(model_to_dict(record))
-        return {"err_code": 0, "record": record_list}
+        if item.fields and not set(item.fields) <= record_field_names:
+            return {"err_code": 403, "msg": "查询的字段不存在"}
+        try:
+            cursor = parse_record_cursor(item.cursor) if item.cursor else None
+        except ValueError:
+            return {"err_code": 403, "msg": "分页参数错误"}
+        query_kwargs = {"uid": uid, "boss": boss, "cycle": cycle, "start_time": start_time, "end_time": end_time, "fields": item.fields}
+        if item.stream:
+            return StreamingResponse(stream_records(clan, query_kwargs, cursor), media_type="application/x-ndjson")
+        limit = min(item.limit, max_record_page_size) if item.limit else None
+        record_list = await clan.get_record_dicts(**query_kwargs, cursor=cursor, limit=limit)
+        next_cursor = format_record_cursor(record_list[-1]) if limit and len(record_list) == limit else None
+        return {"err_code": 0, "record": record_list, "next_cursor": next_cursor}
+
+    @staticmethod
+    async def export_data(item: WebExportData, session: str = Cookie(None)):
+        uid = (await get_web_session(session))[0]
+        clan = await clanbattle.get_clan_data_async(item.clan_gid)
+        if not await clan.check_admin_permission(str(uid)):
+            return {"err_code": -2, "msg": "您不是会战管理员，无权导出会战数据"}
+        if item.table not in export_models:
+            return {"err_code": 403, "msg": "导出的数据表不存在"}
+        data_num = item.data_num if item.data_num is not None else clan.clan_info.current_using_data_num
+        try:
+            exporter = TableExporter(export_models[item.table], item.clan_gid, data_num, item.format)
+        except ClanBattleException as e:
+            return {"err_code": 403, "msg": str(e)}
+        return StreamingResponse(stream_export(exporter), media_type=exporter.media_type,
+                                 headers={"Content-Disposition": f'attachment; filename="{exporter.file_name}"'})
 
     @staticmethod
     async def change_current_clanbattle_data_num(item: WebSetClanbattleData, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
-        if not clan.check_admin_permission(str(uid)):
+        uid = (await get_web_session(session))[0]
+        clan = await clanbattle.get_clan_data_async(item.clan_gid)
+        if not await clan.check_admin_permission(str(uid)):
             return {"err_code": -2, "msg": "您不是会战管理员，无权切换会战档案"}
-        clan.set_current_clanbattle_data(item.data_num)
+        await clan.set_current_clanbattle_data(item.data_num)
         bot: Bot = list(nonebot.get_bots().values())[0]
         gid = clan.clan_info.clan_gid
         await bot.send_group_msg(group_id=gid, message=f"会战管理员已经将会战档案切换为{item.data_num}，请注意")
@@ -417,57 +597,38 @@ class WebPostRoute:
 
     @staticmethod
     async def battle_status(item: WebQueryChallengeStatusForm, session: str = Cookie(None)):
-        clan = clanbattle.get_clan_data(item.clan_gid)
-        status_list = []
-        members = clan.get_clan_members()
-        for member in members:
-            if not item.date:
-                status = clan.get_today_record_status(member)
-            else:
-                day_data = item.date.split('T')[0]
-                detla = datetime.timedelta(
-                    hours=9) if clan.clan_info.clan_type == "jp" else datetime.timedelta(hours=8)
-                now_time_today = datetime.datetime.strptime(
-                    day_data, "%Y-%m-%d") + datetime.timedelta(days=1)
-                start_time = now_time_today + \
-                    datetime.timedelta(hours=5) - detla
-                end_time = now_time_today + \
-                    datetime.timedelta(hours=29) - detla
-                status = clan.get_record_status(member, start_time, end_time)
-            status_list.append(status)
+        clan = await clanbattle.get_clan_data_async(item.clan_gid)
+        if not item.date:
+            status_list = await clan.get_today_member_status()
+        else:
+            day_data = item.date.split('T')[0]
+            battle_date = datetime.datetime.strptime(day_data, "%Y-%m-%d").date() + datetime.timedelta(days=1)
+            status_list = await clan.get_members_day_status(battle_date)
         return {"err_code": 0, "status": status_list}
 
     @staticmethod
     async def notice_member(item: WebNoticeChallengeForm, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
-        if not clan.check_admin_permission(str(uid)):
+        uid = (await get_web_session(session))[0]
+        clan = await clanbattle.get_clan_data_async(item.clan_gid)
+        if not await clan.check_admin_permission(str(uid)):
             return {"err_code": -2, "msg": "您不是会战管理员，无权提醒其他成员出刀"}
         notice_list = []
         for key in item.notice_member:
             if item.notice_member[key] == True:
-                if clan.check_joined_clan(key):
+                if await clan.check_joined_clan(key):
                     notice_list.append(key)
-        bot: Bot = list(nonebot.get_bots().values())[0]
-        notice_message = Message("管理员催你快去出刀啦")
-        for member in notice_list:
-            notice_message += MessageSegment.at(member)
-            if len(notice_message) == 20:
-                await bot.send_group_msg(group_id=item.clan_gid, message=notice_message)
-                notice_message = Message("管理员催你快去出刀啦")
-        if len(notice_message) > 1:
-            await bot.send_group_msg(group_id=item.clan_gid, message=notice_message)
+        message_dispatcher.mention(item.clan_gid, "管理员催你快去出刀啦", notice_list)
         return {"err_code": 0}
 
     @staticmethod
     async def remove_clan_member(item: WebRemoveClanMember, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
-        if not clan.check_admin_permission(str(uid)):
+        uid = (await get_web_session(session))[0]
+        clan = await clanbattle.get_clan_data_async(item.clan_gid)
+        if not await clan.check_admin_permission(str(uid)):
             return {"err_code": -2, "msg": "您不是会战管理员，无权将其他成员移出公会"}
         remove_uid = item.remove_member
         bot: Bot = list(nonebot.get_bots().values())[0]
-        if clan.delete_clan_member(remove_uid):
+        if await clan.delete_clan_member(remove_uid):
             await bot.send_group_msg(group_id=item.clan_gid, message=f"会战管理员通过网页将成员{remove_uid}移出公会")
             return {"err_code": 0}
         else:
@@ -475,11 +636,11 @@ class WebPostRoute:
 
     @staticmethod
     async def change_boss_status(item: WebChangeBossStatus, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
-        if not clan.check_admin_permission(str(uid)):
+        uid = (await get_web_session(session))[0]
+        clan = await clanbattle.get_clan_data_async(item.clan_gid)
+        if not await clan.check_admin_permission(str(uid)):
             return {"err_code": -2, "msg": "您不是会战管理员，无权调整boss状态"}
-        if clan.commit_force_change_boss_status(int(item.boss), int(item.cycle), item.remain_hp):
+        if await clan.commit_force_change_boss_status(int(item.boss), int(item.cycle), item.remain_hp, str(uid)):
             bot: Bot = list(nonebot.get_bots().values())[0]
             await bot.send_group_msg(group_id=item.clan_gid, message=f"会战管理员通过网页将{item.boss}王调整至{item.cycle}周目，剩余生命值{item.remain_hp}")
             return {"err_code": 0}
@@ -487,6 +648,19 @@ class WebPostRoute:
             return {"err_code": 403, "msg": "调整状态出现错误"}
 
 
+# 路由表在加载时生成，避免每次请求都反射查找
+web_get_routes = {name: getattr(WebGetRoute, name)
+                  for name in vars(WebGetRoute) if not name.startswith("_")}
+web_post_routes = {name: (getattr(WebPostRoute, name), inspect.signature(getattr(WebPostRoute, name)).parameters["item"].annotation)
+                   for name in vars(WebPostRoute) if not name.startswith("_")}
+
+# WebSocket 推送的主题与 GET 接口返回的数据一致
+push_hub.register_topic("boss_status", lambda clan_gid: WebGetRoute.boss_status(None, clan_gid))
+push_hub.register_topic("queue", lambda clan_gid: WebGetRoute.get_in_queue(None, clan_gid))
+push_hub.register_topic("on_tree", lambda clan_gid: WebGetRoute.on_tree_list(None, clan_gid))
+push_hub.register_topic("subscribe", lambda clan_gid: WebGetRoute.subscribe_list(None, clan_gid))
+
+
 if not "pytest" in sys.modules:
 
     @app.get("/")
@@ -500,24 +674,24 @@ if not "pytest" in sys.modules:
 
     @app.get("/api/clanbattle/{api_name}")
     async def _(api_name: str, response: Response, clan_gid: str = None, session: str = Cookie(None)):
-        if not (uid := WebAuth.check_session_valid(session)):
+        uid, joined_clan = await get_web_session(session)
+        if not uid:
             return {"err_code": -1, "msg": "会话错误，请重新登录"}
-        if not hasattr(WebGetRoute, api_name):
+        if not (get_func := web_get_routes.get(api_name)):
             response.status_code = 404
             return {"err_code": 404, "msg": "找不到该路由"}
         if api_name in ["get_joined_clan"]:
-            ret = await getattr(WebGetRoute, api_name)(uid=uid)
+            ret = await get_func(uid=uid)
         else:
-            joined_clan = clanbattle.get_joined_clan(uid)
             if not clan_gid in joined_clan:
                 return {"err_code": 403, "msg": "您还没有加入该公会"}
             #clan = clanbattle.get_clan_data(clan_gid)
-            ret = await getattr(WebGetRoute, api_name)(uid=uid, clan_gid=clan_gid)
+            ret = await get_func(uid=uid, clan_gid=clan_gid)
         return ret
 
     @app.post("/api/clanbattle/{api_name}")
     async def _(api_name: str, request: Request, response: Response, session: str = Cookie(None),):
-        if not hasattr(WebPostRoute, api_name):
+        if not (post_route := web_post_routes.get(api_name)):
             response.status_code = 404
             return {"err_code": 404, "msg": "找不到该路由"}
         try:
@@ -525,14 +699,12 @@ if not "pytest" in sys.modules:
             if api_name == "login":
                 return await WebPostRoute.login(WebLoginPost.parse_obj(json_content), request, response)
             else:
-                post_func = getattr(WebPostRoute, api_name)
-                sig = inspect.signature(post_func)
-                post_item_class: WebPostBase = sig.parameters["item"].annotation
+                post_func, post_item_class = post_route
                 item_inst = post_item_class.parse_obj(json_content)
                 # 部分鉴权
-                if not (uid := WebAuth.check_session_valid(session)):
+                uid, joined_clan = await get_web_session(session)
+                if not uid:
                     return {"err_code": -1, "msg": "会话错误，请重新登录"}
-                joined_clan = clanbattle.get_joined_clan(uid)
                 if not item_inst.clan_gid in joined_clan:
                     return {"err_code": 403, "msg": "您还没有加入该公会"}
                 return await post_func(item=item_inst, session=session)
@@ -540,61 +712,97 @@ if not "pytest" in sys.modules:
             response.status_code = 403
             return "Forbidden"
 
+    @app.websocket("/api/clanbattle/ws/{clan_gid}")
+    async def _(websocket: WebSocket, clan_gid: str):
+        await websocket.accept()
+        try:
+            uid, joined_clan = await get_web_session(websocket.cookies.get("session"))
+            if not uid or not clan_gid in joined_clan:
+                raise WebsocketAuthException()
+            await push_hub.serve(websocket, clan_gid)
+        except WebsocketAuthException as e:
+            await websocket.close(code=4003, reason=str(e))
+        except WebSocketDisconnect:
+            pass
+        except asyncio.TimeoutError:
+            # 客户端接收过慢，断开后由客户端重连获取完整状态
+            await websocket.close(code=1013)
+
+
+deleted_table_name = {
+    "battle_record": "出刀记录",
+    "battle_in_progress": "出刀申请",
+    "battle_sl": "SL记录",
+    "battle_subscribe": "预约",
+    "battle_on_tree": "挂树记录",
+    "battle_event": "会战事件",
+    "boss_state_snapshot": "进度快照",
+    "daily_member_summary": "每日出刀统计",
+    "clan_membership": "成员及管理员",
+}
+
+
+def format_deleted_count(deleted: Dict[str, int]) -> str:
+    return "，".join(f"{deleted_table_name.get(table, table)}{count}条" for table, count in deleted.items())
+
 
 class clanbattle_qq:
-    worker = MatcherGroup(
-        type="message", block=True
-    )
-    create_clan = worker.on_regex(r"^创建([台日国])服[公工]会$")
-    commit_record = worker.on_regex(
+    # 所有指令由同一个消息响应器按首字符预筛选后分发
+    dispatcher = CommandDispatcher()
+    worker = dispatcher.matcher
+    create_clan = dispatcher.on_regex(r"^创建([台日国])服[公工]会$")
+    commit_record = dispatcher.on_regex(
         r"^([1-5]{1})?报刀 ?(整)? ?([1-5]{1})??( )?(\d+[EeKkWwBb]{0,2})?([:：](.*?))? ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$"
     )
-    commit_kill_record = worker.on_regex(
+    commit_kill_record = dispatcher.on_regex(
         r"^([1-5]{1})?尾刀 ?(整)? ?([1-5]{1})?? ?([:：](.*?))? ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$")
-    progress = worker.on_regex(r"^(状态|查) ?([1-5]{0,5})?$")
-    query_recent_record = worker.on_regex(
+    progress = dispatcher.on_regex(r"^(状态|查) ?([1-5]{0,5})?$")
+    query_recent_record = dispatcher.on_regex(
         r"^查刀 ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$")
-    queue = worker.on_regex(r"^((申请(出刀)?)|进) ?([1-5]{1})?([:：](.*?))?$")
-    unqueue = worker.on_regex(r"^取消申请|解锁$")
-    showqueue = worker.on_regex(r"^出刀表 ?([1-5]{1,5})?$")
+    queue = dispatcher.on_regex(r"^((申请(出刀)?)|进) ?([1-5]{1})?([:：](.*?))?$")
+    unqueue = dispatcher.on_regex(r"^取消申请|解锁$")
+    showqueue = dispatcher.on_regex(r"^出刀表 ?([1-5]{1,5})?$")
     #clearqueue = worker.on_regex(r"^[清删][空除]出刀表([1-5]{1,5})?$")
-    on_tree = worker.on_regex(
+    on_tree = dispatcher.on_regex(
         r"^挂树 ?([1-5]{1})?([:：](.*?))? ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$"
     )
-    un_on_tree = worker.on_regex(r"^取消挂树|下树$")
-    query_on_tree = worker.on_regex(r"^查树$")
-    subscribe = worker.on_regex(
+    un_on_tree = dispatcher.on_regex(r"^取消挂树|下树$")
+    query_on_tree = dispatcher.on_regex(r"^查树$")
+    subscribe = dispatcher.on_regex(
         r"^预约 ?([1-5]{1})( )?([0-9]{1,3})?([:：](.*?))?$")
-    showsubscribe = worker.on_regex(r"^预约表$")
-    unsubscribe = worker.on_regex(r"^取消预约 ?([1-5]{1})( )?([0-9]{1,3})?$")
-    undo_record_commit = worker.on_regex(
+    showsubscribe = dispatcher.on_regex(r"^预约表$")
+    unsubscribe = dispatcher.on_regex(r"^取消预约 ?([1-5]{1})( )?([0-9]{1,3})?$")
+    undo_record_commit = dispatcher.on_regex(
         r"^撤[回销]? ?([1-5]{1})?$"
     )
-    sl = worker.on_regex(
+    sl = dispatcher.on_regex(
         r"^[sS][lL](\?|？)? ?([1-5]{1})?([:：](.*?))?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$")
-    sl_query = on_regex(r"^查[sS][lL] ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$")
-    today_record = on_regex(r"^今日出刀 ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$")
-    webview = worker.on_regex(r"^面板$")
-    help = worker.on_regex(r"^帮助$")
-    join_clan = worker.on_regex(
+    sl_query = dispatcher.on_regex(r"^查[sS][lL] ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$")
+    today_record = dispatcher.on_regex(r"^今日出刀 ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$")
+    webview = dispatcher.on_regex(r"^面板$")
+    help = dispatcher.on_regex(r"^帮助$")
+    join_clan = dispatcher.on_regex(
         r"^加入[公工]会 ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$")
-    leave_clan = worker.on_regex(r"^退出[公工]会$")
-    refresh_clan_admin = worker.on_regex(r"^刷新会战管理员列表$")
-    rename_clan_uname = worker.on_regex(
+    leave_clan = dispatcher.on_regex(r"^退出[公工]会$")
+    refresh_clan_admin = dispatcher.on_regex(r"^刷新会战管理员列表$")
+    rename_clan_uname = dispatcher.on_regex(
         r"^修改昵称 ?(.{1,20})(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$")
-    rename_clan = worker.on_regex(r"^修改[公工]会名称 ?(.{1,20})$")
-    remove_clan_member = worker.on_regex(r"^移出[公工]会 ?(.{1,20})$")
-    reset_password = worker.on_regex(r"^设置密码 ?(.{1,20})$")
-    add_clanbattle_admin = on_regex(
+    rename_clan = dispatcher.on_regex(r"^修改[公工]会名称 ?(.{1,20})$")
+    remove_clan_member = dispatcher.on_regex(r"^移出[公工]会 ?(.{1,20})$")
+    reset_password = dispatcher.on_regex(r"^设置密码 ?(.{1,20})$")
+    add_clanbattle_admin = dispatcher.on_regex(
         r"^添加会战管理员 ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)$")
-    join_all_member = worker.on_regex(r"^加入全部成员$")
-    switch_current_clanbattle_data = worker.on_regex(r"^切换会战档案 ?(.{1,2})$")
-    clear_current_clanbattle_data = worker.on_regex(r"^清空当前会战档案$")
-    force_change_boss_status = worker.on_regex(
+    join_all_member = dispatcher.on_regex(r"^加入全部成员$")
+    switch_current_clanbattle_data = dispatcher.on_regex(r"^切换会战档案 ?(.{1,2})$")
+    clear_current_clanbattle_data = dispatcher.on_regex(r"^清空当前会战档案$")
+    force_change_boss_status = dispatcher.on_regex(
         r"^修改进度 ?([1-5]{1}) ([0-9]{1,3}) (\d+[EeKkWwBb]{0,2})$")
-    delete_clan = worker.on_regex(r"^清除公会数据$")
-    query_certain_num = worker.on_regex(r"^查(([0-3]{1})|(补偿))刀$")
-    notice_not_report = worker.on_regex(r"^催刀([0-2]{1})?$")
+    batch_commit_record = dispatcher.on_regex(r"^批量报刀\s*\n([\s\S]+)$")
+    delete_clan = dispatcher.on_regex(r"^清除公会数据$")
+    query_certain_num = dispatcher.on_regex(r"^查(([0-3]{1})|(补偿))刀$")
+    notice_not_report = dispatcher.on_regex(r"^催刀([0-2]{1})?$")
+    clan_statistics = dispatcher.on_regex(r"^会战统计$")
+    reload_clan = dispatcher.on_regex(r"^重新加载[公工]会$")
     #killcalc = worker.on_regex(r"^合刀( )?(\d+) (\d+) (\d+)( \d+)?$")
 
 
@@ -608,7 +816,7 @@ async def create_clan_qq(bot: Bot, event: GroupMessageEvent, state: T_State):
         clan_type = "tw"
     elif clan_area == "国":
         clan_type = "cn"
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data_async(gid)
     if clan:
         await clanbattle_qq.create_clan.send("公会已经存在！")
     else:
@@ -623,20 +831,17 @@ async def create_clan_qq(bot: Bot, event: GroupMessageEvent, state: T_State):
         for member in group_member_list:
             if member["role"] in ["owner", "admin"] and member["user_id"] != int(bot.self_id):
                 admin_list.append(str(member["user_id"]))
-        clanbattle.create_clan(gid, group_name, clan_type, admin_list)
+        await run_in_db_thread(clanbattle.create_clan, gid, group_name, clan_type, admin_list)
         await clanbattle_qq.create_clan.send("公会创建成功，请发送“帮助”查看使用说明")
-        clan = clanbattle.get_clan_data(gid)
+        clan = await clanbattle.get_clan_data_async(gid)
         if len(group_member_list) > 36:
             await clanbattle_qq.create_clan.send("当前群内人数过多，仅自动加入管理员，请手动加入需要加入公会的群员，如需加入全部成员请发送“加入全部成员”")
-            for member in group_member_list:
-                if member["role"] in ["owner", "admin"] and member["user_id"] != int(bot.self_id):
-                    clan.add_clan_member(str(
-                        member["user_id"]), member["card"] if member["card"] != "" else member["nickname"])
+            await clan.add_clan_members([(str(member["user_id"]), member["card"] if member["card"] != "" else member["nickname"])
+                                         for member in group_member_list
+                                         if member["role"] in ["owner", "admin"] and member["user_id"] != int(bot.self_id)])
         else:
-            for member in group_member_list:
-                if member["user_id"] != int(bot.self_id):
-                    clan.add_clan_member(str(
-                        member["user_id"]), member["card"] if member["card"] != "" else member["nickname"])
+            await clan.add_clan_members([(str(member["user_id"]), member["card"] if member["card"] != "" else member["nickname"])
+                                         for member in group_member_list if member["user_id"] != int(bot.self_id)])
             await clanbattle_qq.create_clan.send("已经将全部群成员加入公会")
 
 
@@ -644,28 +849,28 @@ async def create_clan_qq(bot: Bot, event: GroupMessageEvent, state: T_State):
 async def get_clanbatle_status_qq(bot: Bot, event: GroupMessageEvent, state: T_State):
     print(get_config)
     gid = str(event.group_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data_async(gid)
     if not clan:
         await clanbattle_qq.progress.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.progress.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     if clan.clan_info.clan_type != "cn":
-        boss_status = clan.get_current_boss_state()
+        boss_status = await clan.get_current_boss_state()
         if state['_matched_groups'][0] == "状态" and not state['_matched_groups'][1]:
             msg = "当前状态：\n" if not get_config().enable_anti_msg_fail else "Status:\n"
             for boss in boss_status:
                 msg += f"{boss.target_cycle}周目{boss.target_boss}王，生命值{Tools.get_num_str_with_dot(boss.boss_hp)}" if not get_config(
                 ).enable_anti_msg_fail else f"{boss.target_cycle}周目{boss.target_boss}王 HP{Tools.get_num_str_with_dot(boss.boss_hp)}"
-                if not clan.check_boss_challengeable(boss.target_cycle, boss.target_boss):
+                if not await clan.check_boss_challengeable(boss.target_cycle, boss.target_boss):
                     msg += "（不可挑战）"
                 msg += "\n"
-            status = clan.get_today_record_status_total()
+            status = await clan.get_today_record_status_total()
             msg += f"今日已出{status[0]}刀，剩余{status[1]}刀补偿刀"
-            in_processes = clan.get_battle_in_progress()
+            in_processes = await clan.get_battle_in_progress()
             in_processes_num = 0
             for _ in in_processes:
                 in_processes_num += 1
-            on_tree = clan.get_battle_on_tree()
+            on_tree = await clan.get_battle_on_tree()
             on_tree_num = 0
             for _ in on_tree:
                 on_tree_num += 1
@@ -675,55 +880,55 @@ async def get_clanbatle_status_qq(bot: Bot, event: GroupMessageEvent, state: T_S
             boss_count = int(state['_matched_groups'][1])
             boss = boss_status[boss_count-1]
             msg = f"当前{boss_count}王位于{boss.target_cycle}周目，剩余血量{Tools.get_num_str_with_dot(boss.boss_hp)}"
-            if not clan.check_boss_challengeable(boss.target_cycle, boss_count):
+            if not await clan.check_boss_challengeable(boss.target_cycle, boss_count):
                 msg += "（不可挑战）"
             msg += "\n"
-            subs = clan.get_battle_subscribe(
+            subs = await clan.get_battle_subscribe(
                 boss=boss_count, boss_cycle=boss.target_cycle)
             if subs:
                 for sub in subs:
-                    msg += clan.get_user_name(sub.member_uid)
+                    msg += await clan.get_user_name(sub.member_uid)
                     if sub.comment and sub.comment != "":
                         msg += f"：{sub.comment}"
                 msg += "已经预约该boss"
-            in_processes = clan.get_battle_in_progress(boss=boss_count)
+            in_processes = await clan.get_battle_in_progress(boss=boss_count)
             if in_processes:
                 if subs:
                     msg += "\n"
                 in_process_list = []
                 for proc in in_processes:
-                    proc_msg = clan.get_user_name(proc.member_uid)
+                    proc_msg = await clan.get_user_name(proc.member_uid)
                     if proc.comment and proc.comment != "":
                         proc_msg += f"：{proc.comment}"
                     in_process_list.append(proc_msg)
                 msg += "、".join(in_process_list) + "正在出刀"
-            on_tree = clan.get_battle_on_tree(boss=boss_count)
+            on_tree = await clan.get_battle_on_tree(boss=boss_count)
             if on_tree:
                 if in_processes or subs:
                     msg += "\n"
                 on_tree_list = []
                 for tree in on_tree:
-                    on_tree_msg = clan.get_user_name(tree.member_uid)
+                    on_tree_msg = await clan.get_user_name(tree.member_uid)
                     if tree.comment and tree.comment != "":
                         on_tree_msg += f"：{tree.comment}"
                     on_tree_list.append(on_tree_msg)
                 msg += f"现在{ '、'.join(on_tree_list)}还挂在树上"
     else:
         msg = "当前状态：\n"
-        boss_status = clan.get_current_boss_state_cn()
+        boss_status = await clan.get_current_boss_state_cn()
         msg += f"{boss_status.target_cycle}周目{boss_status.target_boss}王，生命值{Tools.get_num_str_with_dot(boss_status.boss_hp)}"
-        status = clan.get_today_record_status_total()
+        status = await clan.get_today_record_status_total()
         msg += f"\n今日已出{status[0]}刀，剩余{status[1]}刀补偿刀"
-        in_processes = clan.get_battle_in_progress()
+        in_processes = await clan.get_battle_in_progress()
         in_process_list = []
         for process in in_processes:
-            in_process_list.append(clan.get_user_name(process.member_uid))
+            in_process_list.append(await clan.get_user_name(process.member_uid))
         if in_process_list:
             msg += f"\n当前{ '、'.join(in_process_list)}正在出刀"
-        on_tree = clan.get_battle_on_tree()
+        on_tree = await clan.get_battle_on_tree()
         on_tree_list = []
         for tree in on_tree:
-            on_tree_list.append(clan.get_user_name(tree.member_uid))
+            on_tree_list.append(await clan.get_user_name(tree.member_uid))
         if on_tree_list:
             msg += f"\n现在{ '、'.join(on_tree_list)}还挂在树上"
     await clanbattle_qq.progress.finish(msg.strip() if isinstance(msg, str) else msg)
@@ -745,30 +950,30 @@ async def commit_record_qq(bot: Bot, event: GroupMessageEvent, state: T_State):
                              ) if state['_matched_groups'][2] else None
     challenge_damage = state['_matched_groups'][4]
     comment = state['_matched_groups'][6]
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if clan.clan_info.clan_type == "cn":
-        challenge_boss = clan.get_current_boss_state_cn().target_boss
+        challenge_boss = (await clan.get_current_boss_state_cn()).target_boss
     if not challenge_boss:
-        if progress := clan.get_battle_in_progress(uid=uid):
+        if progress := await clan.get_battle_in_progress(uid=uid):
             challenge_boss = progress[0].target_boss
-        elif on_tree := clan.get_battle_on_tree(uid=uid):
+        elif on_tree := await clan.get_battle_on_tree(uid=uid):
             challenge_boss = on_tree[0].target_boss
         elif proxy_report_uid:
-            if progress := clan.get_battle_in_progress(uid=proxy_report_uid):
+            if progress := await clan.get_battle_in_progress(uid=proxy_report_uid):
                 challenge_boss = progress[0].target_boss
-            elif on_tree := clan.get_battle_on_tree(uid=proxy_report_uid):
+            elif on_tree := await clan.get_battle_on_tree(uid=proxy_report_uid):
                 challenge_boss = on_tree[0].target_boss
         if not challenge_boss:
             await clanbattle_qq.commit_record.finish("您还没有正在挑战的boss，请发送“报刀x 伤害”来进行报刀")
     if not clan:
         await clanbattle_qq.commit_record.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.commit_record.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     result = await clan.commit_record(uid, challenge_boss, challenge_damage, comment, proxy_report_uid, force_use_full_chance)
     if result == CommitRecordResult.success:
-        record = clan.get_recent_record(uid)[0]
-        today_status = clan.get_today_record_status(uid)
-        boss_status = clan.get_current_boss_state()[challenge_boss-1]
+        record = (await clan.get_recent_record(uid))[0]
+        today_status = await clan.get_today_record_status(uid)
+        boss_status = (await clan.get_current_boss_state())[challenge_boss-1]
         if today_status.last_is_addition:
             record_type = "补偿刀"
         else:
@@ -806,32 +1011,32 @@ async def commit_kill_record(bot: Bot, event: GroupMessageEvent, state: T_State)
         challenge_boss = int(state['_matched_groups'][2]
                              ) if state['_matched_groups'][2] else None
     comment = state['_matched_groups'][4]
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if not clan:
         await clanbattle_qq.commit_kill_record.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.commit_kill_record.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     if clan.clan_info.clan_type == "cn":
-        challenge_boss = clan.get_current_boss_state_cn().target_boss
+        challenge_boss = (await clan.get_current_boss_state_cn()).target_boss
     if not challenge_boss:
-        if progress := clan.get_battle_in_progress(uid=uid):
+        if progress := await clan.get_battle_in_progress(uid=uid):
             challenge_boss = progress[0].target_boss
-        elif on_tree := clan.get_battle_on_tree(uid=uid):
+        elif on_tree := await clan.get_battle_on_tree(uid=uid):
             challenge_boss = on_tree[0].target_boss
         elif proxy_report_uid:
-            if progress := clan.get_battle_in_progress(uid=proxy_report_uid):
+            if progress := await clan.get_battle_in_progress(uid=proxy_report_uid):
                 challenge_boss = progress[0].target_boss
-            elif on_tree := clan.get_battle_on_tree(uid=proxy_report_uid):
+            elif on_tree := await clan.get_battle_on_tree(uid=proxy_report_uid):
                 challenge_boss = on_tree[0].target_boss
         if not challenge_boss:
             await clanbattle_qq.commit_kill_record.finish("您还没有正在挑战的boss，请发送“尾刀x”来进行报刀")
-    boss_status = clan.get_current_boss_state()[challenge_boss-1]
-    challenge_damage = str(boss_status.boss_hp)
-    result = await clan.commit_record(uid, challenge_boss, challenge_damage, comment, proxy_report_uid, force_use_full_chance)
+    # 只记录上报时的周目，伤害在提交时按当前血量计算，该周目已被击破时提交失败
+    target_cycle = (await clan.get_current_boss_state())[challenge_boss-1].target_cycle
+    result = await clan.commit_record(uid, challenge_boss, None, comment, proxy_report_uid, force_use_full_chance, True, target_cycle)
     if result == CommitRecordResult.success:
-        record = clan.get_recent_record(uid)[0]
-        today_status = clan.get_today_record_status(uid)
-        boss_status = clan.get_current_boss_state()[challenge_boss-1]
+        record = (await clan.get_recent_record(uid))[0]
+        today_status = await clan.get_today_record_status(uid)
+        boss_status = (await clan.get_current_boss_state())[challenge_boss-1]
         if today_status.last_is_addition:
             record_type = "补偿刀"
         else:
@@ -840,13 +1045,13 @@ async def commit_kill_record(bot: Bot, event: GroupMessageEvent, state: T_State)
             if clan.clan_info.clan_type != "cn":
                 await clanbattle_qq.commit_kill_record.finish(MessageSegment.at(uid) + f"对{challenge_boss}王造成了{Tools.get_num_str_with_dot(record.damage)}点伤害并击破\n今日已出{today_status.today_challenged}刀完整刀，余{today_status.remain_addition_challeng}刀补偿刀，当前刀为{record_type}\n==============\n当前{challenge_boss}王第{boss_status.target_cycle}周目，生命值{Tools.get_num_str_with_dot(boss_status.boss_hp)}")
             else:
-                boss_status = clan.get_current_boss_state_cn()
+                boss_status = await clan.get_current_boss_state_cn()
                 await clanbattle_qq.commit_kill_record.finish(MessageSegment.at(uid) + f"对{challenge_boss}王造成了{Tools.get_num_str_with_dot(record.damage)}点伤害并击破\n今日已出{today_status.today_challenged}刀完整刀，余{today_status.remain_addition_challeng}刀补偿刀，当前刀为{record_type}==============\n当前{boss_status.target_boss}王第{boss_status.target_cycle}周目，生命值{Tools.get_num_str_with_dot(boss_status.boss_hp)}")
         else:
             if clan.clan_info.clan_type != "cn":
                 await clanbattle_qq.commit_kill_record.finish(MessageSegment.at(uid) + f"对{challenge_boss}王造成了{Tools.get_num_str_with_dot(record.damage)}点伤害并击败\n今日已出{today_status.today_challenged}刀完整刀，余{today_status.remain_addition_challeng}刀补偿刀，当前为{record_type}\n==============\n当前{challenge_boss}王第{boss_status.target_cycle}周目 HP{Tools.get_num_str_with_dot(boss_status.boss_hp)}nya")
             else:
-                boss_status = clan.get_current_boss_state_cn()
+                boss_status = await clan.get_current_boss_state_cn()
                 await clanbattle_qq.commit_kill_record.finish(MessageSegment.at(uid) + f"对{challenge_boss}王造成了{Tools.get_num_str_with_dot(record.damage)}点伤害并击破\n今日已出{today_status.today_challenged}刀完整刀，余{today_status.remain_addition_challeng}刀补偿刀，当前刀为{record_type}==============\n当前{boss_status.target_boss}王第{boss_status.target_cycle}周目 HP{Tools.get_num_str_with_dot(boss_status.boss_hp)}nya")
     elif result == CommitRecordResult.illegal_damage_inpiut:
         await clanbattle_qq.commit_kill_record.finish("上报的伤害格式不合法")
@@ -860,6 +1065,8 @@ async def commit_kill_record(bot: Bot, event: GroupMessageEvent, state: T_State)
         await clanbattle_qq.commit_kill_record.finish("现在无法挑战这个boss，别在这发癫了！")
     elif result == CommitRecordResult.on_another_tree:
         await clanbattle_qq.commit_kill_record.finish("你还挂在其他树上，先下树再说吧")
+    elif result == CommitRecordResult.boss_cycle_already_killed:
+        await clanbattle_qq.commit_kill_record.finish("这个周目的boss已经被其他人击破了，请确认后重新报刀")
 
 
 @clanbattle_qq.queue.handle()
@@ -869,29 +1076,29 @@ async def commit_in_progress(bot: Bot, event: GroupMessageEvent, state: T_State)
     challenge_boss = int(state['_matched_groups'][3]
                          ) if state['_matched_groups'][3] else None
     comment = state['_matched_groups'][5]
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if not clan:
         await clanbattle_qq.queue.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.queue.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     if clan.clan_info.clan_type == "cn":
-        challenge_boss = clan.get_current_boss_state_cn().target_boss
+        challenge_boss = (await clan.get_current_boss_state_cn()).target_boss
     if not challenge_boss:
-        if progress := clan.get_battle_in_progress(uid=uid):
-            clan.update_battle_in_progress_record(uid, comment)
+        if progress := await clan.get_battle_in_progress(uid=uid):
+            await clan.update_battle_in_progress_record(uid, comment)
             await clanbattle_qq.queue.finish("修改出刀备注成功！")
     msg = ""
-    if processes := clan.get_battle_in_progress(boss=challenge_boss):
+    if processes := await clan.get_battle_in_progress(boss=challenge_boss):
         in_process_list = []
         for proc in processes:
             if proc.comment and proc.comment != "":
                 in_process_list.append(
-                    f"{clan.get_user_info(proc.member_uid).uname}：{proc.comment}")
+                    f"{await clan.get_user_name(proc.member_uid)}：{proc.comment}")
             else:
                 in_process_list.append(
-                    clan.get_user_info(proc.member_uid).uname)
+                    await clan.get_user_name(proc.member_uid))
         msg = "、".join(in_process_list) + "正在对当前boss出刀，请注意"
-    result = clan.commit_battle_in_progress(uid, challenge_boss, comment)
+    result = await clan.commit_battle_in_progress(uid, challenge_boss, comment)
     if result == CommitInProgressResult.success:
         if not msg == "":
             await clanbattle_qq.queue.send(msg)
@@ -919,23 +1126,23 @@ async def commit_on_tree(bot: Bot, event: GroupMessageEvent, state: T_State):
         uid = str(event.user_id)
     else:
         uid = state['_matched_groups'][4]
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if not clan:
         await clanbattle_qq.on_tree.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.on_tree.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     if clan.clan_info.clan_type == "cn":
-        challenge_boss = clan.get_current_boss_state_cn().target_boss
+        challenge_boss = (await clan.get_current_boss_state_cn()).target_boss
     if not challenge_boss:
-        if in_proc := clan.get_battle_on_tree(uid):
-            clan.update_on_tree_record(uid, comment)
+        if in_proc := await clan.get_battle_on_tree(uid):
+            await clan.update_on_tree_record(uid, comment)
             await clanbattle_qq.on_tree.finish("挂树备注更新成功！")
             return
-        if progress := clan.get_battle_in_progress(uid=uid):
+        if progress := await clan.get_battle_in_progress(uid=uid):
             challenge_boss = progress[0].target_boss
         else:
             await clanbattle_qq.commit_record.finish("您还没有正在挑战的boss，请发送“挂树x ”来挂树")
-    result = clan.commit_battle_on_tree(uid, challenge_boss, comment)
+    result = await clan.commit_battle_on_tree(uid, challenge_boss, comment)
     if result == CommitBattlrOnTreeResult.success:
         await clanbattle_qq.on_tree.finish("嘿呀，" + MessageSegment.at(uid) + f"在{challenge_boss}王挂树了")
     elif result == CommitBattlrOnTreeResult.already_in_other_boss_progress:
@@ -957,12 +1164,12 @@ async def commit_subscribe(bot: Bot, event: GroupMessageEvent, state: T_State):
     comment = state['_matched_groups'][4]
     cycle = int(state['_matched_groups'][2]
                 ) if state['_matched_groups'][2] else None
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if not clan:
         await clanbattle_qq.subscribe.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.subscribe.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    result = clan.commit_batle_subscribe(uid, challenge_boss, cycle,  comment)
+    result = await clan.commit_batle_subscribe(uid, challenge_boss, cycle,  comment)
     if result == CommitSubscribeResult.success:
         await clanbattle_qq.subscribe.finish("预约成功")
     elif result == CommitSubscribeResult.boss_cycle_already_killed:
@@ -981,13 +1188,13 @@ async def join_clan(bot: Bot, event: GroupMessageEvent, state: T_State):
         uid = str(event.user_id)
     else:
         uid = state['_matched_groups'][1]
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if not clan:
         await clanbattle_qq.join_clan.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if clan.check_joined_clan(uid):
+    if await clan.check_joined_clan(uid):
         await clanbattle_qq.join_clan.finish("您已经加入公会了，无需再加入")
     member_info = await bot.get_group_member_info(group_id=event.group_id, user_id=int(uid))
-    clan.add_clan_member(str(
+    await clan.add_clan_member(str(
         member_info["user_id"]), member_info["card"] if member_info["card"] != "" else member_info["nickname"])
     await clanbattle_qq.join_clan.finish("加入成功")
 
@@ -995,12 +1202,12 @@ async def join_clan(bot: Bot, event: GroupMessageEvent, state: T_State):
 @clanbattle_qq.today_record.handle()
 async def _(bot: Bot, event: GroupMessageEvent, state: T_State):
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if not clan:
         await clanbattle_qq.undo_record_commit.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.undo_record_commit.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    records = clan.get_today_record(uid)
+    records = await clan.get_today_record(uid)
 
     pass
 
@@ -1008,41 +1215,41 @@ async def _(bot: Bot, event: GroupMessageEvent, state: T_State):
 @clanbattle_qq.undo_record_commit.handle()
 async def undo_record_commit(bot: Bot, event: GroupMessageEvent, state: T_State):
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if not clan:
         await clanbattle_qq.undo_record_commit.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.undo_record_commit.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     boss_count = int(state['_matched_groups'][0]
                      ) if state['_matched_groups'][0] else None
     if clan.clan_info.clan_type == "cn":
-        recent_record = clan.get_recent_record()
+        recent_record = await clan.get_recent_record()
         if not recent_record:
             await clanbattle_qq.undo_record_commit.finish("未找到最近的出刀记录")
-        if recent_record[0].member_uid != uid and recent_record[0].proxy_report_uid != uid and not clan.check_admin_permission(uid):
+        if recent_record[0].member_uid != uid and recent_record[0].proxy_report_uid != uid and not await clan.check_admin_permission(uid):
             await clanbattle_qq.undo_record_commit.finish("您没有权限撤销上一次的报刀")
-        ret = clan.delete_recent_record(recent_record[0].member_uid)
+        ret = await clan.delete_recent_record(recent_record[0].member_uid)
         if ret:
             msg = "出刀撤回成功"
             boss_count: int = recent_record[0].target_boss
             if boss_count:
-                boss_status = clan.get_current_boss_state_cn()
+                boss_status = await clan.get_current_boss_state_cn()
                 msg += f"\n============\n当前{boss_status.target_boss}王位于{boss_status.target_cycle}周目，剩余血量{Tools.get_num_str_with_dot(boss_status.boss_hp)}\n"
             await clanbattle_qq.undo_record_commit.finish(msg)
         else:
             await clanbattle_qq.undo_record_commit.finish("出刀撤回失败，内部错误")
     else:
         if boss_count:
-            recent_record = clan.get_recent_record(boss=boss_count)
+            recent_record = await clan.get_recent_record(boss=boss_count)
             if recent_record:
                 challenge_uid = recent_record[0].member_uid
                 proxy_uid = recent_record[0].proxy_report_uid
-                if uid in (challenge_uid, proxy_uid) or clan.check_admin_permission(str(event.user_id)):
-                    ret = clan.delete_recent_record(challenge_uid)
+                if uid in (challenge_uid, proxy_uid) or await clan.check_admin_permission(str(event.user_id)):
+                    ret = await clan.delete_recent_record(challenge_uid)
                     if ret:
                         msg = "出刀撤回成功"
                         if boss_count:
-                            boss_status = clan.get_current_boss_state()
+                            boss_status = await clan.get_current_boss_state()
                             boss = boss_status[boss_count-1]
                             msg += f"\n============\n当前{boss_count}王位于{boss.target_cycle}周目，剩余血量{Tools.get_num_str_with_dot(boss.boss_hp)}\n"
                         await clanbattle_qq.undo_record_commit.finish(msg)
@@ -1054,19 +1261,19 @@ async def undo_record_commit(bot: Bot, event: GroupMessageEvent, state: T_State)
             else:
                 await clanbattle_qq.undo_record_commit.finish("出刀撤回失败，未找到对应的出刀记录")
         else:
-            recent_record = clan.get_recent_record(uid=uid)
+            recent_record = await clan.get_recent_record(uid=uid)
             if not recent_record:
                 await clanbattle_qq.undo_record_commit.finish("未找到最近的出刀记录")
-            recent_boss_record = clan.get_recent_record(
+            recent_boss_record = await clan.get_recent_record(
                 boss=recent_record[0].target_boss)
             if recent_record[0].record_time != recent_boss_record[0].record_time:
                 await clanbattle_qq.undo_record_commit.finish(f"您在最近一次出刀后该boss有其他的出刀记录，无法撤回，若是管理员或代报刀可使用'撤回 {recent_record[0].target_boss}'来撤回其他人的出刀")
-            ret = clan.delete_recent_record(recent_record[0].member_uid)
+            ret = await clan.delete_recent_record(recent_record[0].member_uid)
             if ret:
                 msg = "出刀撤回成功"
                 boss_count: int = recent_record[0].target_boss
                 if boss_count:
-                    boss_status = clan.get_current_boss_state()
+                    boss_status = await clan.get_current_boss_state()
                     boss = boss_status[boss_count - 1]
                     msg += f"\n============\n当前{boss_count}王位于{boss.target_cycle}周目，剩余血量{Tools.get_num_str_with_dot(boss.boss_hp)}\n"
                 await clanbattle_qq.undo_record_commit.finish(msg)
@@ -1077,12 +1284,12 @@ async def undo_record_commit(bot: Bot, event: GroupMessageEvent, state: T_State)
 @clanbattle_qq.un_on_tree.handle()
 async def _(bot: Bot, event: GroupMessageEvent, state: T_State):
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if not clan:
         await clanbattle_qq.un_on_tree.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.un_on_tree.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    result = clan.delete_battle_on_tree(uid)
+    result = await clan.delete_battle_on_tree(uid)
     if result:
         await clanbattle_qq.un_on_tree.finish("下树成功")
     else:
@@ -1095,12 +1302,12 @@ async def unsubscribe_boss(bot: Bot, event: GroupMessageEvent, state: T_State):
     challenge_boss = int(state['_matched_groups'][0])
     cycle = int(state['_matched_groups'][2]
                 ) if state['_matched_groups'][2] else None
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if not clan:
         await clanbattle_qq.unsubscribe.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.unsubscribe.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    result = clan.delete_battle_subscribe(uid, challenge_boss, cycle)
+    result = await clan.delete_battle_subscribe(uid, challenge_boss, cycle)
     if result:
         await clanbattle_qq.unsubscribe.finish("取消预约成功desu")
     else:
@@ -1110,13 +1317,13 @@ async def unsubscribe_boss(bot: Bot, event: GroupMessageEvent, state: T_State):
 @clanbattle_qq.query_recent_record.handle()
 async def query_recent_record(bot: Bot, event: GroupMessageEvent, state: T_State):
     target_qq = state['_matched_groups'][1]
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if not clan:
         await clanbattle_qq.query_recent_record.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.query_recent_record.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     if not target_qq:
-        records = clan.get_recent_record(num=5)
+        records = await clan.get_recent_record(num=5)
         if not records:
             await clanbattle_qq.query_recent_record.finish("现在还没有出刀记录哦，快去出刀吧")
         else:
@@ -1124,17 +1331,17 @@ async def query_recent_record(bot: Bot, event: GroupMessageEvent, state: T_State
             for record in records:
                 if record.member_uid == "admin":
                     continue
-                msg += f"{clan.get_user_info(record.member_uid).uname}于{(record.record_time +datetime.timedelta(hours=8)).strftime('%m月%d日%H时%M分')}对{record.target_cycle}周目{record.target_boss}王造成了{Tools.get_num_str_with_dot(record.damage)}点伤害\n\n"
+                msg += f"{await clan.get_user_name(record.member_uid)}于{(record.record_time +datetime.timedelta(hours=8)).strftime('%m月%d日%H时%M分')}对{record.target_cycle}周目{record.target_boss}王造成了{Tools.get_num_str_with_dot(record.damage)}点伤害\n\n"
             msg += "更多记录请前往网页端查看，查询指定成员请at"
             await clanbattle_qq.query_recent_record.finish(msg)
     else:
-        if not clan.check_joined_clan(target_qq):
+        if not await clan.check_joined_clan(target_qq):
             await clanbattle_qq.query_recent_record.finish("对方还没有加入公会哦")
-        records = clan.get_today_record(uid=target_qq)
+        records = await clan.get_today_record(uid=target_qq)
         if not records:
             await clanbattle_qq.query_recent_record.finish("Ta还没有出刀记录哦，快催Ta去出刀吧")
         else:
-            msg = f"{clan.get_user_name(target_qq)}今日的出刀记录："
+            msg = f"{await clan.get_user_name(target_qq)}今日的出刀记录："
             for record in records:
                 msg += f"\n{record.target_cycle}周目{record.target_boss}王 {Tools.get_num_str_with_dot(record.damage)} "
                 if record.remain_next_chance:
@@ -1159,24 +1366,24 @@ async def commit_sl(bot: Bot, event: GroupMessageEvent, state: T_State):
     else:
         uid = state['_matched_groups'][5]
         proxy_report_uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if not clan:
         await clanbattle_qq.sl.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.sl.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     if is_query_sl:
-        sl = clan.get_today_battle_sl(uid=uid)
+        sl = await clan.get_today_battle_sl(uid=uid)
         if sl:
             await clanbattle_qq.sl.finish("您今天已经sl过了")
         else:
             await clanbattle_qq.sl.finish("您今天还没有使用过sl哦")
         return
     if not challenge_boss:
-        if progress := clan.get_battle_in_progress(uid=uid):
+        if progress := await clan.get_battle_in_progress(uid=uid):
             challenge_boss = progress[0].target_boss
-        elif on_treee := clan.get_battle_on_tree(uid=uid):
+        elif on_treee := await clan.get_battle_on_tree(uid=uid):
             challenge_boss = on_treee[0].target_boss
-    result = clan.commit_battle_sl(
+    result = await clan.commit_battle_sl(
         uid, challenge_boss, comment, proxy_report_uid)
     if result == CommitSLResult.success:
         await clanbattle_qq.sl.finish("sl已经记录")
@@ -1191,12 +1398,12 @@ async def commit_sl(bot: Bot, event: GroupMessageEvent, state: T_State):
 @clanbattle_qq.unqueue.handle()
 async def unqueue_boss(bot: Bot, event: GroupMessageEvent, state: T_State):
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if not clan:
         await clanbattle_qq.unqueue.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.unqueue.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    result = clan.delete_battle_in_progress(uid)
+    result = await clan.delete_battle_in_progress(uid)
     if result:
         await clanbattle_qq.unsubscribe.finish("取消申请成功desu")
     else:
@@ -1205,22 +1412,22 @@ async def unqueue_boss(bot: Bot, event: GroupMessageEvent, state: T_State):
 
 @clanbattle_qq.showqueue.handle()
 async def show_queue(bot: Bot, event: GroupMessageEvent, state: T_State):
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if not clan:
         await clanbattle_qq.showqueue.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.showqueue.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    progresses = clan.get_battle_in_progress()
+    progresses = await clan.get_battle_in_progress()
     if not progresses:
         await clanbattle_qq.showqueue.finish("当前没有人申请出刀，赶快来出刀吧")
     else:
         msg = "当前正在出刀的成员：\n"
         for i in range(1, 6):
-            prog = clan.get_battle_in_progress(boss=i)
+            prog = await clan.get_battle_in_progress(boss=i)
             if prog:
                 msg += f"==={i}王===\n"
                 for pro in prog:
-                    msg += f"{clan.get_user_info(pro.member_uid).uname}"
+                    msg += f"{await clan.get_user_name(pro.member_uid)}"
                     if pro.comment and pro.comment != "":
                         msg += f" : {pro.comment}"
                     msg += "\n"
@@ -1229,24 +1436,24 @@ async def show_queue(bot: Bot, event: GroupMessageEvent, state: T_State):
 
 @clanbattle_qq.showsubscribe.handle()
 async def show_subscribe(bot: Bot, event: GroupMessageEvent, state: T_State):
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if not clan:
         await clanbattle_qq.showsubscribe.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.showsubscribe.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    subs = clan.get_battle_subscribe()
-    boss_status = clan.get_current_boss_state()
+    subs = await clan.get_battle_subscribe()
+    boss_status = await clan.get_current_boss_state()
     if not subs:
         await clanbattle_qq.showsubscribe.finish("当前没有人预约boss，赶快来出刀吧")
     else:
         msg = "当前预约的成员：\n"
         for i in range(1, 6):
-            subs = clan.get_battle_subscribe(
+            subs = await clan.get_battle_subscribe(
                 boss=i, boss_cycle=boss_status[i-1].target_cycle)
             if subs:
                 msg += f"==={i}王===\n"
                 for sub in subs:
-                    msg += f"{clan.get_user_info(sub.member_uid).uname}"
+                    msg += f"{await clan.get_user_name(sub.member_uid)}"
                     if sub.comment and sub.comment != "":
                         msg += f" : {sub.comment}"
                     msg += "\n"
@@ -1263,12 +1470,12 @@ async def query_sl(bot: Bot, event: GroupMessageEvent, state: T_State):
         uid = str(event.user_id)
     else:
         uid = state['_matched_groups'][1]
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if not clan:
         await clanbattle_qq.sl_query.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.sl_query.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    sl = clan.get_today_battle_sl(uid=uid)
+    sl = await clan.get_today_battle_sl(uid=uid)
     if sl:
         await clanbattle_qq.sl_query.finish("您今天已经sl过了")
     else:
@@ -1277,10 +1484,10 @@ async def query_sl(bot: Bot, event: GroupMessageEvent, state: T_State):
 
 @clanbattle_qq.query_on_tree.handle()
 async def query_on_tree(bot: Bot, event: GroupMessageEvent, state: T_State):
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if not clan:
         await clanbattle_qq.query_on_tree.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.query_on_tree.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     on_tree_dict = {}
     for i in range(1, 6):
@@ -1288,12 +1495,12 @@ async def query_on_tree(bot: Bot, event: GroupMessageEvent, state: T_State):
     msg = ""
     first_flag = True
     for i in range(1, 6):
-        on_tree_list = clan.get_battle_on_tree(boss=i)
+        on_tree_list = await clan.get_battle_on_tree(boss=i)
         if on_tree_list and len(on_tree_list) > 0:
             msg += f"\n==={i}王===\n" if i == 1 else f"==={i}王===\n"
             for on_tree_item in on_tree_list:
                 commemt = f"：{on_tree_item.comment}" if on_tree_item.comment and on_tree_item.comment != "" else ""
-                msg += f"{clan.get_user_name(on_tree_item.member_uid)}{commemt}（{Tools.get_chinese_timedetla(on_tree_item.record_time)}）"
+                msg += f"{await clan.get_user_name(on_tree_item.member_uid)}{commemt}（{Tools.get_chinese_timedetla(on_tree_item.record_time)}）"
                 #msg += f"当前{clan.get_user_name(on_tree_item.member_uid)}{commemt}挂在{on_tree_item.target_boss}王上"
                 msg += "\n"
     if msg == "":
@@ -1304,8 +1511,8 @@ async def query_on_tree(bot: Bot, event: GroupMessageEvent, state: T_State):
 @clanbattle_qq.reset_password.handle()
 async def reset_password(bot: Bot, event: PrivateMessageEvent, state: T_State):
     uid = str(event.user_id)
-    if user := ClanBattleData.get_user_info(uid):
-        WebAuth.set_password(uid, state['_matched_groups'][0])
+    if user := await run_in_db_thread(ClanBattleData.get_user_info, uid):
+        await run_in_db_thread(WebAuth.set_password, uid, state['_matched_groups'][0])
         await clanbattle_qq.reset_password.finish(
             f"密码已经重置为：{state['_matched_groups'][0]}，请前往网页端登录")
     else:
@@ -1315,10 +1522,10 @@ async def reset_password(bot: Bot, event: PrivateMessageEvent, state: T_State):
 @clanbattle_qq.leave_clan.handle()
 async def leave_clan(bot: Bot, event: GroupMessageEvent, state: T_State):
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
     if not clan:
         await clanbattle_qq.leave_clan.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if clan.delete_clan_member(uid):
+    if await clan.delete_clan_member(uid):
         await clanbattle_qq.leave_clan.finish("退出公会成功！")
     else:
         await clanbattle_qq.leave_clan.finish("退出公会失败，可能还没有加入公会？")
@@ -1327,17 +1534,17 @@ async def leave_clan(bot: Bot, event: GroupMessageEvent, state: T_State):
 @clanbattle_qq.refresh_clan_admin.handle()
 async def refresh_clan_admin(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data_async(gid)
     if not clan:
         await clanbattle_qq.refresh_clan_admin.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.refresh_clan_admin.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     group_member_list = await bot.get_group_member_list(group_id=event.group_id)
     admin_list = []
     for member in group_member_list:
         if member["role"] in ["owner", "admin"] and member["user_id"] != int(bot.self_id):
             admin_list.append(str(member["user_id"]))
-    clan.refresh_clan_admin(admin_list)
+    await clan.refresh_clan_admin(admin_list)
     await clanbattle_qq.refresh_clan_admin.finish("刷新管理员列表成功")
 
 
@@ -1345,15 +1552,15 @@ async def refresh_clan_admin(bot: Bot, event: GroupMessageEvent, state: T_State)
 async def rename_clan(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data_async(gid)
     if not clan:
         await clanbattle_qq.rename_clan.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.rename_clan.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(uid):
+    if not await clan.check_admin_permission(uid):
         await clanbattle_qq.rename_clan.finish("您不是会战管理员，无权使用本指令")
     else:
-        clan.rename_clan(state['_matched_groups'][0])
+        await clan.rename_clan(state['_matched_groups'][0])
         await clanbattle_qq.rename_clan.finish("修改公会名称成功")
 
 
@@ -1361,15 +1568,15 @@ async def rename_clan(bot: Bot, event: GroupMessageEvent, state: T_State):
 async def remove_clan_member(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data_async(gid)
     if not clan:
         await clanbattle_qq.remove_clan_member.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.remove_clan_member.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(uid):
+    if not await clan.check_admin_permission(uid):
         await clanbattle_qq.remove_clan_member.finish("您不是会战管理员，无权使用本指令")
     remove_uid = state['_matched_groups'][0]
-    if clan.delete_clan_member(remove_uid):
+    if await clan.delete_clan_member(remove_uid):
         await clanbattle_qq.remove_clan_member.finish("成功将该成员移出公会")
     else:
         await clanbattle_qq.remove_clan_member.finish("移出公会失败，Ta可能还未加入公会？")
@@ -1378,19 +1585,19 @@ async def remove_clan_member(bot: Bot, event: GroupMessageEvent, state: T_State)
 @clanbattle_qq.rename_clan_uname.handle()
 async def rename_clan_uname(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data_async(gid)
     if not clan:
         await clanbattle_qq.rename_clan_uname.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.rename_clan_uname.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     if not state['_matched_groups'][2]:
         uid = str(event.user_id)
     else:
-        if not clan.check_admin_permission(str(event.user_id)):
+        if not await clan.check_admin_permission(str(event.user_id)):
             await clanbattle_qq.rename_clan_uname.finish("您不是会战管理员，无权修改他人昵称")
         uid = state['_matched_groups'][2]
     uname = state['_matched_groups'][0]
-    if clan.rename_user_uname(uid, uname):
+    if await clan.rename_user_uname(uid, uname):
         await clanbattle_qq.remove_clan_member.finish("修改昵称成功")
     else:
         await clanbattle_qq.remove_clan_member.finish("修改昵称失败，可能用户还没加入任何公会？")
@@ -1400,21 +1607,49 @@ async def rename_clan_uname(bot: Bot, event: GroupMessageEvent, state: T_State):
 async def force_change_boss_status(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data_async(gid)
     challenge_boss = int(state['_matched_groups'][0])
     cycle = int(state['_matched_groups'][1])
     remain_hp = state['_matched_groups'][2]
     if not clan:
         await clanbattle_qq.rename_clan.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.rename_clan.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(uid):
+    if not await clan.check_admin_permission(uid):
         await clanbattle_qq.rename_clan.finish("您不是会战管理员，无权使用本指令")
     else:
-        clan.commit_force_change_boss_status(challenge_boss, cycle, remain_hp)
+        await clan.commit_force_change_boss_status(challenge_boss, cycle, remain_hp, uid)
         await clanbattle_qq.rename_clan.finish("强制修改boss状态成功")
 
 
+# 批量报刀每行一条记录：@成员或QQ号 [boss] 伤害或“尾刀”，国服不需要填写boss
+batch_record_pattern = re.compile(
+    r"^(?:\[CQ:at,qq=([1-9][0-9]{4,})\]|([1-9][0-9]{4,})) *(?:([1-5]) +)?(尾刀|\d+[EeKkWwBb]{0,2})$")
+
+
+@clanbattle_qq.batch_commit_record.handle()
+async def batch_commit_record(bot: Bot, event: GroupMessageEvent, state: T_State):
+    uid = str(event.user_id)
+    clan = await clanbattle.get_clan_data_async(str(event.group_id))
+    if not clan:
+        await clanbattle_qq.batch_commit_record.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
+    if not await clan.check_admin_permission(uid):
+        await clanbattle_qq.batch_commit_record.finish("您不是会战管理员，无权使用本指令")
+    records = []
+    for line in filter(None, map(str.strip, state['_matched_groups'][0].splitlines())):
+        if not (matched := batch_record_pattern.match(line)):
+            await clanbattle_qq.batch_commit_record.finish(f"第{len(records) + 1}条记录格式错误，每行格式为“@成员 boss 伤害”或“@成员 boss 尾刀”")
+        is_kill_boss = matched.group(4) == "尾刀"
+        records.append((matched.group(1) or matched.group(2), int(matched.group(3)) if matched.group(3) else None,
+                        None if is_kill_boss else matched.group(4), is_kill_boss))
+    if len(records) > max_batch_record_num:
+        await clanbattle_qq.batch_commit_record.finish(f"每次最多补报{max_batch_record_num}条出刀记录")
+    result, index = await clan.commit_records(records, uid)
+    if result != CommitRecordResult.success:
+        await clanbattle_qq.batch_commit_record.finish(f"第{index + 1}条记录：{commit_record_result_msg[result]}，本次补报的记录均未保存")
+    await clanbattle_qq.batch_commit_record.finish(await get_batch_record_summary(clan, len(records)))
+
+
 @clanbattle_qq.help.handle()
 async def send_bot_help(bot: Bot, event: MessageEvent, state: T_State):
     if isinstance(event, GroupMessageEvent) or isinstance(event, PrivateMessageEvent):
@@ -1430,20 +1665,17 @@ async def send_webview(bot: Bot, event: MessageEvent, state: T_State):
 @clanbattle_qq.join_all_member.handle()
 async def join_all_member(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data_async(gid)
     if not clan:
         await clanbattle_qq.join_all_member.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.join_all_member.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(str(event.user_id)):
+    if not await clan.check_admin_permission(str(event.user_id)):
         await clanbattle_qq.join_all_member.finish("您不是会战管理员，无权加入全部成员")
     group_member_list = await bot.get_group_member_list(group_id=event.group_id)
-    for member in group_member_list:
-        if member["user_id"] != int(bot.self_id):
-            if not clan.check_joined_clan(str(member["user_id"])):
-                clan.add_clan_member(str(
-                    member["user_id"]), member["card"] if member["card"] != "" else member["nickname"])
-    await clanbattle_qq.join_all_member.finish("加入全部成员成功")
+    joined_num = await clan.add_clan_members([(str(member["user_id"]), member["card"] if member["card"] != "" else member["nickname"])
+                                              for member in group_member_list if member["user_id"] != int(bot.self_id)])
+    await clanbattle_qq.join_all_member.finish(f"加入全部成员成功，新加入{joined_num}人")
 
 
 @clanbattle_qq.switch_current_clanbattle_data.handle()
@@ -1451,16 +1683,16 @@ async def switch_current_clanbattle_data(bot: Bot, event: GroupMessageEvent, sta
     gid = str(event.group_id)
     uid = str(event.user_id)
     set_num = int(state['_matched_groups'][0])
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data_async(gid)
     if not clan:
         await clanbattle_qq.switch_current_clanbattle_data.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.switch_current_clanbattle_data.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(uid):
+    if not await clan.check_admin_permission(uid):
         await clanbattle_qq.switch_current_clanbattle_data.finish("您不是会战管理员，无权使用本指令")
     if set_num < 1 or set_num > 10:
         await clanbattle_qq.switch_current_clanbattle_data.finish("会战档案超出允许的范围，请考虑清空旧的会战档案")
-    clan.set_current_clanbattle_data(set_num)
+    await clan.set_current_clanbattle_data(set_num)
     await clanbattle_qq.switch_current_clanbattle_data.finish(f"切换会战档案成功，当前使用会战档案{set_num}")
 
 
@@ -1468,15 +1700,15 @@ async def switch_current_clanbattle_data(bot: Bot, event: GroupMessageEvent, sta
 async def clear_current_clanbattle_data(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data_async(gid)
     if not clan:
         await clanbattle_qq.clear_current_clanbattle_data.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.clear_current_clanbattle_data.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(uid):
+    if not await clan.check_admin_permission(uid):
         await clanbattle_qq.clear_current_clanbattle_data.finish("您不是会战管理员，无权使用本指令")
-    clan.clear_current_clanbattle_data()
-    await clanbattle_qq.clear_current_clanbattle_data.finish(f"清空会战档案成功！")
+    deleted = await clan.clear_current_clanbattle_data()
+    await clanbattle_qq.clear_current_clanbattle_data.finish(f"清空会战档案成功！\n{format_deleted_count(deleted)}")
 
 
 @clanbattle_qq.add_clanbattle_admin.handle()
@@ -1484,60 +1716,58 @@ async def add_clanbattle_admin(bot: Bot, event: GroupMessageEvent, state: T_Stat
     gid = str(event.group_id)
     uid = str(event.user_id)
     new_admin_uid = state['_matched_groups'][1]
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data_async(gid)
     if not clan:
         await clanbattle_qq.add_clanbattle_admin.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.add_clanbattle_admin.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(uid):
+    if not await clan.check_admin_permission(uid):
         await clanbattle_qq.add_clanbattle_admin.finish("您不是会战管理员，无权使用本指令")
-    admin_list = clan.get_db_strlist_list(clan.clan_info.clan_admin)
-    admin_list.append(new_admin_uid)
-    clan.refresh_clan_admin(admin_list)
+    await clan.add_clan_admin(new_admin_uid)
 
 
 @clanbattle_qq.delete_clan.handle()
 async def delete_clan(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data_async(gid)
     if not clan:
         await clanbattle_qq.delete_clan.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.delete_clan.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(uid):
+    if not await clan.check_admin_permission(uid):
         await clanbattle_qq.delete_clan.finish("您不是会战管理员，无权使用本指令")
-    clanbattle.delete_clan(gid)
-    await clanbattle_qq.delete_clan.finish("清除公会数据成功")
+    deleted = await run_in_db_thread(clanbattle.delete_clan, gid)
+    await clanbattle_qq.delete_clan.finish(f"清除公会数据成功\n{format_deleted_count(deleted)}")
 
 
 @clanbattle_qq.query_certain_num.handle()
 async def query_certain_num(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data_async(gid)
     if not clan:
         await clanbattle_qq.query_certain_num.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.query_certain_num.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     query_num = int(state['_matched_groups'][1]
                     ) if state['_matched_groups'][1] else None
     query_remain = True if state['_matched_groups'][2] else False
     if query_num != None:
         msg = f"今日已出{query_num}刀的有：\n"
-        status = clan.get_today_member_status()
+        status = await clan.get_today_member_status()
         for member_state in status:
             if member_state.today_challenged == query_num:
-                msg += f"{clan.get_user_name(member_state.uid)}、"
+                msg += f"{await clan.get_user_name(member_state.uid)}、"
         if msg == f"今日已出{query_num}刀的有：\n":
             msg = f"今天还没有人已经出了{query_num}刀"
         await clanbattle_qq.query_certain_num.finish(msg.strip('、'))
     if query_remain:
         msg = f"还没有出补偿刀的有：\n"
-        status = clan.get_today_member_status()
+        status = await clan.get_today_member_status()
         for member_state in status:
             if member_state.remain_addition_challeng > 0:
-                msg += f"{clan.get_user_name(member_state.uid)}、"
+                msg += f"{await clan.get_user_name(member_state.uid)}、"
         if msg == f"还没有出补偿刀的有：\n":
             msg = f"现在没有剩余的补偿刀！"
         await clanbattle_qq.query_certain_num.finish(msg.strip('、'))
@@ -1547,25 +1777,65 @@ async def query_certain_num(bot: Bot, event: GroupMessageEvent, state: T_State):
 async def notice_not_report(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data_async(gid)
     if not clan:
         await clanbattle_qq.notice_not_report.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.notice_not_report.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(uid):
+    if not await clan.check_admin_permission(uid):
         await clanbattle_qq.notice_not_report.finish("您不是会战管理员，无权使用本指令")
     notice_num = int(state['_matched_groups'][0]
                      ) if state['_matched_groups'][0] else 0
-    status = clan.get_today_member_status()
+    status = await clan.get_today_member_status()
     notice_list = []
     for member_state in status:
         if member_state.today_challenged <= notice_num:
             notice_list.append(member_state.uid)
-    notice_message = Message("管理员催你快去出刀啦")
-    for member in notice_list:
-        notice_message += MessageSegment.at(member)
-        if len(notice_message) == 20:
-            await bot.send_group_msg(group_id=gid, message=notice_message)
-            notice_message = Message("管理员催你快去出刀啦")
-    if len(notice_message) > 1:
-        await bot.send_group_msg(group_id=gid, message=notice_message)
+    message_dispatcher.mention(gid, "管理员催你快去出刀啦", notice_list)
+
+
+# 会战统计中显示的伤害最高的成员数量
+statistics_top_member_num = 5
+
+
+@clanbattle_qq.clan_statistics.handle()
+async def clan_statistics(bot: Bot, event: GroupMessageEvent, state: T_State):
+    gid = str(event.group_id)
+    clan = await clanbattle.get_clan_data_async(gid)
+    if not clan:
+        await clanbattle_qq.clan_statistics.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
+    if not await clan.check_joined_clan(str(event.user_id)):
+        await clanbattle_qq.clan_statistics.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
+    try:
+        statistics = await clan.get_clan_statistics()
+    except ClanBattleException as e:
+        await clanbattle_qq.clan_statistics.finish(str(e))
+    total = statistics["total"]
+    if not total:
+        await clanbattle_qq.clan_statistics.finish("当前会战档案还没有出刀记录")
+    msg = f"当前会战档案共出刀{total['count']}刀（完整刀{total['full_challenge']}刀，补偿刀{total['addition_challenge']}刀）\n"
+    msg += f"总伤害{Tools.get_num_str_with_dot(total['total_damage'])}，击败boss{total['kills']}次，共{len(statistics['days'])}天\n"
+    msg += "==============\n各boss伤害："
+    for boss, boss_statistics in sorted(statistics["bosses"].items()):
+        msg += f"\n{boss}王：{boss_statistics['count']}刀，平均{Tools.get_num_str_with_dot(round(boss_statistics['average_damage']))}"
+        msg += f"，中位数{Tools.get_num_str_with_dot(round(boss_statistics['damage_percentiles']['p50']))}"
+    msg += "\n==============\n总伤害最高的成员："
+    top_members = sorted(statistics["members"].items(), key=lambda item: item[1]["total_damage"], reverse=True)
+    for i, (member_uid, member_statistics) in enumerate(top_members[:statistics_top_member_num]):
+        msg += f"\n{i+1}. {await clan.get_user_name(member_uid)}：{Tools.get_num_str_with_dot(member_statistics['total_damage'])}"
+        msg += f"（{member_statistics['count']}刀，击败boss{member_statistics['kills']}次）"
+    await clanbattle_qq.clan_statistics.finish(msg)
+
+
+@clanbattle_qq.reload_clan.handle()
+async def reload_clan(bot: Bot, event: GroupMessageEvent, state: T_State):
+    # 通过导入工具或直接修改数据库改动公会数据后，重新从数据库读取公会信息和boss状态
+    uid = str(event.user_id)
+    gid = str(event.group_id)
+    clan = await clanbattle.get_clan_data_async(gid)
+    if not clan:
+        await clanbattle_qq.reload_clan.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
+    if not await clan.check_admin_permission(uid):
+        await clanbattle_qq.reload_clan.finish("您不是会战管理员，无权使用本指令")
+    await run_in_db_thread(clanbattle.reload_clan, gid, True)
+    await clanbattle_qq.reload_clan.finish("已重新加载公会数据")
@@ -0,0 +1,176 @@
+import re
+import inspect
+from typing import Callable, Dict, List, Optional, Set, Tuple, Type
+
+try:
+    import re._parser as sre_parse
+    import re._constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+from nonebot.adapters import Bot, Event
+from nonebot.exception import FinishedException
+from nonebot.log import logger
+from nonebot.matcher import Matcher
+from nonebot.plugin import on_message
+from nonebot.typing import T_State
+
+
+def get_first_chars(items) -> Tuple[Optional[Set[str]], bool]:
+    # 返回 (可能的首字符集合, 是否可以匹配空串)，无法确定时集合为 None
+    chars = set()
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            item_chars, nullable = {chr(av)}, False
+        elif op == sre_constants.IN:
+            item_chars, nullable = set(), False
+            for in_op, in_av in av:
+                if in_op == sre_constants.LITERAL:
+                    item_chars.add(chr(in_av))
+                elif in_op == sre_constants.RANGE and in_av[1] - in_av[0] < 64:
+                    item_chars.update(map(chr, range(in_av[0], in_av[1] + 1)))
+                else:
+                    return None, False
+        elif op == sre_constants.BRANCH:
+            item_chars, nullable = set(), False
+            for branch in av[1]:
+                branch_chars, branch_nullable = get_first_chars(branch)
+                if branch_chars is None:
+                    return None, False
+                item_chars |= branch_chars
+                nullable = nullable or branch_nullable
+        elif op == sre_constants.SUBPATTERN:
+            item_chars, nullable = get_first_chars(av[3])
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            item_chars, nullable = get_first_chars(av[2])
+            nullable = nullable or av[0] == 0
+        elif op == sre_constants.AT:
+            item_chars, nullable = set(), True
+        else:
+            return None, False
+        if item_chars is None:
+            return None, False
+        chars |= item_chars
+        if not nullable:
+            return chars, False
+    return chars, True
+
+
+def is_anchored(items) -> bool:
+    if not items:
+        return False
+    op, av = items[0]
+    if op == sre_constants.AT:
+        return av == sre_constants.AT_BEGINNING
+    if op == sre_constants.BRANCH:
+        return all(is_anchored(branch) for branch in av[1])
+    if op == sre_constants.SUBPATTERN:
+        return is_anchored(av[3])
+    return False
+
+
+def get_command_first_chars(regex: str) -> Optional[Set[str]]:
+    # 以 ^ 开头且首字符可确定的正则才能按首字符预筛选
+    try:
+        items = list(sre_parse.parse(regex))
+    except Exception:
+        return None
+    if not is_anchored(items):
+        return None
+    chars, nullable = get_first_chars(items)
+    if chars is None or nullable:
+        return None
+    return chars
+
+
+class RegexCommand:
+    # 与 on_regex 返回的事件响应器用法相同，实际由 CommandDispatcher 统一匹配和调用
+
+    def __init__(self, dispatcher: "CommandDispatcher", regex: str, block: bool) -> None:
+        self.dispatcher = dispatcher
+        self.regex = regex
+        self.pattern = re.compile(regex)
+        self.block = block
+        self.handlers: List[Tuple[Callable, Optional[Type[Event]]]] = []
+
+    def handle(self):
+        def decorator(func: Callable):
+            event_type = inspect.signature(func).parameters["event"].annotation
+            if event_type is inspect.Parameter.empty:
+                event_type = None
+            self.handlers.append((func, event_type))
+            return func
+
+        return decorator
+
+    async def send(self, message, **kwargs):
+        return await self.dispatcher.matcher.send(message, **kwargs)
+
+    async def finish(self, message=None, **kwargs):
+        await self.dispatcher.matcher.finish(message, **kwargs)
+
+    async def run(self, bot: Bot, event: Event, state: T_State, matched: re.Match):
+        state = dict(state)
+        state["_matched"] = matched.group()
+        state["_matched_groups"] = matched.groups()
+        state["_matched_dict"] = matched.groupdict()
+        for handler, event_type in self.handlers:
+            if event_type and not isinstance(event, event_type):
+                continue
+            try:
+                await handler(bot, event, state)
+            except FinishedException:
+                return
+            except Exception:
+                logger.exception(f"处理指令 {self.regex} 时出现错误")
+                return
+
+
+class CommandDispatcher:
+    # 所有指令共用一个消息响应器，先按消息首字符筛选候选指令，再对候选指令执行完整的正则匹配
+
+    def __init__(self, priority: int = 1) -> None:
+        self.commands: List[RegexCommand] = []
+        self.first_char_index: Dict[str, List[RegexCommand]] = {}
+        self.unindexed_commands: List[RegexCommand] = []
+        self.matcher: Type[Matcher] = on_message(rule=self.check, priority=priority, block=False)
+        self.matcher.handle()(self.dispatch)
+
+    def on_regex(self, regex: str, block: bool = True) -> RegexCommand:
+        command = RegexCommand(self, regex, block)
+        self.commands.append(command)
+        if (chars := get_command_first_chars(regex)) is None:
+            self.unindexed_commands.append(command)
+        else:
+            for char in chars:
+                self.first_char_index.setdefault(char, []).append(command)
+        return command
+
+    def match(self, text: str) -> List[Tuple[RegexCommand, re.Match]]:
+        candidates = set(self.unindexed_commands)
+        if text:
+            candidates.update(self.first_char_index.get(text[0], ()))
+        ret_list = []
+        # 按注册顺序执行
+        for command in self.commands:
+            if command in candidates and (matched := command.pattern.search(text)):
+                ret_list.append((command, matched))
+        return ret_list
+
+    async def check(self, event: Event, state: T_State) -> bool:
+        try:
+            text = str(event.get_message())
+        except Exception:
+            return False
+        if matched_commands := self.match(text):
+            state["_clanbattle_commands"] = matched_commands
+            return True
+        return False
+
+    async def dispatch(self, bot: Bot, event: Event, state: T_State, matcher: Matcher):
+        matched_commands = state["_clanbattle_commands"]
+        if any(command.block for command, _ in matched_commands):
+            matcher.stop_propagation()
+        for command, matched in matched_commands:
+            await command.run(bot, event, state, matched)
@@ -3,12 +3,38 @@ import json
 import pydantic
 
 
+class DatabaseConfig(pydantic.BaseModel):
+    backend: str = "sqlite"  # sqlite, postgresql 或 mysql
+    name: str = None  # 数据库名，sqlite 时为数据库文件路径，默认使用插件目录下的 clanbattle.db
+    host: str = "localhost"
+    port: int = None
+    user: str = None
+    password: str = None
+    max_connections: int = 10
+    timeout: float = 10  # 等待连接池空闲连接的秒数
+    stale_timeout: int = 300  # 空闲连接超过该秒数后重新连接
+
+
 class ConfigClass(pydantic.BaseModel):
     web_url: str
     disable_private_message: bool
     enable_anti_msg_fail: bool
     db_salt: str
     boss_info: dict
+    db_worker_num: int = 4
+    web_session_cache_ttl: int = 60
+    send_msg_global_rate: float = 5
+    send_msg_group_rate: float = 2
+    send_msg_burst: int = 3
+    send_msg_retry_times: int = 3
+    sqlite_pragmas: dict = {}
+    db_maintenance_interval: int = 3600
+    database: DatabaseConfig = DatabaseConfig()
+    shared_cache_url: str = None  # 例如 redis://localhost:6379/2，多个机器人进程共用同一数据库时设置
+    shared_cache_ttl: int = 300
+    clan_data_cache_size: int = 256
+    clan_data_idle_timeout: int = 21600
+    boss_state_snapshot_interval: int = 50
 
 
 clanbattle_config: "ConfigClass" = None
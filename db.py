@@ -1,8 +1,12 @@
 #import redis
 import sys
+import datetime
 
 from os import path
 from peewee import *
+from playhouse.pool import PooledSqliteDatabase, PooledPostgresqlDatabase, PooledMySQLDatabase
+
+from .config import get_config, DatabaseConfig
 
 
 redis_db = 2
@@ -16,13 +20,52 @@ else:
     db_path = path.join(path.dirname(__file__),
                         "clanbattle_test.db").replace(":\\", ":\\\\")
 
-sqlite_db = SqliteDatabase(db_path)
+# 默认使用 WAL 模式，读写可以并发进行；可在配置文件 sqlite_pragmas 中覆盖
+default_pragmas = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "cache_size": -16 * 1024,  # 单位为 KiB
+    "mmap_size": 64 * 1024 * 1024,
+    "busy_timeout": 5000,
+}
+
+
+def get_pragmas() -> dict:
+    pragmas = dict(default_pragmas)
+    pragmas.update(get_config().sqlite_pragmas)
+    return pragmas
+
+
+def create_database(db_config: DatabaseConfig) -> Database:
+    # 每个线程从连接池取得自己的连接，数据库线程池中的任务执行完毕后归还
+    if db_config.backend == "sqlite":
+        return PooledSqliteDatabase(db_config.name or db_path, pragmas=get_pragmas(), max_connections=db_config.max_connections,
+                                    stale_timeout=db_config.stale_timeout, timeout=db_config.timeout, check_same_thread=False)
+    if db_config.backend == "postgresql":
+        database_class = PooledPostgresqlDatabase
+    elif db_config.backend == "mysql":
+        database_class = PooledMySQLDatabase
+    else:
+        raise ValueError(f"不支持的数据库类型：{db_config.backend}")
+    connect_params = {"host": db_config.host, "user": db_config.user, "password": db_config.password}
+    if db_config.port:
+        connect_params["port"] = db_config.port
+    return database_class(db_config.name, max_connections=db_config.max_connections, stale_timeout=db_config.stale_timeout,
+                          timeout=db_config.timeout, **connect_params)
+
+
+def is_sqlite(database: Database = None) -> bool:
+    database = database or clanbattle_db.obj
+    return isinstance(database, SqliteDatabase)
+
+
+clanbattle_db = DatabaseProxy()
 #db = SqliteDatabase(r"d:\\Code\nb2_pcr_clanbattle_bot\plugins\clanbattle\clanbattle.db")
 
 
 class BaseModel(Model):
     class Meta:
-        database = sqlite_db
+        database = clanbattle_db
 
 
 class User(BaseModel):
@@ -30,8 +73,8 @@ class User(BaseModel):
     tg_uid = CharField(unique=True, null=True)
     uname = CharField(null=True)
     password = CharField(null=True)
-    clan_joined = TextField(null=True)  # list,split by |
-    web_session = CharField(null=True)
+    clan_joined = TextField(null=True)  # 已迁移至 ClanMembership，写入成员时同步更新，供回退旧版本使用
+    web_session = CharField(null=True, index=True)
     is_super_admin = BooleanField(default=False)
 
     class Meta:
@@ -43,8 +86,8 @@ class ClanInfo(BaseModel):
     clan_name = CharField()
     clan_type = CharField()  # cn为国，tw为台，jp为日
     clan_api_key = CharField(unique=True, null=True)
-    clan_admin = TextField()  # list,split by |
-    clan_members = TextField(null=True)  # list,split by |
+    clan_admin = TextField()  # 已迁移至 ClanMembership，写入成员时同步更新，供回退旧版本使用
+    clan_members = TextField(null=True)  # 已迁移至 ClanMembership，写入成员时同步更新，供回退旧版本使用
     create_time = DateTimeField()
     current_using_data_num = IntegerField(default=1)
     #current_cycle = IntegerField()
@@ -72,6 +115,11 @@ class BattleRecord(BaseModel):
 
     class Meta:
         table_name = "battle_record"
+        indexes = (
+            (("clan_gid", "using_data_num", "target_boss", "record_time"), False),
+            (("clan_gid", "using_data_num", "member_uid", "record_time"), False),
+            (("clan_gid", "using_data_num", "record_time"), False),
+        )
 
 
 class BattleSubscribe(BaseModel):
@@ -85,6 +133,10 @@ class BattleSubscribe(BaseModel):
 
     class Meta:
         table_name = "battle_subscribe"
+        indexes = (
+            (("clan_gid", "using_data_num", "target_boss", "target_cycle"), False),
+            (("clan_gid", "using_data_num", "member_uid"), False),
+        )
 
 
 class BattleOnTree(BaseModel):
@@ -98,6 +150,10 @@ class BattleOnTree(BaseModel):
 
     class Meta:
         table_name = "battle_on_tree"
+        indexes = (
+            (("clan_gid", "using_data_num", "target_boss"), False),
+            (("clan_gid", "using_data_num", "member_uid"), False),
+        )
 
 
 class BattleInProgress(BaseModel):
@@ -111,6 +167,10 @@ class BattleInProgress(BaseModel):
 
     class Meta:
         table_name = "battle_in_progress"
+        indexes = (
+            (("clan_gid", "using_data_num", "target_boss"), False),
+            (("clan_gid", "using_data_num", "member_uid"), False),
+        )
 
 
 class BattleSL(BaseModel):
@@ -125,8 +185,316 @@ class BattleSL(BaseModel):
 
     class Meta:
         table_name = "battle_sl"
+        indexes = (
+            (("clan_gid", "using_data_num", "member_uid", "record_time"), False),
+            (("clan_gid", "using_data_num", "record_time"), False),
+        )
+
+
+class ClanMembership(BaseModel):
+    clan_gid = CharField()
+    member_uid = CharField()
+    role = CharField()  # member为公会成员，admin为会战管理员
+
+    class Meta:
+        table_name = "clan_membership"
+        indexes = (
+            (("clan_gid", "role", "member_uid"), True),
+            (("member_uid", "role"), False),
+        )
+
+
+class BattleEvent(BaseModel):
+    # 只追加不修改的会战事件记录
+    clan_gid = CharField()
+    using_data_num = IntegerField()
+    event_type = CharField()  # report、kill、undo、force_change、sl、on_tree、off_tree、queue、unqueue、subscribe、unsubscribe
+    member_uid = CharField(null=True)
+    operator_uid = CharField(null=True)
+    target_cycle = IntegerField(null=True)
+    target_boss = IntegerField(null=True)
+    record_id = IntegerField(null=True)
+    boss_state = TextField(null=True)  # 事件之后目标boss的状态（JSON），不改变boss状态的事件为空
+    comment = TextField(null=True)
+    event_time = DateTimeField()
+
+    class Meta:
+        table_name = "battle_event"
+        indexes = (
+            (("clan_gid", "using_data_num", "id"), False),
+            (("clan_gid", "using_data_num", "record_id"), False),
+        )
+
+
+class BossStateSnapshot(BaseModel):
+    clan_gid = CharField()
+    using_data_num = IntegerField()
+    last_event_id = IntegerField()  # 快照包含的最后一个事件
+    boss_state = TextField()  # 各boss的状态（JSON）
+    snapshot_time = DateTimeField()
+
+    class Meta:
+        table_name = "boss_state_snapshot"
+        indexes = (
+            (("clan_gid", "using_data_num", "last_event_id"), False),
+        )
+
+
+class DailyMemberSummary(BaseModel):
+    # 每个会战日每名成员的出刀统计，随出刀记录和SL记录同步更新
+    clan_gid = CharField()
+    using_data_num = IntegerField()
+    battle_date = DateField()
+    member_uid = CharField()
+    total_challenge = IntegerField(default=0)  # 完整刀
+    addition_challenge = IntegerField(default=0)  # 补偿刀
+    remain_addition_challenge = IntegerField(default=0)  # 剩余补偿刀
+    total_damage = BigIntegerField(default=0)
+    last_is_extra_time = BooleanField(default=False)
+    last_record_id = IntegerField(null=True)
+    use_sl = BooleanField(default=False)
+
+    class Meta:
+        table_name = "daily_member_summary"
+        indexes = (
+            (("clan_gid", "using_data_num", "battle_date", "member_uid"), True),
+        )
+
+
+all_models = [User, ClanInfo, BattleRecord,
+              BattleSubscribe, BattleOnTree, BattleInProgress, BattleSL, ClanMembership,
+              BattleEvent, BossStateSnapshot, DailyMemberSummary]
 
 
-sqlite_db.connect()
-sqlite_db.create_tables([User, ClanInfo, BattleRecord,
-                         BattleSubscribe, BattleOnTree, BattleInProgress, BattleSL])
+def get_battle_day_offset(clan_type: str) -> datetime.timedelta:
+    # 会战日从当地时间5点开始，日服为 UTC+9，其它为 UTC+8；UTC 时间加上该偏移后的日期即为会战日
+    return datetime.timedelta(hours=9 if clan_type == "jp" else 8) - datetime.timedelta(hours=5)
+
+
+def get_battle_date(record_time: datetime.datetime, clan_type: str) -> datetime.date:
+    return (record_time + get_battle_day_offset(clan_type)).date()
+
+
+def get_battle_day_datetime(battle_date: datetime.date, clan_type: str) -> tuple:
+    # 返回会战日的起止时间（UTC）
+    start_time = datetime.datetime.combine(battle_date, datetime.time()) - get_battle_day_offset(clan_type)
+    return (start_time, start_time + datetime.timedelta(days=1))
+
+
+def rebuild_daily_summary(clan_gid: str = None, using_data_num: int = None, member_uid: str = None, battle_date: datetime.date = None) -> int:
+    # 由出刀记录和SL记录重新生成每日出刀统计，可只重建指定的公会、档案、成员或会战日，返回生成的行数
+    clans = ClanInfo.select(ClanInfo.clan_gid, ClanInfo.clan_type)
+    if clan_gid:
+        clans = clans.where(ClanInfo.clan_gid == clan_gid)
+    rebuilt = 0
+    for clan in clans:
+        def where(model):
+            condition = model.clan_gid == clan.clan_gid
+            if using_data_num is not None:
+                condition &= model.using_data_num == using_data_num
+            if member_uid:
+                condition &= model.member_uid == member_uid
+            if battle_date:
+                if model is DailyMemberSummary:
+                    condition &= model.battle_date == battle_date
+                else:
+                    start_time, end_time = get_battle_day_datetime(battle_date, clan.clan_type)
+                    condition &= (model.record_time > start_time) & (model.record_time < end_time)
+            return condition
+
+        rows = {}
+
+        def get_row(item) -> dict:
+            day = get_battle_date(item.record_time, clan.clan_type)
+            key = (item.using_data_num, day, item.member_uid)
+            if key not in rows:
+                rows[key] = {"clan_gid": clan.clan_gid, "using_data_num": item.using_data_num, "battle_date": day,
+                             "member_uid": item.member_uid, "total_challenge": 0, "addition_challenge": 0,
+                             "remain_addition_challenge": 0, "total_damage": 0, "last_is_extra_time": False,
+                             "last_record_id": None, "use_sl": False}
+            return rows[key]
+
+        records = BattleRecord.select(BattleRecord.id, BattleRecord.using_data_num, BattleRecord.member_uid, BattleRecord.record_time,
+                                      BattleRecord.damage, BattleRecord.is_extra_time, BattleRecord.remain_next_chance)
+        for record in records.where(where(BattleRecord)).order_by(BattleRecord.id).iterator():
+            row = get_row(record)
+            if record.is_extra_time:
+                row["addition_challenge"] += 1
+                row["remain_addition_challenge"] -= 1
+            else:
+                row["total_challenge"] += 1
+            if record.remain_next_chance:
+                row["remain_addition_challenge"] += 1
+            row["total_damage"] += record.damage
+            row["last_is_extra_time"] = record.is_extra_time
+            row["last_record_id"] = record.id
+        sls = BattleSL.select(BattleSL.using_data_num, BattleSL.member_uid, BattleSL.record_time)
+        for sl in sls.where(where(BattleSL)).iterator():
+            get_row(sl)["use_sl"] = True
+        with clanbattle_db.atomic():
+            DailyMemberSummary.delete().where(where(DailyMemberSummary)).execute()
+            for batch in chunked(list(rows.values()), 100):
+                DailyMemberSummary.insert_many(batch).execute()
+        rebuilt += len(rows)
+    return rebuilt
+
+
+def split_strlist(text_field: str) -> list:
+    return [item for item in str(text_field).split("|") if item] if text_field else []
+
+
+def sync_legacy_membership(gid: str, uid_list: list = ()):
+    # 旧字段移除前，ClanMembership 变化后同时更新公会和成员的旧版 | 分隔字段，回退到旧版本时不会丢失成员变更
+    roles = {"member": [], "admin": []}
+    for uid, role in (ClanMembership.select(ClanMembership.member_uid, ClanMembership.role)
+                      .where(ClanMembership.clan_gid == gid).order_by(ClanMembership.id).tuples()):
+        roles[role].append(uid)
+    ClanInfo.update(clan_members="|".join(roles["member"]) or None, clan_admin="|".join(roles["admin"])).where(
+        ClanInfo.clan_gid == gid).execute()
+    uid_list = list(dict.fromkeys(uid_list))
+    for i in range(0, len(uid_list), 100):
+        joined = {uid: [] for uid in uid_list[i:i+100]}
+        for clan_gid, uid in (ClanMembership.select(ClanMembership.clan_gid, ClanMembership.member_uid)
+                              .where(ClanMembership.member_uid.in_(list(joined)) & (ClanMembership.role == "member"))
+                              .order_by(ClanMembership.id).tuples()):
+            joined[uid].append(clan_gid)
+        for uid, gids in joined.items():
+            User.update(clan_joined="|".join(gids) or None).where(User.qq_uid == uid).execute()
+
+
+def has_legacy_membership() -> bool:
+    return (ClanInfo.select().where(ClanInfo.clan_members.is_null(False) | (ClanInfo.clan_admin != "")).exists()
+            or User.select().where(User.clan_joined.is_null(False)).exists())
+
+
+def migrate_clan_membership():
+    # 按旧版以 | 分隔保存的成员、管理员和已加入公会列表同步 ClanMembership，返回新增和删除的行数
+    # 旧字段与 ClanMembership 保持一致时不做修改；回退到旧版本后修改过的成员在再次升级时同步回来
+    rows = []
+    for clan in ClanInfo.select():
+        for uid in split_strlist(clan.clan_members):
+            rows.append((clan.clan_gid, uid, "member"))
+        for uid in split_strlist(clan.clan_admin):
+            rows.append((clan.clan_gid, uid, "admin"))
+    exist_clans = set(clan.clan_gid for clan in ClanInfo.select(ClanInfo.clan_gid))
+    for user in User.select().where(User.clan_joined.is_null(False)):
+        for gid in split_strlist(user.clan_joined):
+            if gid in exist_clans:
+                rows.append((gid, user.qq_uid, "member"))
+    rows = list(dict.fromkeys(rows))
+    exist_rows = set(ClanMembership.select(ClanMembership.clan_gid, ClanMembership.member_uid, ClanMembership.role).tuples())
+    new_rows = [row for row in rows if row not in exist_rows]
+    removed_rows = exist_rows - set(rows)
+    with clanbattle_db.atomic():
+        for i in range(0, len(new_rows), 100):
+            ClanMembership.insert_many(new_rows[i:i+100], fields=[
+                ClanMembership.clan_gid, ClanMembership.member_uid, ClanMembership.role]).on_conflict_ignore().execute()
+        for gid, uid, role in removed_rows:
+            ClanMembership.delete().where((ClanMembership.clan_gid == gid) & (ClanMembership.member_uid == uid)
+                                          & (ClanMembership.role == role)).execute()
+    return len(new_rows) + len(removed_rows)
+
+
+def migrate_db():
+    # 创建缺失的表和索引，旧数据库升级后会补建索引并更新查询统计信息
+    exist_indexes = set()
+    exist_tables = clanbattle_db.get_tables()
+    for table in exist_tables:
+        exist_indexes.update(index.name for index in clanbattle_db.get_indexes(table))
+    with clanbattle_db.atomic():
+        clanbattle_db.create_tables(all_models)
+    if exist_tables and has_legacy_membership():
+        migrate_clan_membership()
+    if exist_tables and DailyMemberSummary._meta.table_name not in exist_tables:
+        rebuild_daily_summary()
+    new_indexes = []
+    for model in all_models:
+        for index in model._meta.fields_to_index():
+            if index._name not in exist_indexes:
+                new_indexes.append(index._name)
+    if exist_indexes and new_indexes and not isinstance(clanbattle_db.obj, MySQLDatabase):
+        clanbattle_db.execute_sql("ANALYZE")
+    return new_indexes
+
+
+def run_with_connection(func, *args, **kwargs):
+    with clanbattle_db.connection_context():
+        return func(*args, **kwargs)
+
+
+def write_transaction(clan_gid: str):
+    # SQLite 直接获取写锁；其它数据库锁定公会信息行，使多个机器人进程对同一公会的写入串行执行
+    if is_sqlite():
+        return clanbattle_db.atomic("IMMEDIATE")
+    return ClanLockedTransaction(clan_gid)
+
+
+class ClanLockedTransaction:
+
+    def __init__(self, clan_gid: str) -> None:
+        self.clan_gid = clan_gid
+        self.transaction = None
+
+    def __enter__(self):
+        self.transaction = clanbattle_db.atomic()
+        self.transaction.__enter__()
+        list(ClanInfo.select(ClanInfo.id).where(ClanInfo.clan_gid == self.clan_gid).for_update())
+        return self.transaction
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return self.transaction.__exit__(exc_type, exc_val, exc_tb)
+
+
+def copy_database(source: Database, target: Database, batch_size: int = 500) -> dict:
+    # 将 source 中的全部数据按主键顺序分批复制到 target，target 中对应的表必须为空
+    copied = {}
+    for model in all_models:
+        if not source.table_exists(model._meta.table_name):
+            raise ValueError(f"源数据库缺少 {model._meta.table_name} 表，请先使用当前版本启动一次机器人完成升级")
+    with target.bind_ctx(all_models):
+        target.create_tables(all_models)
+        for model in all_models:
+            if model.select().exists():
+                raise ValueError(f"目标数据库的 {model._meta.table_name} 表不为空")
+    for model in all_models:
+        last_id = 0
+        copied[model._meta.table_name] = 0
+        while True:
+            with source.bind_ctx([model]):
+                rows = list(model.select().where(model.id > last_id).order_by(model.id).limit(batch_size).dicts())
+            if not rows:
+                break
+            with target.bind_ctx([model]), target.atomic():
+                model.insert_many(rows).execute()
+            last_id = rows[-1]["id"]
+            copied[model._meta.table_name] += len(rows)
+        if isinstance(target, PostgresqlDatabase) and last_id:
+            # 复制时指定了主键，需要同步自增序列
+            with target.bind_ctx([model]):
+                target.execute_sql("SELECT setval(pg_get_serial_sequence(%s, 'id'), %s)",
+                                   (model._meta.table_name, last_id))
+    return copied
+
+
+def run_maintenance():
+    # 定期将 WAL 文件写回数据库并更新查询统计信息
+    if not is_sqlite():
+        return
+    with clanbattle_db.connection_context():
+        clanbattle_db.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        clanbattle_db.execute_sql("PRAGMA optimize")
+
+
+def close_db():
+    clanbattle_db.close_all()
+
+
+if not "pytest" in sys.modules:
+    clanbattle_db.initialize(create_database(get_config().database))
+else:
+    # 测试时始终使用本地 SQLite 数据库
+    clanbattle_db.initialize(create_database(DatabaseConfig()))
+clanbattle_db.connect()
+migrate_db()
+clanbattle_db.close()
+
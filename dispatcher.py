@@ -0,0 +1,173 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Iterable, List, Optional
+
+import nonebot
+from nonebot.adapters.onebot.v11 import Message, MessageSegment
+from nonebot.log import logger
+
+from .config import get_config
+
+
+# 单条消息中最多包含的@数量，超出部分拆分为多条发送
+max_mention_per_message = 19
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        self.refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class OutboundMessage:
+
+    def __init__(self, gid: str, message: Message = None, mention_text: str = None, mentions: List[str] = None) -> None:
+        self.gid = gid
+        self.message = message
+        # 带@的提醒消息以提醒文本区分，发送前相同提醒的@会合并到一起
+        self.mention_text = mention_text
+        self.mentions = mentions
+        self.retry_times = 0
+
+    def build(self) -> Message:
+        if self.mention_text is None:
+            return self.message
+        return Message(self.mention_text) + Message(map(MessageSegment.at, self.mentions))
+
+
+class MessageDispatcher:
+    # 群消息统一排队发送，按群和全局令牌桶限速，发送失败时重试
+
+    def __init__(self) -> None:
+        self.queues: "OrderedDict[str, Deque[OutboundMessage]]" = OrderedDict()
+        self.group_buckets: Dict[str, TokenBucket] = {}
+        self.global_bucket: TokenBucket = None
+        self.wakeup: asyncio.Event = None
+        self.idle: asyncio.Event = None
+        self.worker_task: asyncio.Task = None
+        self.sent_count = 0
+        self.failed_count = 0
+
+    def ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        if self.worker_task and not self.worker_task.done() and self.worker_task.get_loop() is loop:
+            return
+        config = get_config()
+        self.global_bucket = TokenBucket(config.send_msg_global_rate, config.send_msg_burst)
+        self.group_buckets.clear()
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.worker_task = loop.create_task(self.worker())
+
+    def get_group_bucket(self, gid: str) -> TokenBucket:
+        if gid not in self.group_buckets:
+            config = get_config()
+            self.group_buckets[gid] = TokenBucket(config.send_msg_group_rate, config.send_msg_burst)
+        return self.group_buckets[gid]
+
+    def enqueue(self, item: OutboundMessage):
+        self.ensure_worker()
+        self.queues.setdefault(item.gid, deque()).append(item)
+        self.idle.clear()
+        self.wakeup.set()
+
+    def send(self, gid: str, message: Message):
+        self.enqueue(OutboundMessage(str(gid), message=Message(message)))
+
+    def mention(self, gid: str, text: str, uids: Iterable[str]):
+        uids = [str(uid) for uid in uids]
+        if not uids:
+            return
+        gid = str(gid)
+        for item in self.queues.get(gid, ()):
+            if item.mention_text == text:
+                item.mentions.extend(uid for uid in dict.fromkeys(uids) if uid not in item.mentions)
+                return
+        self.enqueue(OutboundMessage(gid, mention_text=text, mentions=list(dict.fromkeys(uids))))
+
+    def pending_count(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def next_item(self) -> Optional[OutboundMessage]:
+        item = None
+        for gid, queue in self.queues.items():
+            if self.get_group_bucket(gid).wait_time() == 0:
+                item = queue.popleft()
+                break
+        if not item:
+            return None
+        # 轮流发送各个群的消息
+        if self.queues[item.gid]:
+            self.queues.move_to_end(item.gid)
+        else:
+            del self.queues[item.gid]
+        if item.mention_text is not None and len(item.mentions) > max_mention_per_message:
+            rest = OutboundMessage(item.gid, mention_text=item.mention_text,
+                                   mentions=item.mentions[max_mention_per_message:])
+            item.mentions = item.mentions[:max_mention_per_message]
+            self.queues.setdefault(item.gid, deque()).appendleft(rest)
+        return item
+
+    def get_wait_time(self) -> float:
+        return min(self.get_group_bucket(gid).wait_time() for gid in self.queues)
+
+    async def worker(self):
+        while True:
+            if not self.queues:
+                self.idle.set()
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            if (wait := max(self.global_bucket.wait_time(), self.get_wait_time())) > 0:
+                await asyncio.sleep(wait)
+                continue
+            item = self.next_item()
+            if not item:
+                continue
+            self.global_bucket.consume()
+            self.get_group_bucket(item.gid).consume()
+            await self.deliver(item)
+
+    async def deliver(self, item: OutboundMessage):
+        try:
+            bot = list(nonebot.get_bots().values())[0]
+            await bot.send_group_msg(group_id=item.gid, message=item.build())
+            self.sent_count += 1
+        except Exception as e:
+            item.retry_times += 1
+            if item.retry_times > get_config().send_msg_retry_times:
+                self.failed_count += 1
+                logger.warning(f"群{item.gid}消息发送失败，已放弃：{e}")
+                return
+            # 重试的消息排在该群队首，保持消息顺序
+            self.queues.setdefault(item.gid, deque()).appendleft(item)
+
+    async def drain(self, timeout: float = None):
+        if not self.worker_task or self.worker_task.done() or self.idle.is_set():
+            return
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"仍有{self.pending_count()}条群消息未发送")
+
+    def stats(self) -> Dict[str, int]:
+        return {"pending": self.pending_count(), "sent": self.sent_count, "failed": self.failed_count}
+
+
+message_dispatcher = MessageDispatcher()
@@ -14,6 +14,24 @@ class ClanBattleDamageParseException(Exception):
         return "伤害解析错误，请确保输入伤害格式正确"
 
 
+class ClanBattleBatchRecordException(Exception):
+    def __init__(self, index: int, result):
+        self.index = index
+        self.result = result
+
+    def __str__(self):
+        return f"第{self.index + 1}条出刀记录上报失败：{self.result}"
+
+
+class ClanBattleImportException(Exception):
+    def __init__(self, line_num: int, msg: str):
+        self.line_num = line_num
+        self.msg = msg
+
+    def __str__(self):
+        return f"第{self.line_num}条记录导入失败：{self.msg}"
+
+
 class WebsocketAuthException(Exception):
     def __init__(self):
         pass
@@ -0,0 +1,145 @@
+import csv
+import datetime
+import io
+import json
+from typing import Dict, List, Optional, Type
+
+from peewee import BigIntegerField, BooleanField, DateField, DateTimeField, IntegerField
+
+from .db import BaseModel, BattleRecord, BattleSL, BattleInProgress, BattleOnTree, BattleSubscribe
+from .exception import ClanBattleException
+
+
+# 可导出的表，均按公会和会战档案筛选
+export_models: Dict[str, Type[BaseModel]] = {model._meta.table_name: model for model in (
+    BattleRecord, BattleSL, BattleInProgress, BattleOnTree, BattleSubscribe)}
+
+export_formats = {"csv": "text/csv", "ndjson": "application/x-ndjson", "parquet": "application/vnd.apache.parquet"}
+
+
+def encode_json_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f"无法编码 {type(value)}")
+
+
+class ChunkSink(io.RawIOBase):
+    # pyarrow 写入的数据先暂存，每写完一批取出一次；自行记录位置，取出数据后写入位置不变
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.chunks: List[bytes] = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def take(self) -> bytes:
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+
+class TableExporter:
+    # 按主键顺序分批读取一张表，每次调用 next_chunk 读取并编码一批，内存占用与表的大小无关
+
+    def __init__(self, model: Type[BaseModel], clan_gid: str, data_num: int, export_format: str, batch_size: int = 1000) -> None:
+        if export_format not in export_formats:
+            raise ClanBattleException("不支持的导出格式")
+        self.model = model
+        self.clan_gid = clan_gid
+        self.data_num = data_num
+        self.export_format = export_format
+        self.batch_size = batch_size
+        self.fields = model._meta.sorted_fields
+        self.field_names = [field.name for field in self.fields]
+        self.last_id = 0
+        self.started = False
+        self.finished = False
+        self.parquet_writer = None
+        self.parquet_sink: ChunkSink = None
+        if export_format == "parquet":
+            self.init_parquet()
+
+    def init_parquet(self):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ClanBattleException("导出 Parquet 格式需要安装 pyarrow")
+        field_types = {BigIntegerField: pyarrow.int64(), IntegerField: pyarrow.int64(), BooleanField: pyarrow.bool_(),
+                       DateTimeField: pyarrow.timestamp("us"), DateField: pyarrow.date32()}
+        schema = pyarrow.schema([(field.name, next((arrow_type for field_type, arrow_type in field_types.items()
+                                                    if isinstance(field, field_type)), pyarrow.string()))
+                                 for field in self.fields])
+        self.parquet_sink = ChunkSink()
+        self.parquet_writer = pyarrow.parquet.ParquetWriter(self.parquet_sink, schema)
+
+    @property
+    def file_name(self) -> str:
+        return f"{self.clan_gid}_{self.data_num}_{self.model._meta.table_name}.{self.export_format}"
+
+    @property
+    def media_type(self) -> str:
+        return export_formats[self.export_format]
+
+    def read_batch(self) -> List[tuple]:
+        rows = list(self.model
+                    .select(*self.fields)
+                    .where((self.model.clan_gid == self.clan_gid) & (self.model.using_data_num == self.data_num)
+                           & (self.model.id > self.last_id))
+                    .order_by(self.model.id)
+                    .limit(self.batch_size)
+                    .tuples())
+        if rows:
+            self.last_id = rows[-1][0]
+        return rows
+
+    def encode_csv(self, rows: List[tuple]) -> bytes:
+        output = io.StringIO()
+        writer = csv.writer(output)
+        if not self.started:
+            # 带 BOM 以便表格软件正确识别编码
+            output.write("\ufeff")
+            writer.writerow(self.field_names)
+        writer.writerows(rows)
+        return output.getvalue().encode("utf-8")
+
+    def encode_ndjson(self, rows: List[tuple]) -> bytes:
+        return "".join(json.dumps(dict(zip(self.field_names, row)), ensure_ascii=False, default=encode_json_value) + "\n"
+                       for row in rows).encode("utf-8")
+
+    def encode_parquet(self, rows: List[tuple]) -> bytes:
+        import pyarrow
+        if rows:
+            columns = list(zip(*rows))
+            self.parquet_writer.write_table(pyarrow.Table.from_pydict(
+                {name: list(column) for name, column in zip(self.field_names, columns)}, schema=self.parquet_writer.schema))
+        else:
+            self.parquet_writer.close()
+        return self.parquet_sink.take()
+
+    def next_chunk(self) -> Optional[bytes]:
+        # 全部导出后返回 None
+        if self.finished:
+            return None
+        rows = self.read_batch()
+        chunk = getattr(self, f"encode_{self.export_format}")(rows)
+        self.started = True
+        if len(rows) < self.batch_size:
+            if rows and self.parquet_writer:
+                chunk += self.encode_parquet([])
+            self.finished = True
+        return chunk
+
+    def __iter__(self):
+        while (chunk := self.next_chunk()) is not None:
+            yield chunk
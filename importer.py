@@ -0,0 +1,184 @@
+import csv
+import datetime
+import json
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from .db import clanbattle_db, User, ClanInfo, BattleRecord, BattleEvent, BossStateSnapshot, get_battle_date, rebuild_daily_summary, sync_legacy_membership
+from .exception import ClanBattleImportException
+from . import utils
+from .utils import ClanBattleData
+
+
+def read_rows(path: str, file_format: str = None) -> Iterator[dict]:
+    # 逐行读取 CSV 或 JSON Lines 文件，不会一次性读入整个文件
+    file_format = file_format or ("csv" if path.lower().endswith(".csv") else "ndjson")
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if file_format == "csv":
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def get_value(row: dict, key: str, parser=str):
+    value = row.get(key)
+    return None if value is None or value == "" else parser(value)
+
+
+def parse_bool(value) -> bool:
+    return str(value).strip().lower() in ("1", "true", "yes")
+
+
+def parse_time(value) -> datetime.datetime:
+    return value if isinstance(value, datetime.datetime) else datetime.datetime.fromisoformat(str(value))
+
+
+class BossTimeline:
+    # 按时间顺序模拟一个空的会战档案中各boss的状态，检查导入的记录是否与 boss_info 一致，规则与报刀时的检查相同
+
+    def __init__(self, clan_type: str) -> None:
+        # 通过模块读取，Tools.update_boss_info 更新boss信息时会替换 stage_tables
+        self.stage_table = utils.stage_tables[clan_type]
+        self.cycles = [1] * 5
+        self.boss_hp = [self.stage_table.get_boss_hp(1, boss) for boss in range(1, 6)]
+        self.last_time: datetime.datetime = None
+
+    def apply(self, target_boss: int, target_cycle: Optional[int], damage: int, boss_hp: Optional[int]) -> Tuple[int, int]:
+        # 返回出刀时boss的周目和血量，与模拟的状态不一致时抛出 ValueError
+        if not 1 <= target_boss <= 5:
+            raise ValueError(f"boss编号{target_boss}错误")
+        cycle, hp = self.cycles[target_boss-1], self.boss_hp[target_boss-1]
+        if target_cycle is not None and target_cycle != cycle:
+            raise ValueError(f"{target_boss}王当前为{cycle}周目")
+        if boss_hp is not None and boss_hp != hp:
+            raise ValueError(f"{target_boss}王当前剩余血量为{hp}")
+        if not 0 <= damage <= hp:
+            raise ValueError(f"伤害{damage}超出{target_boss}王剩余血量{hp}")
+        if damage == hp:
+            self.cycles[target_boss-1] += 1
+            self.boss_hp[target_boss-1] = self.stage_table.get_boss_hp(
+                self.stage_table.get_stage(cycle + 1), target_boss)
+        else:
+            self.boss_hp[target_boss-1] -= damage
+        return cycle, hp
+
+
+class RecordImporter:
+    # 批量导入其它会战机器人的出刀记录，只写入数据表，不进行击杀提醒等处理，导入完成后重新生成boss状态和每日出刀统计
+
+    def __init__(self, clan_type: str = None, data_num: int = None, batch_size: int = 500) -> None:
+        self.clan_type = clan_type
+        self.data_num = data_num
+        self.batch_size = batch_size
+        self.clans: Dict[str, ClanInfo] = {}
+        self.timelines: Dict[Tuple[str, int], BossTimeline] = {}
+        # (公会, 档案, 成员) -> (会战日, 剩余补偿刀)
+        self.remain_addition: Dict[Tuple[str, int, str], Tuple[datetime.date, int]] = {}
+        self.user_names: Dict[str, Optional[str]] = {}
+        self.members: Dict[str, Set[str]] = {}
+        self.pending: List[dict] = []
+        self.imported = 0
+
+    def get_clan(self, row: dict) -> ClanInfo:
+        gid = str(row["clan_gid"])
+        if gid not in self.clans:
+            clan = ClanInfo.get_or_none(ClanInfo.clan_gid == gid)
+            if not clan:
+                clan_type = get_value(row, "clan_type") or self.clan_type
+                if clan_type not in utils.stage_tables:
+                    raise ValueError(f"公会{gid}不存在，需要指定服务器（cn、tw或jp）")
+                ClanBattleData.create_clan(gid, get_value(row, "clan_name") or gid, clan_type, [])
+                clan = ClanInfo.get(ClanInfo.clan_gid == gid)
+            self.clans[gid] = clan
+        return self.clans[gid]
+
+    def get_timeline(self, clan: ClanInfo, data_num: int) -> BossTimeline:
+        key = (clan.clan_gid, data_num)
+        if key not in self.timelines:
+            # 已有数据的档案无法确定导入记录之前的boss状态
+            if (BattleRecord.select().where((BattleRecord.clan_gid == clan.clan_gid) & (BattleRecord.using_data_num == data_num)).exists()
+                    or BattleEvent.select().where((BattleEvent.clan_gid == clan.clan_gid) & (BattleEvent.using_data_num == data_num)
+                                                  & BattleEvent.boss_state.is_null(False)).exists()):
+                raise ValueError(f"公会{clan.clan_gid}的会战档案{data_num}已有出刀数据，只能导入到空档案")
+            self.timelines[key] = BossTimeline(clan.clan_type)
+        return self.timelines[key]
+
+    def add_row(self, row: dict):
+        clan = self.get_clan(row)
+        data_num = self.data_num or get_value(row, "using_data_num", int) or clan.current_using_data_num
+        timeline = self.get_timeline(clan, data_num)
+        member_uid = str(row["member_uid"])
+        record_time = parse_time(row["record_time"])
+        if timeline.last_time and record_time < timeline.last_time:
+            raise ValueError("同一档案的记录需按时间顺序排列")
+        timeline.last_time = record_time
+        damage = int(row["damage"])
+        target_cycle, boss_hp = timeline.apply(int(row["target_boss"]), get_value(row, "target_cycle", int),
+                                               damage, get_value(row, "boss_hp", int))
+        # 未提供是否为补偿刀时按当天之前的记录推算，与报刀时的规则相同
+        key = (clan.clan_gid, data_num, member_uid)
+        battle_date = get_battle_date(record_time, clan.clan_type)
+        last_date, remain_addition = self.remain_addition.get(key, (battle_date, 0))
+        if last_date != battle_date:
+            remain_addition = 0
+        is_extra_time = get_value(row, "is_extra_time", parse_bool)
+        remain_next_chance = get_value(row, "remain_next_chance", parse_bool)
+        if is_extra_time is None or remain_next_chance is None:
+            is_extra_time = remain_addition > 0
+            remain_next_chance = not is_extra_time and damage == boss_hp
+        elif is_extra_time and remain_addition <= 0:
+            raise ValueError("该成员当天没有剩余的补偿刀")
+        elif remain_next_chance and (is_extra_time or damage != boss_hp):
+            raise ValueError("只有击破boss的完整刀才会留下补偿刀")
+        self.remain_addition[key] = (battle_date, remain_addition + remain_next_chance - is_extra_time)
+        self.pending.append({"clan_gid": clan.clan_gid, "member_uid": member_uid, "record_time": record_time,
+                             "using_data_num": data_num, "target_cycle": target_cycle, "target_boss": int(row["target_boss"]),
+                             "boss_hp": boss_hp, "damage": damage, "comment": get_value(row, "comment"),
+                             "is_extra_time": is_extra_time, "remain_next_chance": remain_next_chance,
+                             "proxy_report_uid": get_value(row, "proxy_report_uid")})
+        if member_uid not in self.user_names or not self.user_names[member_uid]:
+            self.user_names[member_uid] = get_value(row, "member_name")
+        self.members.setdefault(clan.clan_gid, set()).add(member_uid)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            BattleRecord.insert_many(self.pending).execute()
+            self.imported += len(self.pending)
+            self.pending = []
+
+    def finish(self) -> Dict[str, int]:
+        self.flush()
+        exist_users = set()
+        for uids in [list(self.user_names)[i:i+self.batch_size] for i in range(0, len(self.user_names), self.batch_size)]:
+            exist_users.update(uid for uid, in User.select(User.qq_uid).where(User.qq_uid.in_(uids)).tuples())
+        new_users = [{"qq_uid": uid, "uname": uname} for uid, uname in self.user_names.items() if uid not in exist_users]
+        for i in range(0, len(new_users), self.batch_size):
+            User.insert_many(new_users[i:i+self.batch_size]).execute()
+        new_members = sum(ClanBattleData.insert_membership(gid, sorted(uids), "member") for gid, uids in self.members.items())
+        for gid, uids in self.members.items():
+            sync_legacy_membership(gid, sorted(uids))
+        # 删除旧的进度快照，下次加载时由导入的记录生成boss状态
+        summary_rows = 0
+        for clan_gid, data_num in self.timelines:
+            BossStateSnapshot.delete().where((BossStateSnapshot.clan_gid == clan_gid)
+                                             & (BossStateSnapshot.using_data_num == data_num)).execute()
+            summary_rows += rebuild_daily_summary(clan_gid, data_num)
+        return {"battle_record": self.imported, "user": len(new_users), "clan_membership": new_members,
+                "daily_member_summary": summary_rows}
+
+
+def import_records(path: str, file_format: str = None, clan_type: str = None, data_num: int = None, batch_size: int = 500) -> Dict[str, int]:
+    # 全部记录在同一事务中导入，任意一条记录不合法时不会写入任何数据
+    importer = RecordImporter(clan_type, data_num, batch_size)
+    with clanbattle_db.atomic():
+        for line_num, row in enumerate(read_rows(path, file_format), 1):
+            try:
+                importer.add_row(row)
+            except KeyError as e:
+                raise ClanBattleImportException(line_num, f"缺少{e}字段")
+            except (ValueError, TypeError) as e:
+                raise ClanBattleImportException(line_num, str(e))
+        return importer.finish()
@@ -0,0 +1,152 @@
+import argparse
+import importlib
+import os
+import sys
+
+import nonebot
+import peewee
+
+
+def load_plugin():
+    # 以包的形式导入插件，使维护命令可以在机器人进程之外运行
+    plugin_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(plugin_dir))
+    nonebot.init()
+    plugin = importlib.import_module(os.path.basename(plugin_dir))
+    plugin.load_config()
+    plugin.Tools.update_boss_info()
+    return plugin
+
+
+def explain(args) -> int:
+    plugin = load_plugin()
+    clan = plugin.clanbattle.get_clan_data(args.clan_gid)
+    if not clan:
+        print("公会不存在")
+        return 1
+    for name, sql, plan in clan.explain_hot_queries():
+        print(f"=== {name} ===")
+        print(sql)
+        for row in plan:
+            print(f"    {row}")
+    return 0
+
+
+def copy_db(args) -> int:
+    plugin = load_plugin()
+    db = importlib.import_module(plugin.__name__ + ".db")
+    source_path = args.source or os.path.join(os.path.dirname(os.path.abspath(__file__)), "clanbattle.db")
+    if not os.path.isfile(source_path):
+        print(f"找不到源数据库 {source_path}")
+        return 1
+    target = db.clanbattle_db.obj
+    if db.is_sqlite(target) and os.path.abspath(target.database) == os.path.abspath(source_path):
+        print("目标数据库与源数据库相同，请先在配置文件中设置 database")
+        return 1
+    source = peewee.SqliteDatabase(source_path)
+    try:
+        copied = db.copy_database(source, target, args.batch_size)
+    except ValueError as e:
+        print(e)
+        return 1
+    finally:
+        source.close()
+    for table, count in copied.items():
+        print(f"{table}: {count}")
+    return 0
+
+
+def rebuild_summary(args) -> int:
+    plugin = load_plugin()
+    db = importlib.import_module(plugin.__name__ + ".db")
+    if args.clan_gid and not db.ClanInfo.get_or_none(db.ClanInfo.clan_gid == args.clan_gid):
+        print("公会不存在")
+        return 1
+    print(f"已生成{db.rebuild_daily_summary(args.clan_gid)}条每日出刀统计")
+    return 0
+
+
+def export(args) -> int:
+    plugin = load_plugin()
+    db = importlib.import_module(plugin.__name__ + ".db")
+    export_module = importlib.import_module(plugin.__name__ + ".export")
+    exception = importlib.import_module(plugin.__name__ + ".exception")
+    clan_info = db.ClanInfo.get_or_none(db.ClanInfo.clan_gid == args.clan_gid)
+    if not clan_info:
+        print("公会不存在")
+        return 1
+    data_num = args.data_num if args.data_num is not None else clan_info.current_using_data_num
+    os.makedirs(args.output, exist_ok=True)
+    for table in args.table or export_module.export_models:
+        try:
+            exporter = export_module.TableExporter(
+                export_module.export_models[table], args.clan_gid, data_num, args.format, args.batch_size)
+        except exception.ClanBattleException as e:
+            print(e)
+            return 1
+        path = os.path.join(args.output, exporter.file_name)
+        with open(path, "wb") as f:
+            for chunk in exporter:
+                f.write(chunk)
+        print(f"{table}: {path}")
+    return 0
+
+
+def import_data(args) -> int:
+    plugin = load_plugin()
+    importer = importlib.import_module(plugin.__name__ + ".importer")
+    exception = importlib.import_module(plugin.__name__ + ".exception")
+    if not os.path.isfile(args.path):
+        print(f"找不到文件 {args.path}")
+        return 1
+    try:
+        imported = importer.import_records(args.path, args.format, args.clan_type, args.data_num, args.batch_size)
+    except exception.ClanBattleImportException as e:
+        print(e)
+        return 1
+    for table, count in imported.items():
+        print(f"{table}: {count}")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Yuki Clanbattle 维护工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    explain_parser = subparsers.add_parser("explain", help="输出常用查询的执行计划")
+    explain_parser.add_argument("clan_gid", help="公会群号")
+    explain_parser.set_defaults(func=explain)
+
+    copy_parser = subparsers.add_parser("copy-db", help="将 SQLite 数据库中的数据复制到配置文件中设置的数据库")
+    copy_parser.add_argument("--source", help="源 SQLite 数据库文件，默认为插件目录下的 clanbattle.db")
+    copy_parser.add_argument("--batch-size", type=int, default=500, help="每批复制的行数")
+    copy_parser.set_defaults(func=copy_db)
+
+    summary_parser = subparsers.add_parser("rebuild-summary", help="由出刀记录重新生成每日出刀统计")
+    summary_parser.add_argument("--clan-gid", help="只重新生成该公会的统计")
+    summary_parser.set_defaults(func=rebuild_summary)
+
+    export_parser = subparsers.add_parser("export", help="导出公会某个会战档案的数据")
+    export_parser.add_argument("clan_gid", help="公会群号")
+    export_parser.add_argument("--data-num", type=int, help="会战档案编号，默认为当前档案")
+    export_parser.add_argument("--format", choices=["csv", "ndjson", "parquet"], default="csv", help="导出格式，parquet 需安装 pyarrow")
+    export_parser.add_argument("--table", action="append", choices=["battle_record", "battle_sl", "battle_in_progress", "battle_on_tree", "battle_subscribe"],
+                               help="导出的数据表，可指定多次，默认导出全部")
+    export_parser.add_argument("--output", default=".", help="输出目录")
+    export_parser.add_argument("--batch-size", type=int, default=1000, help="每批读取的行数")
+    export_parser.set_defaults(func=export)
+
+    import_parser = subparsers.add_parser("import", help="从其它会战机器人导出的文件导入出刀记录")
+    import_parser.add_argument("path", help="CSV 或 JSON Lines 文件，每行一条出刀记录")
+    import_parser.add_argument("--format", choices=["csv", "ndjson"], help="文件格式，默认按扩展名判断")
+    import_parser.add_argument("--clan-type", choices=["cn", "tw", "jp"], help="公会不存在时创建公会使用的服务器")
+    import_parser.add_argument("--data-num", type=int, help="导入到的会战档案编号，默认使用文件中的 using_data_num 或公会当前档案")
+    import_parser.add_argument("--batch-size", type=int, default=500, help="每批写入的行数")
+    import_parser.set_defaults(func=import_data)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
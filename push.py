@@ -0,0 +1,112 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Set
+
+from fastapi import WebSocket
+from fastapi.encoders import jsonable_encoder
+
+from .db import ClanInfo, BattleRecord, BattleInProgress, BattleOnTree, BattleSubscribe, BattleEvent
+
+
+# 数据表变化时需要推送的主题
+table_topics: Dict[type, Set[str]] = {
+    BattleRecord: {"boss_status"},
+    BattleEvent: {"boss_status"},
+    BattleInProgress: {"queue"},
+    BattleOnTree: {"on_tree"},
+    BattleSubscribe: {"subscribe"},
+    ClanInfo: {"boss_status", "queue", "on_tree", "subscribe"},
+}
+
+# 单次发送超时时间（秒），超时的客户端视为已断开
+send_timeout = 10
+
+
+class PushClient:
+    # 每个客户端只保留各主题的最新数据，发送慢的客户端不会积压消息
+
+    def __init__(self, websocket: WebSocket, clan_gid: str) -> None:
+        self.websocket = websocket
+        self.clan_gid = clan_gid
+        self.pending: Dict[str, Any] = {}
+        self.wakeup = asyncio.Event()
+
+    def offer(self, topic: str, data: Any):
+        self.pending[topic] = data
+        self.wakeup.set()
+
+    async def send_loop(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            pending, self.pending = self.pending, {}
+            for topic, data in pending.items():
+                await asyncio.wait_for(self.websocket.send_json({"type": topic, "data": data}), send_timeout)
+
+
+class PushHub:
+
+    def __init__(self) -> None:
+        self.clients: Dict[str, Set[PushClient]] = {}
+        self.topic_loaders: Dict[str, Callable[[str], Awaitable[Any]]] = {}
+        self.dirty_topics: Dict[str, Set[str]] = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def register_topic(self, topic: str, loader: Callable[[str], Awaitable[Any]]):
+        self.topic_loaders[topic] = loader
+
+    def notify_tables(self, clan_gid: str, tables: Iterable[type]):
+        # 可能在数据库线程中调用，需要切换回事件循环
+        if not self.loop or not self.clients.get(clan_gid):
+            return
+        topics = set()
+        for table in tables:
+            topics |= table_topics.get(table, set())
+        if topics:
+            self.loop.call_soon_threadsafe(self.mark_dirty, clan_gid, topics)
+
+    def mark_dirty(self, clan_gid: str, topics: Set[str]):
+        if clan_gid in self.dirty_topics:
+            self.dirty_topics[clan_gid] |= topics
+            return
+        self.dirty_topics[clan_gid] = set(topics)
+        asyncio.ensure_future(self.publish(clan_gid))
+
+    async def publish(self, clan_gid: str):
+        # 同一公会短时间内的多次修改合并为一次推送，每个主题只读取一次数据
+        await asyncio.sleep(0)
+        topics = self.dirty_topics.pop(clan_gid, set())
+        for topic in topics:
+            if not self.clients.get(clan_gid) or topic not in self.topic_loaders:
+                continue
+            data = jsonable_encoder(await self.topic_loaders[topic](clan_gid))
+            for client in list(self.clients.get(clan_gid, ())):
+                client.offer(topic, data)
+
+    async def serve(self, websocket: WebSocket, clan_gid: str):
+        self.loop = asyncio.get_running_loop()
+        client = PushClient(websocket, clan_gid)
+        self.clients.setdefault(clan_gid, set()).add(client)
+        send_task = asyncio.ensure_future(client.send_loop())
+        receive_task = None
+        try:
+            # 连接建立后先推送一次完整状态
+            for topic, loader in self.topic_loaders.items():
+                client.offer(topic, jsonable_encoder(await loader(clan_gid)))
+            receive_task = asyncio.ensure_future(websocket.receive_text())
+            while True:
+                done, _ = await asyncio.wait({send_task, receive_task}, return_when=asyncio.FIRST_COMPLETED)
+                if send_task in done:
+                    send_task.result()
+                    break
+                receive_task.result()
+                receive_task = asyncio.ensure_future(websocket.receive_text())
+        finally:
+            self.clients[clan_gid].discard(client)
+            if not self.clients[clan_gid]:
+                del self.clients[clan_gid]
+            for task in (send_task, receive_task):
+                if task and not task.done():
+                    task.cancel()
+
+
+push_hub = PushHub()
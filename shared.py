@@ -0,0 +1,189 @@
+import json
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+from nonebot.log import logger
+
+
+# 多个机器人进程共用的缓存和失效通知，未配置 shared_cache_url 时全部操作为空操作
+key_prefix = "clanbattle:"
+invalidate_channel = key_prefix + "invalidate"
+
+
+class MemorySharedBackend:
+    # 进程内实现，接口与 redis 客户端的子集相同，用于测试和单进程部署
+
+    def __init__(self) -> None:
+        self.entries: Dict[str, tuple] = {}
+        self.subscribers: Dict[str, List[Callable[[str], None]]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            if entry[0] and entry[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            return entry[1]
+
+    def set(self, key: str, value: str, ex: int = None):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ex if ex else None, value)
+
+    def delete(self, *keys: str) -> int:
+        with self.lock:
+            return sum(self.entries.pop(key, None) is not None for key in keys)
+
+    def incr(self, key: str) -> int:
+        with self.lock:
+            expire, value = self.entries.get(key, (None, "0"))
+            value = str(int(value) + 1)
+            self.entries[key] = (expire, value)
+            return int(value)
+
+    def publish(self, channel: str, message: str) -> int:
+        with self.lock:
+            handlers = list(self.subscribers.get(channel, ()))
+        for handler in handlers:
+            handler(message)
+        return len(handlers)
+
+    def subscribe(self, channel: str, handler: Callable[[str], None]):
+        with self.lock:
+            self.subscribers.setdefault(channel, []).append(handler)
+
+    def close(self):
+        with self.lock:
+            self.subscribers.clear()
+
+
+class RedisSharedBackend:
+
+    def __init__(self, url: str) -> None:
+        import redis
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.pubsub = None
+        self.listen_thread = None
+
+    def get(self, key: str) -> Optional[str]:
+        return self.client.get(key)
+
+    def set(self, key: str, value: str, ex: int = None):
+        self.client.set(key, value, ex=ex)
+
+    def delete(self, *keys: str) -> int:
+        return self.client.delete(*keys)
+
+    def incr(self, key: str) -> int:
+        return self.client.incr(key)
+
+    def publish(self, channel: str, message: str) -> int:
+        return self.client.publish(channel, message)
+
+    def subscribe(self, channel: str, handler: Callable[[str], None]):
+        if not self.pubsub:
+            self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(**{channel: lambda message: handler(message["data"])})
+        if not self.listen_thread:
+            self.listen_thread = self.pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def close(self):
+        if self.listen_thread:
+            self.listen_thread.stop()
+        if self.pubsub:
+            self.pubsub.close()
+        self.client.close()
+
+
+def create_shared_backend(url: str):
+    if url == "memory://":
+        return MemorySharedBackend()
+    return RedisSharedBackend(url)
+
+
+class SharedState:
+
+    def __init__(self) -> None:
+        self.backend = None
+        # 用于忽略本进程自己发出的通知
+        self.node_id = uuid.uuid4().hex
+        self.listeners: List[Callable[[dict], None]] = []
+        self.published_count = 0
+        self.received_count = 0
+        self.error_count = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    def start(self, backend):
+        self.backend = backend
+        backend.subscribe(invalidate_channel, self.on_message)
+
+    def stop(self):
+        if self.backend:
+            self.backend.close()
+            self.backend = None
+
+    def add_listener(self, listener: Callable[[dict], None]):
+        self.listeners.append(listener)
+
+    def call_backend(self, method: str, *args, **kwargs):
+        # 共享缓存不可用时退回到只使用本进程缓存，不影响正常功能
+        if not self.backend:
+            return None
+        try:
+            return getattr(self.backend, method)(*args, **kwargs)
+        except Exception as e:
+            self.error_count += 1
+            logger.warning(f"共享缓存操作 {method} 失败：{e}")
+            return None
+
+    def get_json(self, key: str) -> Any:
+        data = self.call_backend("get", key_prefix + key)
+        return json.loads(data) if data else None
+
+    def set_json(self, key: str, value: Any, ttl: int):
+        self.call_backend("set", key_prefix + key, json.dumps(value, ensure_ascii=False), ex=ttl)
+
+    def get_int(self, key: str) -> int:
+        return int(self.call_backend("get", key_prefix + key) or 0)
+
+    def incr(self, key: str) -> int:
+        return self.call_backend("incr", key_prefix + key) or 0
+
+    def delete(self, *keys: str):
+        if keys:
+            self.call_backend("delete", *(key_prefix + key for key in keys))
+
+    def publish(self, event_type: str, **data):
+        if not self.backend:
+            return
+        data.update(type=event_type, node=self.node_id)
+        if self.call_backend("publish", invalidate_channel, json.dumps(data)) is not None:
+            self.published_count += 1
+
+    def on_message(self, message: str):
+        try:
+            event = json.loads(message)
+        except ValueError:
+            return
+        if event.get("node") == self.node_id:
+            return
+        self.received_count += 1
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception:
+                logger.exception("处理共享缓存失效通知时出现错误")
+
+    def stats(self) -> Dict[str, int]:
+        return {"enabled": self.enabled, "published": self.published_count,
+                "received": self.received_count, "errors": self.error_count}
+
+
+shared_state = SharedState()
@@ -0,0 +1,98 @@
+from typing import Dict, List, Optional
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .db import get_battle_day_offset
+from .exception import ClanBattleException
+
+
+# 统计的伤害分位数
+damage_percentiles = (10, 25, 50, 75, 90)
+
+
+def load_record_columns(rows: List[tuple], clan_type: str) -> Dict[str, "np.ndarray"]:
+    # rows 为 (member_uid, target_boss, damage, boss_hp, is_extra_time, remain_next_chance, record_time)，转为按列保存的数组
+    if np is None:
+        raise ClanBattleException("会战统计需要安装 numpy")
+    member_uid, target_boss, damage, boss_hp, is_extra_time, remain_next_chance, record_time = (
+        zip(*rows) if rows else ([],) * 7)
+    record_time = np.array(record_time, dtype="datetime64[us]")
+    return {
+        "member_uid": np.array(member_uid, dtype=str),
+        "target_boss": np.array(target_boss, dtype=np.int64),
+        "damage": np.array(damage, dtype=np.int64),
+        "boss_hp": np.array(boss_hp, dtype=np.int64),
+        "is_extra_time": np.array(is_extra_time, dtype=bool),
+        "remain_next_chance": np.array(remain_next_chance, dtype=bool),
+        "battle_date": (record_time + np.timedelta64(get_battle_day_offset(clan_type))).astype("datetime64[D]"),
+    }
+
+
+def summarize_groups(keys: "np.ndarray", columns: Dict[str, "np.ndarray"]) -> Dict[str, dict]:
+    # 按 keys 分组统计伤害，各项统计均为整列的向量运算
+    group_keys, inverse = np.unique(keys, return_inverse=True)
+    group_num = len(group_keys)
+    damage = columns["damage"]
+    is_extra_time = columns["is_extra_time"]
+
+    def group_sum(weights) -> "np.ndarray":
+        return np.bincount(inverse, weights=weights, minlength=group_num)
+
+    count = np.bincount(inverse, minlength=group_num)
+    total_damage = group_sum(damage)
+    addition_challenge = group_sum(is_extra_time)
+    addition_damage = group_sum(np.where(is_extra_time, damage, 0))
+    compensation_earned = group_sum(columns["remain_next_chance"])
+    kills = group_sum((damage == columns["boss_hp"]) & (damage > 0))
+    # 按组排序后每组的伤害连续存放，按线性插值一次算出所有组的分位数
+    sorted_damage = damage[np.lexsort((damage, inverse))].astype(np.float64)
+    group_start = (np.cumsum(count) - count)[:, None]
+    position = (count[:, None] - 1) * (np.array(damage_percentiles) / 100)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    lower_damage = sorted_damage[group_start + lower]
+    percentiles = lower_damage + (sorted_damage[group_start + upper] - lower_damage) * (position - lower)
+    ret = {}
+    for i, key in enumerate(group_keys.tolist()):
+        ret[str(key)] = {
+            "count": int(count[i]),
+            "full_challenge": int(count[i] - addition_challenge[i]),
+            "addition_challenge": int(addition_challenge[i]),
+            "total_damage": int(total_damage[i]),
+            "average_damage": float(total_damage[i] / count[i]),
+            "kills": int(kills[i]),
+            "damage_percentiles": {f"p{p}": float(value) for p, value in zip(damage_percentiles, percentiles[i])},
+            # 补偿刀：获得的数量、已使用的数量、使用率和平均伤害
+            "compensation_earned": int(compensation_earned[i]),
+            "compensation_used": int(addition_challenge[i]),
+            "compensation_efficiency": float(addition_challenge[i] / compensation_earned[i]) if compensation_earned[i] else None,
+            "compensation_average_damage": float(addition_damage[i] / addition_challenge[i]) if addition_challenge[i] else None,
+        }
+    return ret
+
+
+def summarize_days(columns: Dict[str, "np.ndarray"]) -> List[dict]:
+    days, day_index = np.unique(columns["battle_date"], return_inverse=True)
+    member_keys, member_index = np.unique(columns["member_uid"], return_inverse=True)
+    # 同一天同一成员只计一次
+    member_day = np.unique(day_index * len(member_keys) + member_index)
+    members = np.bincount(member_day // max(len(member_keys), 1), minlength=len(days))
+    full_challenge = np.bincount(day_index, weights=~columns["is_extra_time"], minlength=len(days))
+    total_damage = np.bincount(day_index, weights=columns["damage"], minlength=len(days))
+    return [{"date": str(day), "members": int(members[i]), "full_challenge": int(full_challenge[i]),
+             "total_damage": int(total_damage[i])} for i, day in enumerate(days.tolist())]
+
+
+def compute_statistics(rows: List[tuple], clan_type: str) -> dict:
+    columns = load_record_columns(rows, clan_type)
+    total: Optional[dict] = summarize_groups(np.zeros(len(rows), dtype=np.int64), columns).get("0")
+    return {
+        "record_count": len(rows),
+        "total": total,
+        "members": summarize_groups(columns["member_uid"], columns),
+        "bosses": summarize_groups(columns["target_boss"], columns),
+        "days": summarize_days(columns),
+    }
@@ -2,6 +2,7 @@ from os import path
 import os
 
 
+import asyncio
 from typing import TYPE_CHECKING, Set
 
 import pytest
@@ -26,7 +27,7 @@ async def test_clanbattle(app: App, load_plugins):
 
 
     #加入公会测试
-    async with app.test_matcher(clanbattle_qq.create_clan) as ctx:
+    async with app.test_matcher(clanbattle_qq.worker) as ctx:
         bot = ctx.create_bot()
         msg = Message("创建台服公会")
         event = GroupMessageEvent(message=msg, group_id=114514,user_id=114514, self_id= 0, message_id=0,time=114514,post_type="message",sub_type="1",message_type="group",raw_message="创建台服公会",font=0,sender=Sender())
@@ -43,4 +44,162 @@ async def test_clanbattle(app: App, load_plugins):
         }])
         ctx.should_call_send(event, "公会创建成功，请发送“帮助”查看使用说明", True)
         ctx.should_call_send(event, "已经将全部群成员加入公会", True)
-        
\ No newline at end of file
+
+
+@pytest.fixture
+def clan_data(nonebug_init: None):
+    from .. import clanbattle
+
+    gid = "1919810"
+    if clanbattle.get_clan_data(gid):
+        clanbattle.delete_clan(gid)
+    clanbattle.create_clan(gid, "测试公会", "tw", ["114514"])
+    clan = clanbattle.get_clan_data(gid)
+    clan.add_clan_members([("114514", "先辈"), ("114515", "先辈2号")])
+    yield clan
+    clanbattle.delete_clan(gid)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_kill_record(clan_data):
+    from ..utils import CommitRecordResult
+
+    # 两条1周目1王的尾刀同时上报，伤害在持有锁后按当前血量计算，只有一条能击破
+    stage_table = clan_data.stage_table
+    results = await asyncio.gather(clan_data.commit_record("114514", 1, None, None, is_kill_boss=True, target_cycle=1),
+                                   clan_data.commit_record("114515", 1, None, None, is_kill_boss=True, target_cycle=1))
+    assert sorted(results, key=lambda result: result.value) == [CommitRecordResult.success, CommitRecordResult.boss_cycle_already_killed]
+    records = clan_data.get_record()
+    assert len(records) == 1
+    assert records[0].damage == stage_table.get_boss_hp(1, 1)
+    boss_status = clan_data.get_current_boss_state()[0]
+    assert (boss_status.target_cycle, boss_status.boss_hp) == (2, stage_table.get_boss_hp(stage_table.get_stage(2), 1))
+
+
+def get_boss_states(clan):
+    return [(boss.target_cycle, boss.boss_hp) for boss in clan.get_current_boss_state()]
+
+
+def assert_tracker_reloads(clan):
+    # 重新加载的状态应与增量更新的状态相同
+    from ..utils import BossStateTracker
+
+    tracker = clan.get_boss_state_tracker()
+    fresh = BossStateTracker(tracker.clan_gid, tracker.data_num)
+    fresh.load()
+    assert {boss: state.to_dict() for boss, state in fresh.boss_records.items()} == \
+        {boss: state.to_dict() for boss, state in tracker.boss_records.items()}
+    return fresh
+
+
+@pytest.mark.asyncio
+async def test_boss_state_snapshot_undo(clan_data, monkeypatch):
+    from ..config import get_config
+    from ..db import BossStateSnapshot
+    from ..utils import AsyncClanBattleData, CommitRecordResult
+
+    monkeypatch.setattr(get_config(), "boss_state_snapshot_interval", 2)
+    clan = AsyncClanBattleData(clan_data)
+    stage_table = clan_data.stage_table
+    full_hp = [stage_table.get_boss_hp(1, boss) for boss in range(1, 6)]
+    initial = get_boss_states(clan_data)
+    assert await clan_data.commit_record("114514", 1, "100", None) == CommitRecordResult.success
+    assert await clan_data.commit_record("114515", 2, "200", None) == CommitRecordResult.success
+    assert await clan_data.commit_record("114514", 1, None, None, is_kill_boss=True, target_cycle=1) == CommitRecordResult.success
+    assert await clan_data.commit_record("114515", 3, "300", None) == CommitRecordResult.success
+    killed = get_boss_states(clan_data)
+    assert killed[:3] == [(2, stage_table.get_boss_hp(stage_table.get_stage(2), 1)), (1, full_hp[1] - 200), (1, full_hp[2] - 300)]
+    snapshots = BossStateSnapshot.select().where(BossStateSnapshot.clan_gid == clan_data.clan_info.clan_gid)
+    # 第一次追加事件时保存的初始快照和每2个事件保存的快照
+    assert snapshots.count() == 3
+    assert assert_tracker_reloads(clan_data).events_since_snapshot == 0
+    # 撤销最后一个快照之后的出刀，重新加载时从快照之后重放撤销事件
+    assert await clan.delete_recent_record("114515")
+    assert get_boss_states(clan_data) == killed[:2] + [initial[2]] + killed[3:]
+    fresh = assert_tracker_reloads(clan_data)
+    assert fresh.events_since_snapshot == 1 and fresh.has_snapshot
+    # 撤销快照之前的尾刀和报刀
+    assert await clan.delete_recent_record("114514")
+    assert get_boss_states(clan_data)[0] == (1, full_hp[0] - 100)
+    assert_tracker_reloads(clan_data)
+    assert await clan.delete_recent_record("114514")
+    assert await clan.delete_recent_record("114515")
+    assert get_boss_states(clan_data) == initial
+    assert_tracker_reloads(clan_data)
+    assert not clan_data.get_record()
+
+
+@pytest.mark.asyncio
+async def test_boss_state_legacy_archive(clan_data):
+    import datetime
+    from ..db import BattleRecord, BossStateSnapshot
+    from ..utils import AsyncClanBattleData, CommitRecordResult
+
+    full_hp = clan_data.stage_table.get_boss_hp(1, 1)
+    # 旧版本的档案只有出刀记录，没有事件和快照
+    BattleRecord.create(clan_gid=clan_data.clan_info.clan_gid, member_uid="114514", using_data_num=clan_data.clan_info.current_using_data_num,
+                        target_cycle=1, target_boss=1, boss_hp=full_hp, damage=100, record_time=datetime.datetime.utcnow(),
+                        is_extra_time=False, remain_next_chance=False)
+    clan_data.get_boss_state_tracker().reset()
+    assert get_boss_states(clan_data)[0] == (1, full_hp - 100)
+    snapshots = BossStateSnapshot.select().where(BossStateSnapshot.clan_gid == clan_data.clan_info.clan_gid)
+    assert snapshots.count() == 0
+    assert await clan_data.commit_record("114515", 1, "50", None) == CommitRecordResult.success
+    # 第一个事件之前保存由出刀记录得到的初始快照
+    assert [snapshot.last_event_id for snapshot in snapshots] == [0]
+    assert get_boss_states(clan_data)[0] == (1, full_hp - 150)
+    assert_tracker_reloads(clan_data)
+    assert await AsyncClanBattleData(clan_data).delete_recent_record("114515")
+    assert get_boss_states(clan_data)[0] == (1, full_hp - 100)
+    assert_tracker_reloads(clan_data)
+
+
+def test_command_dispatcher_match(nonebug_init: None):
+    from .. import clanbattle_qq
+
+    dispatcher = clanbattle_qq.dispatcher
+    messages = ["创建台服公会", "报刀 1 500w", "2尾刀", "尾刀 3:备注", "状态", "查", "查刀", "申请出刀1", "进2",
+                "取消申请", "解锁", "取消申请了吗", "帮我解锁", "挂树 3", "下树", "预约 5 3", "撤回", "sl 2", "查SL", "今日出刀",
+                "批量报刀\n123456 1 100w", "切换会战档案 2", "会战统计", "加入公会", "[CQ:at,qq=114514] 报刀", "", "随便说点什么"]
+    for text in messages:
+        # 按首字符预筛选后的结果应与逐条匹配全部指令相同
+        expected = [(command, command.pattern.search(text)) for command in dispatcher.commands]
+        expected = [(command, matched.group()) for command, matched in expected if matched]
+        assert [(command, matched.group()) for command, matched in dispatcher.match(text)] == expected, text
+
+
+@pytest.mark.asyncio
+async def test_batch_record_rollback(clan_data):
+    from ..utils import CommitRecordResult
+
+    def get_boss_state():
+        return [(boss.target_cycle, boss.boss_hp) for boss in clan_data.get_current_boss_state()]
+
+    boss_state = get_boss_state()
+    # 第二条超出血量时第一条也不保存
+    records = [("114514", 1, "100", False), ("114515", 2, str(boss_state[1][1] + 1), False)]
+    assert await clan_data.commit_records(records, "114514") == (CommitRecordResult.damage_out_of_hp, 1)
+    assert get_boss_state() == boss_state
+    assert not clan_data.get_record()
+    records = [("114514", 1, "100", False), ("114515", 1, None, True)]
+    assert await clan_data.commit_records(records, "114514") == (CommitRecordResult.success, None)
+    assert get_boss_state()[0] == (2, boss_state[0][1])
+    assert [record.damage for record in clan_data.get_record()] == [100, boss_state[0][1] - 100]
+
+
+def test_batch_record_pattern(nonebug_init: None):
+    from .. import batch_record_pattern
+
+    lines = {
+        "[CQ:at,qq=114514] 1 500w": ("114514", None, "1", "500w"),
+        "114514 3 1234567": (None, "114514", "3", "1234567"),
+        "114514 尾刀": (None, "114514", None, "尾刀"),
+        "[CQ:at,qq=114515]2 尾刀": ("114515", None, "2", "尾刀"),
+        "114514 1.5kw": None,
+        "1145 1 500w": None,
+        "114514 6 500w": None,
+        "114514 1 伤害": None,
+    }
+    for line, groups in lines.items():
+        matched = batch_record_pattern.match(line)
+        assert (matched.groups() if matched else None) == groups, line
@@ -0,0 +1,111 @@
+import datetime
+import sqlite3
+
+import pytest
+
+
+def test_create_database(nonebug_init: None, tmp_path):
+    from peewee import SqliteDatabase
+    from playhouse.pool import PooledPostgresqlDatabase
+    from ..config import DatabaseConfig
+    from ..db import create_database
+
+    database = create_database(DatabaseConfig(name=str(tmp_path / "clanbattle.db"), max_connections=3))
+    assert isinstance(database, SqliteDatabase)
+    assert database._max_connections == 3
+    with database.connection_context():
+        assert database.execute_sql("PRAGMA journal_mode").fetchone()[0] == "wal"
+    database.close_all()
+    # 只创建连接池，不会连接数据库
+    database = create_database(DatabaseConfig(backend="postgresql", name="clanbattle", user="yuki", port=5433))
+    assert isinstance(database, PooledPostgresqlDatabase)
+    assert database.connect_params["port"] == 5433
+    with pytest.raises(ValueError):
+        create_database(DatabaseConfig(backend="oracle"))
+
+
+def test_write_transaction(nonebug_init: None):
+    from ..db import clanbattle_db, db_path, ClanInfo, write_transaction
+
+    gid = "1919811"
+    ClanInfo.delete().where(ClanInfo.clan_gid == gid).execute()
+    with clanbattle_db.connection_context():
+        with write_transaction(gid):
+            # 事务开始时即取得写锁，其它连接无法写入
+            other = sqlite3.connect(db_path, timeout=0)
+            with pytest.raises(sqlite3.OperationalError):
+                other.execute("BEGIN IMMEDIATE")
+            other.close()
+            ClanInfo.create(clan_gid=gid, clan_name="测试公会", clan_type="tw", clan_admin="",
+                            create_time=datetime.datetime.utcnow())
+        with pytest.raises(RuntimeError):
+            with write_transaction(gid):
+                ClanInfo.update(clan_name="已修改").where(ClanInfo.clan_gid == gid).execute()
+                raise RuntimeError()
+        assert ClanInfo.get(ClanInfo.clan_gid == gid).clan_name == "测试公会"
+        ClanInfo.delete().where(ClanInfo.clan_gid == gid).execute()
+
+
+def test_copy_database(nonebug_init: None, tmp_path):
+    from peewee import SqliteDatabase
+    from ..db import all_models, copy_database, ClanInfo, User, BattleRecord
+
+    source = SqliteDatabase(str(tmp_path / "source.db"))
+    target = SqliteDatabase(str(tmp_path / "target.db"))
+    with source.bind_ctx(all_models):
+        source.create_tables(all_models)
+        ClanInfo.create(clan_gid="1", clan_name="测试公会", clan_type="tw", clan_admin="", create_time=datetime.datetime.utcnow())
+        User.insert_many([{"qq_uid": str(uid), "uname": f"成员{uid}"} for uid in range(5)]).execute()
+        # 删除中间的行，复制后主键不变
+        User.delete().where(User.qq_uid == "2").execute()
+        for i in range(7):
+            BattleRecord.create(clan_gid="1", member_uid=str(i % 5), target_boss=i % 5 + 1, target_cycle=1,
+                                boss_hp=6000000, damage=i * 1000, using_data_num=1, record_time=datetime.datetime.utcnow(),
+                                is_extra_time=False, remain_next_chance=False)
+        expected = {model: list(model.select().order_by(model.id).tuples()) for model in (ClanInfo, User, BattleRecord)}
+    copied = copy_database(source, target, batch_size=2)
+    assert copied["user"] == 4 and copied["battle_record"] == 7
+    with target.bind_ctx(all_models):
+        for model, rows in expected.items():
+            assert list(model.select().order_by(model.id).tuples()) == rows
+    with pytest.raises(ValueError):
+        copy_database(source, target)
+    with source.bind_ctx(all_models):
+        source.drop_tables([BattleRecord])
+    with pytest.raises(ValueError):
+        copy_database(source, SqliteDatabase(str(tmp_path / "empty.db")))
+
+
+def test_migrate_clan_membership(nonebug_init: None, tmp_path):
+    from peewee import SqliteDatabase
+    from ..db import all_models, migrate_clan_membership, sync_legacy_membership, has_legacy_membership, ClanInfo, ClanMembership, User
+
+    def get_membership():
+        return set(ClanMembership.select(ClanMembership.clan_gid, ClanMembership.member_uid, ClanMembership.role).tuples())
+
+    database = SqliteDatabase(str(tmp_path / "legacy.db"))
+    with database.bind_ctx(all_models):
+        database.create_tables(all_models)
+        assert not has_legacy_membership()
+        ClanInfo.create(clan_gid="1", clan_name="测试公会", clan_type="tw", clan_admin="10", clan_members="10|11",
+                        create_time=datetime.datetime.utcnow())
+        User.insert_many([{"qq_uid": "10", "clan_joined": "1"}, {"qq_uid": "11", "clan_joined": "1"},
+                          {"qq_uid": "12", "clan_joined": "1|2"}]).execute()
+        assert has_legacy_membership()
+        assert migrate_clan_membership() == 4
+        assert get_membership() == {("1", "10", "member"), ("1", "11", "member"), ("1", "12", "member"), ("1", "10", "admin")}
+        # 旧字段与 ClanMembership 一致时重复执行不做修改
+        assert migrate_clan_membership() == 0
+        # 新版本删除成员时同步更新旧字段
+        ClanMembership.delete().where(ClanMembership.member_uid == "11").execute()
+        sync_legacy_membership("1", ["11"])
+        assert ClanInfo.get(ClanInfo.clan_gid == "1").clan_members == "10|12"
+        assert User.get(User.qq_uid == "11").clan_joined is None
+        assert migrate_clan_membership() == 0
+        # 回退到旧版本后修改的成员在再次升级时同步回来
+        ClanInfo.update(clan_members="10|13").where(ClanInfo.clan_gid == "1").execute()
+        User.update(clan_joined="2").where(User.qq_uid == "12").execute()
+        User.create(qq_uid="13", clan_joined="1")
+        assert migrate_clan_membership() == 2
+        assert get_membership() == {("1", "10", "member"), ("1", "13", "member"), ("1", "10", "admin")}
+    database.close()
@@ -0,0 +1,85 @@
+import csv
+import datetime
+import io
+import json
+
+import pytest
+
+
+gid = "1919814"
+
+
+@pytest.fixture
+def export_records(nonebug_init: None):
+    from ..db import BattleRecord
+
+    def clear():
+        BattleRecord.delete().where(BattleRecord.clan_gid.in_([gid, gid + "0"])).execute()
+
+    def create(count: int) -> list:
+        clear()
+        start_time = datetime.datetime(2026, 1, 1, 12, 0)
+        base = {"clan_gid": gid, "member_uid": "2000", "record_time": start_time, "using_data_num": 1, "target_cycle": 1,
+                "target_boss": 1, "boss_hp": 6000000, "damage": 1000, "is_extra_time": False, "remain_next_chance": False}
+        rows = [dict(base, member_uid=str(2000 + i % 3), record_time=start_time + datetime.timedelta(minutes=i),
+                     target_boss=i % 5 + 1, damage=1000 * (i + 1), comment="备注,含逗号" if i == 0 else None,
+                     is_extra_time=i % 2 == 1) for i in range(count)]
+        # 其它档案和其它公会的记录插在中间，不会导出
+        others = [dict(base, using_data_num=2), dict(base, clan_gid=gid + "0")]
+        for row in rows[:2] + others + rows[2:]:
+            BattleRecord.create(**row)
+        return [record.id for record in BattleRecord.select().where(
+            (BattleRecord.clan_gid == gid) & (BattleRecord.using_data_num == 1)).order_by(BattleRecord.id)]
+
+    yield create
+    clear()
+
+
+def run_exporter(export_format: str) -> bytes:
+    from ..db import BattleRecord
+    from ..export import TableExporter
+
+    exporter = TableExporter(BattleRecord, gid, 1, export_format, batch_size=2)
+    chunks = list(exporter)
+    assert exporter.finished and exporter.next_chunk() is None
+    return b"".join(chunks)
+
+
+# 0 条、恰好为 batch_size 整数倍和最后一批不满的情况
+@pytest.mark.parametrize("count", [0, 4, 5])
+def test_export_csv(export_records, count):
+    from ..db import BattleRecord
+
+    ids = export_records(count)
+    text = run_exporter("csv").decode("utf-8")
+    assert text.startswith("\ufeff") and text.count("\ufeff") == 1
+    rows = list(csv.reader(io.StringIO(text[1:])))
+    header = [field.name for field in BattleRecord._meta.sorted_fields]
+    assert rows[0] == header
+    assert rows.count(header) == 1
+    assert [int(row[0]) for row in rows[1:]] == ids
+    if count:
+        assert rows[1][header.index("comment")] == "备注,含逗号"
+
+
+@pytest.mark.parametrize("count", [0, 4, 5])
+def test_export_ndjson(export_records, count):
+    ids = export_records(count)
+    lines = run_exporter("ndjson").decode("utf-8").splitlines()
+    records = [json.loads(line) for line in lines]
+    assert [record["id"] for record in records] == ids
+    if count:
+        assert records[0]["record_time"] == "2026-01-01T12:00:00"
+        assert records[1]["is_extra_time"] is True
+
+
+@pytest.mark.parametrize("count", [0, 4, 5])
+def test_export_parquet(export_records, count):
+    parquet = pytest.importorskip("pyarrow.parquet")
+
+    ids = export_records(count)
+    table = parquet.read_table(io.BytesIO(run_exporter("parquet")))
+    assert table.num_rows == count
+    assert table.column("id").to_pylist() == ids
+    if count:
+        assert table.column("damage").to_pylist() == [1000 * (i + 1) for i in range(count)]
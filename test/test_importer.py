@@ -0,0 +1,130 @@
+import csv
+import datetime
+import json
+
+import pytest
+
+
+gid = "1919813"
+member_uids = ["2001", "2002"]
+start_time = datetime.datetime(2026, 1, 1, 2, 0)
+
+
+@pytest.fixture
+def import_clan(nonebug_init: None):
+    from .. import clanbattle
+    from ..db import User
+
+    def clear():
+        if clanbattle.get_clan_data(gid):
+            clanbattle.delete_clan(gid)
+        User.delete().where(User.qq_uid.in_(member_uids)).execute()
+
+    clear()
+    yield
+    clear()
+
+
+def get_boss_hp(clan_type: str, cycle: int, boss: int) -> int:
+    from .. import utils
+
+    stage_table = utils.stage_tables[clan_type]
+    return stage_table.get_boss_hp(stage_table.get_stage(cycle), boss)
+
+
+def make_row(minutes: int, member_uid: str, target_boss: int, damage: int, **fields) -> dict:
+    row = {"clan_gid": gid, "member_uid": member_uid, "record_time": (start_time + datetime.timedelta(minutes=minutes)).isoformat(),
+           "target_boss": target_boss, "damage": damage}
+    row.update(fields)
+    return row
+
+
+def write_csv(path, rows):
+    fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+    return str(path)
+
+
+def write_ndjson(path, rows):
+    with open(path, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+    return str(path)
+
+
+def test_import_records(import_clan, tmp_path):
+    from .. import clanbattle
+    from ..db import DailyMemberSummary
+    from ..importer import import_records
+
+    kill_hp = get_boss_hp("tw", 1, 1)
+    rows = [make_row(0, "2001", 1, 100, member_name="先辈"),
+            make_row(1, "2002", 1, kill_hp - 100, boss_hp=kill_hp - 100, target_cycle=1),
+            # 未提供是否为补偿刀，按击破留下的补偿刀推算
+            make_row(2, "2002", 2, 500)]
+    result = import_records(write_csv(tmp_path / "records.csv", rows), clan_type="tw", batch_size=2)
+    assert result == {"battle_record": 3, "user": 2, "clan_membership": 2, "daily_member_summary": 2}
+    clanbattle.reload_clan(gid)
+    clan = clanbattle.get_clan_data(gid)
+    assert [(record.member_uid, record.is_extra_time, record.remain_next_chance) for record in clan.get_record()] == \
+        [("2001", False, False), ("2002", False, True), ("2002", True, False)]
+    summaries = {summary.member_uid: summary for summary in DailyMemberSummary.select().where(DailyMemberSummary.clan_gid == gid)}
+    assert (summaries["2001"].total_challenge, summaries["2001"].total_damage) == (1, 100)
+    assert (summaries["2002"].total_challenge, summaries["2002"].addition_challenge,
+            summaries["2002"].remain_addition_challenge, summaries["2002"].total_damage) == (1, 1, 0, kill_hp - 100 + 500)
+    boss_state = clan.get_current_boss_state()
+    assert (boss_state[0].target_cycle, boss_state[0].boss_hp) == (2, get_boss_hp("tw", 2, 1))
+    assert (boss_state[1].target_cycle, boss_state[1].boss_hp) == (1, get_boss_hp("tw", 1, 2) - 500)
+    assert sorted(clan.get_clan_members()) == member_uids
+
+
+def test_import_records_ndjson(import_clan, tmp_path):
+    from .. import clanbattle
+    from ..importer import import_records
+
+    rows = [make_row(0, "2001", 3, 300, clan_type="jp", is_extra_time=False, remain_next_chance=False, comment="备注")]
+    assert import_records(write_ndjson(tmp_path / "records.ndjson", rows))["battle_record"] == 1
+    clan = clanbattle.get_clan_data(gid)
+    assert clan.clan_info.clan_type == "jp"
+    assert clan.get_record()[0].comment == "备注"
+
+
+@pytest.mark.parametrize("bad_row", [
+    make_row(-1, "2002", 2, 100),
+    make_row(1, "2002", 1, 100, boss_hp=1),
+    make_row(1, "2002", 1, 100, target_cycle=2),
+    make_row(1, "2002", 2, 100, is_extra_time=True, remain_next_chance=False),
+    make_row(1, "2002", 2, 100, is_extra_time=False, remain_next_chance=True),
+])
+def test_import_records_rollback(import_clan, tmp_path, bad_row):
+    from ..db import ClanInfo, BattleRecord, User
+    from ..exception import ClanBattleImportException
+    from ..importer import import_records
+
+    # 时间倒序、血量或周目与boss状态不一致、补偿刀不合法时整批回滚，已写入的记录和新建的公会也不会保存
+    rows = [make_row(0, "2001", 1, 100), bad_row]
+    with pytest.raises(ClanBattleImportException) as exc_info:
+        import_records(write_ndjson(tmp_path / "records.ndjson", rows), clan_type="tw", batch_size=1)
+    assert exc_info.value.line_num == 2
+    assert not ClanInfo.select().where(ClanInfo.clan_gid == gid).exists()
+    assert not BattleRecord.select().where(BattleRecord.clan_gid == gid).exists()
+    assert not User.select().where(User.qq_uid.in_(member_uids)).exists()
+
+
+@pytest.mark.asyncio
+async def test_import_records_non_empty_archive(import_clan, tmp_path):
+    from .. import clanbattle
+    from ..exception import ClanBattleImportException
+    from ..importer import import_records
+
+    clanbattle.create_clan(gid, "测试公会", "tw", [])
+    clan = clanbattle.get_clan_data(gid)
+    clan.add_clan_members([("2001", "先辈")])
+    await clan.commit_record("2001", 1, "100", None)
+    with pytest.raises(ClanBattleImportException) as exc_info:
+        import_records(write_csv(tmp_path / "records.csv", [make_row(0, "2002", 2, 100)]))
+    assert exc_info.value.line_num == 1
+    assert [record.member_uid for record in clan.get_record()] == ["2001"]
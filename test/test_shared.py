@@ -0,0 +1,61 @@
+import pytest
+
+
+@pytest.fixture
+def shared_backend(nonebug_init: None):
+    from ..shared import shared_state, MemorySharedBackend
+
+    backend = MemorySharedBackend()
+    shared_state.start(backend)
+    yield backend
+    shared_state.stop()
+
+
+def test_session_cache(shared_backend):
+    from ..utils import SessionCache
+
+    # 两个实例模拟两个机器人进程的本地缓存
+    cache, other_cache = SessionCache(), SessionCache()
+    cache.set("session", "114514", ["1919810"])
+    assert other_cache.get("session") == ("114514", ["1919810"])
+    cache.invalidate("114514")
+    other_cache.invalidate_local("114514")
+    assert other_cache.get("session") is None
+    cache.set("session", "114514", ["1919810"])
+    cache.invalidate()
+    assert other_cache.get("session") is None
+
+
+def test_shared_event_round_trip(shared_backend):
+    from .. import clanbattle
+    from ..db import BattleRecord
+    from ..shared import shared_state, SharedState
+
+    gid = "1919812"
+    if clanbattle.get_clan_data(gid):
+        clanbattle.delete_clan(gid)
+    clanbattle.create_clan(gid, "测试公会", "tw", ["114514"])
+    clan = clanbattle.get_clan_data(gid)
+    # 另一个进程收到通知后清除同一公会的本地缓存
+    other_state = SharedState()
+    other_state.add_listener(clanbattle.on_shared_event)
+    other_state.start(shared_backend)
+    received = []
+    shared_state.add_listener(received.append)
+    try:
+        clan.get_record()
+        clan.get_clan_admins()
+        cache_size = clan.get_cache_stats()["size"]
+        clan.share_tables_changed(frozenset([BattleRecord]))
+        assert shared_state.get_int(f"clan:{gid}:version") == 1
+        assert other_state.received_count == 1
+        assert clan.get_cache_stats()["size"] == cache_size - 1
+        # 本进程发出的通知不会再由本进程处理
+        assert received == [] and shared_state.received_count == 0
+        other_state.publish("all_clans", tables=[])
+        assert shared_state.received_count == 1 and other_state.received_count == 1
+        assert received[0]["node"] == other_state.node_id
+        assert clan.get_cache_stats()["size"] == 0
+    finally:
+        shared_state.listeners.remove(received.append)
+        clanbattle.delete_clan(gid)
@@ -0,0 +1,74 @@
+import datetime
+
+import pytest
+
+
+np = pytest.importorskip("numpy")
+
+
+def reference_group(rows: list) -> dict:
+    # 逐条记录计算的统计结果，用于核对按列的向量运算
+    damages = [row[2] for row in rows]
+    extra = [row for row in rows if row[4]]
+    earned = sum(1 for row in rows if row[5])
+    return {
+        "count": len(rows),
+        "full_challenge": len(rows) - len(extra),
+        "addition_challenge": len(extra),
+        "total_damage": sum(damages),
+        "average_damage": sum(damages) / len(rows),
+        "kills": sum(1 for row in rows if row[2] == row[3] and row[2] > 0),
+        "damage_percentiles": {f"p{p}": float(np.percentile(damages, p)) for p in (10, 25, 50, 75, 90)},
+        "compensation_earned": earned,
+        "compensation_used": len(extra),
+        "compensation_efficiency": len(extra) / earned if earned else None,
+        "compensation_average_damage": sum(row[2] for row in extra) / len(extra) if extra else None,
+    }
+
+
+def reference_groups(rows: list, key_index: int) -> dict:
+    groups = {}
+    for row in rows:
+        groups.setdefault(str(row[key_index]), []).append(row)
+    return {key: reference_group(group) for key, group in groups.items()}
+
+
+def test_compute_statistics(nonebug_init: None):
+    from ..db import get_battle_day_offset
+    from ..stats import compute_statistics
+
+    start_time = datetime.datetime(2026, 1, 1, 12, 0)
+    hour = datetime.timedelta(hours=1)
+    # (member_uid, target_boss, damage, boss_hp, is_extra_time, remain_next_chance, record_time)
+    rows = [
+        ("2001", 1, 1000, 6000000, False, False, start_time),
+        ("2001", 1, 6000000 - 1000, 6000000 - 1000, False, True, start_time + hour),
+        ("2001", 2, 2500, 8000000, True, False, start_time + 2 * hour),
+        ("2002", 2, 4000, 8000000 - 2500, False, False, start_time + 3 * hour),
+        ("2002", 3, 0, 10000000, False, False, start_time + 24 * hour),
+        ("2002", 2, 7000, 8000000 - 6500, False, False, start_time + 25 * hour),
+        # 只有一条记录的成员和boss
+        ("2003", 4, 12345, 12000000, False, False, start_time + 26 * hour),
+    ]
+    statistics = compute_statistics(rows, "tw")
+    assert statistics["record_count"] == len(rows)
+    assert statistics["total"] == reference_group(rows)
+    assert statistics["members"] == reference_groups(rows, 0)
+    assert statistics["bosses"] == reference_groups(rows, 1)
+    assert statistics["members"]["2003"]["damage_percentiles"] == {f"p{p}": 12345.0 for p in (10, 25, 50, 75, 90)}
+    days = {}
+    for row in rows:
+        day = days.setdefault(str((row[6] + get_battle_day_offset("tw")).date()),
+                              {"members": set(), "full_challenge": 0, "total_damage": 0})
+        day["members"].add(row[0])
+        day["full_challenge"] += not row[4]
+        day["total_damage"] += row[2]
+    assert statistics["days"] == [{"date": date, "members": len(day["members"]), "full_challenge": day["full_challenge"],
+                                   "total_damage": day["total_damage"]} for date, day in sorted(days.items())]
+    assert len(statistics["days"]) == 2
+
+
+def test_compute_statistics_empty(nonebug_init: None):
+    from ..stats import compute_statistics
+
+    assert compute_statistics([], "tw") == {"record_count": 0, "total": None, "members": {}, "bosses": {}, "days": []}
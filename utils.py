@@ -4,14 +4,24 @@ from typing import Dict, List
 import datetime
 import nonebot
 from enum import Enum
-from functools import wraps
+from functools import wraps, partial
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import weakref
+import bisect
+import threading
+import time
 
 from nonebot.adapters.onebot.v11 import Bot
 from nonebot.adapters.onebot.v11 import Message, MessageSegment
-from peewee import _BoundModelsContext
-from .db import BaseModel, User, ClanInfo, BattleOnTree, BattleRecord, BattleInProgress, BattleSL, BattleSubscribe
-from .exception import ClanBattleException, ClanBattleDamageParseException
-from typing import Any, List, Union, Optional, Tuple
+from peewee import _BoundModelsContext, ModelSelect
+from .db import clanbattle_db, run_with_connection, rebuild_daily_summary, sync_legacy_membership, write_transaction, is_sqlite, all_models, BaseModel, User, ClanInfo, BattleOnTree, BattleRecord, BattleInProgress, BattleSL, BattleSubscribe, ClanMembership, BattleEvent, BossStateSnapshot, DailyMemberSummary, get_battle_date, get_battle_day_datetime
+from .push import push_hub
+from .dispatcher import message_dispatcher
+from .shared import shared_state
+from .stats import compute_statistics
+from .exception import ClanBattleException, ClanBattleDamageParseException, ClanBattleBatchRecordException
+from typing import Any, Callable, List, Union, Optional, Tuple, Type
 import json
 import uuid
 import hashlib
@@ -38,6 +48,71 @@ class BossInfo(pydantic.BaseModel):
 boss_info: dict = None
 
 
+class StageTable:
+    # 某个服务器的阶段表，由配置文件中的 boss_info 生成，生成后不再修改
+
+    __slots__ = ("stage_start_cycles", "boss_hp")
+
+    def __init__(self, stage_start_cycles: List[int], boss_hp: List[List[int]]) -> None:
+        if not stage_start_cycles or list(stage_start_cycles) != sorted(set(stage_start_cycles)):
+            raise ValueError("各阶段的起始周目必须递增")
+        if len(boss_hp) != len(stage_start_cycles) or any(len(stage_hp) != 5 for stage_hp in boss_hp):
+            raise ValueError("每个阶段必须配置5个boss的血量")
+        self.stage_start_cycles: Tuple[int, ...] = tuple(stage_start_cycles)
+        self.boss_hp: Tuple[Tuple[int, ...], ...] = tuple(tuple(stage_hp) for stage_hp in boss_hp)
+
+    @property
+    def stage_count(self) -> int:
+        return len(self.stage_start_cycles)
+
+    def get_stage(self, cycle: int) -> int:
+        stage = bisect.bisect_right(self.stage_start_cycles, cycle)
+        if stage == 0:
+            raise ClanBattleException("cycle error")
+        return stage
+
+    def get_boss_hp(self, stage: int, boss: int) -> int:
+        return self.boss_hp[stage-1][boss-1]
+
+
+stage_tables: Dict[str, StageTable] = {}
+
+_cache_miss = object()
+
+battle_models = [BattleRecord, BattleInProgress, BattleSL, BattleSubscribe, BattleOnTree, BattleEvent, BossStateSnapshot, DailyMemberSummary]
+
+table_models: Dict[str, Type[BaseModel]] = {model._meta.table_name: model for model in all_models}
+
+# 报刀、击杀等操作附带删除挂树、预约和出刀申请时记录的事件，与对应的取消指令相同
+removal_event_types: Dict[Type[BaseModel], str] = {BattleOnTree: "off_tree", BattleSubscribe: "unsubscribe", BattleInProgress: "unqueue"}
+
+db_executor: ThreadPoolExecutor = None
+db_executor_lock = threading.Lock()
+
+
+def get_db_executor() -> ThreadPoolExecutor:
+    global db_executor
+    with db_executor_lock:
+        if not db_executor:
+            db_executor = ThreadPoolExecutor(
+                max_workers=get_config().db_worker_num, thread_name_prefix="clanbattle_db")
+        return db_executor
+
+
+async def run_in_db_thread(func, *args, **kwargs):
+    # 数据库操作均为同步阻塞调用，放到线程池执行以免阻塞事件循环
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_db_executor(), partial(run_with_connection, func, *args, **kwargs))
+
+
+def shutdown_db_executor():
+    global db_executor
+    with db_executor_lock:
+        if db_executor:
+            db_executor.shutdown(wait=True)
+            db_executor = None
+
+
 class BossStatus:
     target_cycle: int
     stage: int
@@ -87,6 +162,7 @@ class CommitRecordResult(Enum):
     member_not_in_clan = 4
     boss_not_challengeable = 5
     on_another_tree = 6
+    boss_cycle_already_killed = 7
 
 
 class CommitInProgressResult(Enum):
@@ -128,45 +204,521 @@ class NewRecordLegalCheckResult(Enum):
     boss_not_challengeable = 2
 
 
+class ResultCache:
+    # 读取结果缓存，每条结果记录其依赖的数据表，写入某张表时只清除依赖该表的结果
+    # 其它公会的数据库线程和共享缓存的订阅线程也会清除缓存，因此各操作自行加锁，不依赖公会锁
+
+    def __init__(self, max_size: int = 512) -> None:
+        self.max_size = max_size
+        self.entries: "OrderedDict[Any, Tuple[Any, frozenset]]" = OrderedDict()
+        self.lock = threading.Lock()
+        # 每次清除时递增，读取期间发生过清除的结果不再写入缓存
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, tables: frozenset, generation: int = None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = (value, tables)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, tables: frozenset = None):
+        with self.lock:
+            self.generation += 1
+            if not tables:
+                self.entries.clear()
+                return
+            for key in [key for key, entry in self.entries.items() if entry[1] & tables]:
+                del self.entries[key]
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"size": len(self.entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+class SessionCache:
+    # Web 会话缓存：session -> (过期时间, uid, 已加入的公会列表)
+    # 启用共享缓存时同时写入共享缓存，其它进程修改会话或成员时通过失效通知清除本进程的缓存
+
+    def __init__(self) -> None:
+        self.entries: Dict[str, Tuple[float, str, List[str]]] = {}
+        self.lock = threading.Lock()
+
+    def get_local(self, session: str) -> Optional[Tuple[str, List[str]]]:
+        with self.lock:
+            entry = self.entries.get(session)
+            if not entry:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[session]
+                return None
+            return entry[1], list(entry[2])
+
+    def get(self, session: str) -> Optional[Tuple[str, List[str]]]:
+        if cached := self.get_local(session):
+            return cached
+        if not shared_state.enabled or not (data := shared_state.get_json(self.shared_key(session))):
+            return None
+        self.set_local(session, data[0], data[1], get_config().web_session_cache_ttl)
+        return data[0], list(data[1])
+
+    @staticmethod
+    def shared_key(session: str) -> str:
+        # 全部会话失效时递增版本号，旧版本的缓存不会再被读取
+        return f"session:{shared_state.get_int('session_version')}:{session}"
+
+    def set_local(self, session: str, uid: str, joined_clan: List[str], ttl: int):
+        with self.lock:
+            self.entries[session] = (time.monotonic() + ttl, uid, list(joined_clan))
+
+    def set(self, session: str, uid: str, joined_clan: List[str]):
+        ttl = get_config().web_session_cache_ttl
+        if ttl <= 0:
+            return
+        self.set_local(session, uid, joined_clan, ttl)
+        if shared_state.enabled:
+            key = self.shared_key(session)
+            shared_state.set_json(key, [uid, joined_clan], ttl)
+            shared_state.set_json(f"session_uid:{uid}", key, ttl)
+
+    def invalidate_local(self, uid: str = None):
+        with self.lock:
+            if uid is None:
+                self.entries.clear()
+                return
+            for session in [session for session, entry in self.entries.items() if entry[1] == uid]:
+                del self.entries[session]
+
+    def invalidate(self, uid: str = None):
+        self.invalidate_local(uid)
+        if not shared_state.enabled:
+            return
+        if uid is None:
+            shared_state.incr("session_version")
+        elif key := shared_state.get_json(f"session_uid:{uid}"):
+            shared_state.delete(key, f"session_uid:{uid}")
+        shared_state.publish("session", uid=uid)
+
+
+class BossRecordState:
+    # 某个boss最近一次变化后的状态，字段与出刀记录相同；seq 为产生该状态的事件编号，由出刀记录得到的初始状态为 0
+    __slots__ = ("seq", "id", "target_boss", "target_cycle", "boss_hp", "damage", "record_time")
+
+    def __init__(self, target_boss: int, target_cycle: int, boss_hp: int, damage: int, record_time: datetime.datetime, id: int = None, seq: int = 0) -> None:
+        self.seq = seq
+        self.id = id
+        self.target_boss = target_boss
+        self.target_cycle = target_cycle
+        self.boss_hp = boss_hp
+        self.damage = damage
+        self.record_time = record_time
+
+    @staticmethod
+    def from_record(record: BattleRecord) -> "BossRecordState":
+        return BossRecordState(record.target_boss, record.target_cycle, record.boss_hp, record.damage, record.record_time, record.id)
+
+    @staticmethod
+    def from_dict(data: dict, seq: int = None) -> "BossRecordState":
+        return BossRecordState(data["target_boss"], data["target_cycle"], data["boss_hp"], data["damage"],
+                               datetime.datetime.fromisoformat(data["record_time"]), data["id"],
+                               data.get("seq", 0) if seq is None else seq)
+
+    def to_dict(self) -> dict:
+        return {"seq": self.seq, "id": self.id, "target_boss": self.target_boss, "target_cycle": self.target_cycle,
+                "boss_hp": self.boss_hp, "damage": self.damage, "record_time": self.record_time.isoformat()}
+
+    def sort_key(self) -> tuple:
+        return (self.seq, self.record_time, self.id or 0)
+
+
+class BossStateTracker:
+    # 每个boss的当前状态由最近的快照加上之后的状态事件重放得到，首次使用时加载一次，之后随追加的事件增量更新
+    # 尚无快照的档案（旧版本的数据）由出刀记录得到初始状态，第一次追加事件时保存为第一个快照
+
+    def __init__(self, clan_gid: str, data_num: int) -> None:
+        self.clan_gid = clan_gid
+        self.data_num = data_num
+        self.boss_records: Dict[int, BossRecordState] = None
+        self.events_since_snapshot = 0
+        self.last_event_id = 0
+        self.has_snapshot = False
+
+    def record_filter(self):
+        return (BattleRecord.clan_gid == self.clan_gid) & (BattleRecord.using_data_num == self.data_num)
+
+    def event_filter(self):
+        return (BattleEvent.clan_gid == self.clan_gid) & (BattleEvent.using_data_num == self.data_num)
+
+    @staticmethod
+    def is_newer(record: BossRecordState, current: BossRecordState) -> bool:
+        if not current:
+            return True
+        return record.sort_key() >= current.sort_key()
+
+    def load_query(self) -> ModelSelect:
+        latest = (BattleRecord
+                  .select(BattleRecord.target_boss, fn.MAX(BattleRecord.record_time).alias("latest_time"))
+                  .where(self.record_filter())
+                  .group_by(BattleRecord.target_boss))
+        records = (BattleRecord
+                   .select()
+                   .join(latest, on=((BattleRecord.target_boss == latest.c.target_boss)
+                                     & (BattleRecord.record_time == latest.c.latest_time)))
+                   .where(self.record_filter()))
+        return records
+
+    def reload_boss_query(self, boss: int) -> ModelSelect:
+        return BattleRecord.select().where(self.record_filter() & (BattleRecord.target_boss == boss)).order_by(
+            BattleRecord.record_time.desc(), BattleRecord.id.desc()).limit(1)
+
+    def snapshot_query(self, before_event_id: int = None) -> ModelSelect:
+        snapshots = BossStateSnapshot.select().where(
+            (BossStateSnapshot.clan_gid == self.clan_gid) & (BossStateSnapshot.using_data_num == self.data_num))
+        if before_event_id is not None:
+            snapshots = snapshots.where(BossStateSnapshot.last_event_id < before_event_id)
+        return snapshots.order_by(BossStateSnapshot.last_event_id.desc()).limit(1)
+
+    def event_query(self, after_event_id: int, before_event_id: int = None) -> ModelSelect:
+        events = BattleEvent.select().where(self.event_filter() & (BattleEvent.id > after_event_id)
+                                            & BattleEvent.boss_state.is_null(False))
+        if before_event_id is not None:
+            events = events.where(BattleEvent.id < before_event_id)
+        return events.order_by(BattleEvent.id)
+
+    def record_event_query(self, record_id: int) -> ModelSelect:
+        return BattleEvent.select().where(self.event_filter() & (BattleEvent.record_id == record_id)
+                                          & BattleEvent.event_type.in_(("report", "kill"))).limit(1)
+
+    def load_from_records(self) -> Dict[int, BossRecordState]:
+        boss_records = {}
+        for record in self.load_query():
+            state = BossRecordState.from_record(record)
+            if self.is_newer(state, boss_records.get(record.target_boss)):
+                boss_records[record.target_boss] = state
+        return boss_records
+
+    @staticmethod
+    def apply_event(boss_records: Dict[int, BossRecordState], event: BattleEvent):
+        # 空的状态表示恢复为该boss的初始状态
+        if state := json.loads(event.boss_state):
+            boss_records[event.target_boss] = BossRecordState.from_dict(state, event.id)
+        else:
+            boss_records.pop(event.target_boss, None)
+
+    def save_snapshot(self, boss_records: Dict[int, BossRecordState], last_event_id: int):
+        BossStateSnapshot.create(clan_gid=self.clan_gid, using_data_num=self.data_num, last_event_id=last_event_id,
+                                 boss_state=json.dumps({boss: state.to_dict() for boss, state in boss_records.items()}),
+                                 snapshot_time=datetime.datetime.utcnow())
+
+    def replay(self, before_event_id: int = None) -> Tuple[Dict[int, BossRecordState], int, int, bool]:
+        # 返回 (重放后的状态, 重放的事件数, 最后一个事件的编号, 是否从快照开始)，指定 before_event_id 时得到该事件之前的状态
+        # 只读取数据库，读取boss状态的接口不会写入
+        snapshot: BossStateSnapshot = self.snapshot_query(before_event_id).first()
+        if snapshot:
+            boss_records = {int(boss): BossRecordState.from_dict(state)
+                            for boss, state in json.loads(snapshot.boss_state).items()}
+            last_event_id = snapshot.last_event_id
+        else:
+            boss_records = self.load_from_records()
+            last_event_id = 0
+        replayed = 0
+        for event in self.event_query(last_event_id, before_event_id):
+            self.apply_event(boss_records, event)
+            last_event_id = event.id
+            replayed += 1
+        return boss_records, replayed, last_event_id, snapshot is not None
+
+    def load(self):
+        self.boss_records, self.events_since_snapshot, self.last_event_id, self.has_snapshot = self.replay()
+
+    def append_event(self, event_type: str, target_boss: int, state: Optional[BossRecordState], **fields) -> BattleEvent:
+        # 追加改变boss状态的事件，state 为空时该boss恢复为初始状态，每隔一定数量的事件保存一次快照
+        if self.boss_records is None:
+            self.load()
+        if not self.has_snapshot:
+            # 在写事务中保存第一个快照，撤销之后的事件时仍能得到由出刀记录计算的初始状态
+            self.save_snapshot(self.boss_records, self.last_event_id)
+            self.has_snapshot = True
+            self.events_since_snapshot = 0
+        event = BattleEvent.create(clan_gid=self.clan_gid, using_data_num=self.data_num, event_type=event_type,
+                                   target_boss=target_boss, event_time=datetime.datetime.utcnow(),
+                                   boss_state=json.dumps(state.to_dict() if state else {}), **fields)
+        self.apply_event(self.boss_records, event)
+        self.last_event_id = event.id
+        self.events_since_snapshot += 1
+        if self.events_since_snapshot >= get_config().boss_state_snapshot_interval:
+            self.save_snapshot(self.boss_records, event.id)
+            self.events_since_snapshot = 0
+        return event
+
+    def get_state_before_record(self, record: BattleRecord) -> Optional[BossRecordState]:
+        # 出刀记录对应的事件之前该boss的状态，记录早于事件日志时按剩余的出刀记录计算
+        event = self.record_event_query(record.id).first()
+        if event:
+            return self.replay(before_event_id=event.id)[0].get(record.target_boss)
+        result = self.reload_boss_query(record.target_boss)
+        return BossRecordState.from_record(result[0]) if result else None
+
+    def get_boss_record(self, boss: int) -> Optional[BossRecordState]:
+        if self.boss_records is None:
+            self.load()
+        return self.boss_records.get(boss)
+
+    def get_latest_record(self) -> Optional[BossRecordState]:
+        if self.boss_records is None:
+            self.load()
+        latest = None
+        for record in self.boss_records.values():
+            if self.is_newer(record, latest):
+                latest = record
+        return latest
+
+    def reset(self):
+        self.boss_records = None
+
+
 class ClanBattleData:
 
-    cache = {}
+    instances: "weakref.WeakSet[ClanBattleData]" = weakref.WeakSet()
 
     def __init__(self, gid: str) -> None:
         clan: ClanInfo = ClanInfo.get(ClanInfo.clan_gid == gid)
         if not clan:
             raise ClanBattleException("公会不存在")
         self.clan_info = clan
+        self.cache = ResultCache()
+        self.boss_state_tracker: BossStateTracker = None
+        # 同一公会的读写在线程池中串行执行，保证缓存和boss状态一致
+        self.lock = threading.RLock()
+        # 在事件循环中排队，避免等待同一公会的任务占满数据库线程池
+        self.async_lock: asyncio.Lock = None
+        self.async_lock_loop: asyncio.AbstractEventLoop = None
+        # 写事务中修改的表，提交后再通知其它进程
+        self.deferred_tables: set = None
+        self.last_access = time.monotonic()
+        ClanBattleData.instances.add(self)
+
+    def call_locked(self, func, *args, **kwargs):
+        with self.lock:
+            return func(*args, **kwargs)
+
+    def get_async_lock(self) -> asyncio.Lock:
+        # asyncio.Lock 与事件循环绑定，事件循环变化时需要重新创建
+        loop = asyncio.get_running_loop()
+        if self.async_lock_loop is not loop:
+            self.async_lock = asyncio.Lock()
+            self.async_lock_loop = loop
+        return self.async_lock
+
+    def in_use(self) -> bool:
+        if (self.async_lock and self.async_lock.locked()) or self.deferred_tables is not None:
+            return True
+        if not self.lock.acquire(blocking=False):
+            return True
+        self.lock.release()
+        return False
 
-    def cache_return(get_func):
-
-        @wraps(get_func)
-        def decorated(*args, **kwargs):
-            return get_func(*args, **kwargs)
-            cache_key = str(args) + str(kwargs) + str(get_func)
-            cache_obj: dict = args[0].cache
-            cache_res = cache_obj.get(cache_key, "@*^")
-            if cache_res != "@*^":
-                #print("cache hit")
-                return cache_res
-            else:
-                result = get_func(*args, **kwargs)
-                cache_obj[cache_key] = result
-                #print("cache not hit")
-                return result
-
-        return decorated
-
-    def clear_cache(get_func):
+    def reload_clan_info(self) -> bool:
+        # 公会信息被其它途径修改后重新读取并清除缓存，公会已被删除时返回 False
+        with self.lock:
+            clan_info = ClanInfo.get_or_none(ClanInfo.clan_gid == self.clan_info.clan_gid)
+            if not clan_info:
+                return False
+            self.clan_info = clan_info
+            self.cache.invalidate()
+            self.boss_state_tracker = None
+            return True
 
-        @wraps(get_func)
-        def decorated(*args, **kwargs):
-            ret = get_func(*args, **kwargs)
-            args[0].cache = {}
-            return ret
+    def invalidate(self, tables: frozenset = None):
+        with self.lock:
+            self.cache.invalidate(tables)
+            if not tables or tables & {BattleRecord, BattleEvent}:
+                self.get_boss_state_tracker().reset()
+
+    async def run_locked(self, func, *args, **kwargs):
+        async with self.get_async_lock():
+            return await run_in_db_thread(self.call_locked, func, *args, **kwargs)
+
+    def cache_return(*tables: Type[BaseModel]):
+        depend_tables = frozenset(tables)
+
+        def decorator(get_func):
+
+            @wraps(get_func)
+            def decorated(self: "ClanBattleData", *args, **kwargs):
+                cache_key = (get_func.__name__, self.clan_info.current_using_data_num,
+                             args, tuple(sorted(kwargs.items())))
+                try:
+                    cache_res = self.cache.get(cache_key, _cache_miss)
+                except TypeError:
+                    return get_func(self, *args, **kwargs)
+                if cache_res is _cache_miss:
+                    generation = self.cache.generation
+                    cache_res = get_func(self, *args, **kwargs)
+                    self.cache.set(cache_key, cache_res, depend_tables, generation)
+                # 返回列表的副本，避免调用方修改缓存内容
+                return list(cache_res) if isinstance(cache_res, list) else cache_res
+
+            return decorated
+
+        return decorator
+
+    def shared_return(dump: Callable = None, load: Callable = None):
+        # 多个进程共享的读取结果缓存，公会的任意数据修改后失效，仅用于无参数的方法；写事务中总是读取数据库
+        def decorator(get_func):
+
+            @wraps(get_func)
+            def decorated(self: "ClanBattleData"):
+                if not shared_state.enabled or clanbattle_db.in_transaction():
+                    return get_func(self)
+                key = self.shared_cache_key(get_func.__name__)
+                if (cached := shared_state.get_json(key)) is not None:
+                    return load(cached) if load else cached
+                ret = get_func(self)
+                shared_state.set_json(key, dump(ret) if dump else ret, get_config().shared_cache_ttl)
+                return ret
+
+            return decorated
+
+        return decorator
+
+    def clear_cache(*tables: Type[BaseModel]):
+        changed_tables = frozenset(tables)
+
+        def decorator(set_func):
+
+            @wraps(set_func)
+            def decorated(self: "ClanBattleData", *args, **kwargs):
+                try:
+                    return set_func(self, *args, **kwargs)
+                finally:
+                    self.tables_changed(changed_tables)
+
+            return decorated
+
+        return decorator
+
+    def serialized_commit(commit_func):
+
+        @wraps(commit_func)
+        def decorated(self: "ClanBattleData", *args, **kwargs):
+            # 读取-校验-写入在公会锁和同一事务中完成，避免并发提交时重复击杀boss
+            with self.lock:
+                self.deferred_tables = set()
+                try:
+                    with write_transaction(self.clan_info.clan_gid):
+                        if shared_state.enabled:
+                            # 其它进程的修改可能还未通知到本进程，取得写锁后从数据库重新读取
+                            self.cache.invalidate()
+                            self.get_boss_state_tracker().reset()
+                        return commit_func(self, *args, **kwargs)
+                except:
+                    # 事务已回滚，缓存和boss状态可能包含未提交的数据
+                    self.cache.invalidate()
+                    self.get_boss_state_tracker().reset()
+                    raise
+                finally:
+                    changed_tables, self.deferred_tables = self.deferred_tables, None
+                    if changed_tables:
+                        self.share_tables_changed(frozenset(changed_tables))
 
         return decorated
 
+    @staticmethod
+    def clear_all_cache(*tables: Type[BaseModel]):
+        # 用于修改多个公会共享的数据（如用户昵称）
+        for clan_data in list(ClanBattleData.instances):
+            clan_data.cache.invalidate(frozenset(tables))
+        shared_state.publish("all_clans", tables=[table._meta.table_name for table in tables])
+
+    def tables_changed(self, tables: frozenset):
+        self.cache.invalidate(tables)
+        push_hub.notify_tables(self.clan_info.clan_gid, tables)
+        if self.deferred_tables is not None:
+            self.deferred_tables |= tables
+        else:
+            self.share_tables_changed(tables)
+
+    def share_tables_changed(self, tables: frozenset):
+        # 递增公会的缓存版本号使共享缓存失效，并通知其它进程清除本地缓存
+        if not shared_state.enabled:
+            return
+        clan_gid = self.clan_info.clan_gid
+        shared_state.incr(f"clan:{clan_gid}:version")
+        shared_state.publish("clan", clan_gid=clan_gid, tables=[table._meta.table_name for table in tables])
+
+    def shared_cache_key(self, name: str) -> str:
+        clan_gid = self.clan_info.clan_gid
+        return f"clan:{clan_gid}:{shared_state.get_int(f'clan:{clan_gid}:version')}:{name}"
+
+    def delete_model_instance(self, instance: BaseModel, operator_uid: str = None):
+        instance.delete_instance()
+        if event_type := removal_event_types.get(type(instance)):
+            self.log_event(event_type, instance.member_uid, instance.target_cycle, instance.target_boss,
+                           operator_uid=operator_uid)
+        self.tables_changed(frozenset([type(instance)]))
+
+    def get_cache_stats(self) -> Dict[str, int]:
+        return self.cache.stats()
+
+    def explain_hot_queries(self) -> List[Tuple[str, str, List[str]]]:
+        # 输出常用查询的执行计划，用于检查索引是否生效
+        start_time, end_time = self.get_today_datetime()
+        tracker = self.get_boss_state_tracker()
+        queries = [
+            ("boss_state_snapshot", tracker.snapshot_query()),
+            ("boss_state_events", tracker.event_query(0)),
+            ("boss_state_record_event", tracker.record_event_query(0)),
+            ("boss_state_records", tracker.load_query()),
+            ("boss_state_reload", tracker.reload_boss_query(1)),
+            ("record", self.get_record_query()),
+            ("record_member_today", self.get_record_query(
+                uid="0", start_time=start_time, end_time=end_time)),
+            ("record_today", self.get_record_query(
+                start_time=start_time, end_time=end_time)),
+            ("recent_record", self.get_record_query(num=1, time_desc=True)),
+            ("recent_record_member", self.get_record_query(
+                uid="0", num=1, time_desc=True)),
+            ("recent_record_boss", self.get_record_query(
+                boss=1, num=1, time_desc=True)),
+            ("battle_in_progress_member", self.get_battle_in_progress_query(uid="0")),
+            ("battle_in_progress_boss", self.get_battle_in_progress_query(boss=1)),
+            ("battle_subscribe_boss_cycle", self.get_battle_subscribe_query(
+                boss=1, boss_cycle=1)),
+            ("battle_subscribe_member", self.get_battle_subscribe_query(
+                uid="0", boss=1, boss_cycle=1)),
+            ("battle_on_tree_member", self.get_battle_on_tree_query(uid="0")),
+            ("battle_on_tree_boss", self.get_battle_on_tree_query(boss=1)),
+            ("battle_sl_member_today", self.get_battle_sl_query(
+                uid="0", start_time=start_time, end_time=end_time)),
+            ("daily_summary_today", DailyMemberSummary.select().where(
+                self.get_daily_summary_filter(self.get_battle_date()))),
+            ("daily_summary_member_today", DailyMemberSummary.select().where(
+                self.get_daily_summary_filter(self.get_battle_date(), "0"))),
+        ]
+        ret_list = []
+        explain_prefix = "EXPLAIN QUERY PLAN " if is_sqlite() else "EXPLAIN "
+        for name, query in queries:
+            sql, params = query.sql()
+            plan = [" ".join(str(col) for col in row)
+                    for row in query.model._meta.database.execute_sql(explain_prefix + sql, params)]
+            ret_list.append((name, sql, plan))
+        return ret_list
+
     @staticmethod
     def get_db_strlist_list(text_field: TextField) -> List[str]:
         return str(text_field).split("|") if text_field else []
@@ -196,13 +748,49 @@ class ClanBattleData:
 
     @staticmethod
     def create_clan(gid: str, clan_name: str, clan_type: str, clan_admin: List[str]):
-        ClanInfo.create(clan_gid=gid, clan_name=clan_name, create_time=datetime.datetime.utcnow(),
-                        clan_type=clan_type, clan_admin=ClanBattleData.get_db_strlist_str(clan_admin))
+        with clanbattle_db.atomic():
+            ClanInfo.create(clan_gid=gid, clan_name=clan_name, create_time=datetime.datetime.utcnow(),
+                            clan_type=clan_type, clan_admin="")
+            ClanBattleData.insert_membership(gid, clan_admin, "admin")
+            sync_legacy_membership(gid)
+
+    @staticmethod
+    def delete_clan(gid: str) -> Dict[str, int]:
+        # 删除公会的全部档案数据和成员，返回各表删除的行数
+        deleted = {}
+        with clanbattle_db.atomic():
+            members = [uid for uid, in ClanMembership.select(ClanMembership.member_uid).where(
+                (ClanMembership.clan_gid == gid) & (ClanMembership.role == "member")).tuples()]
+            for model in battle_models + [ClanMembership]:
+                deleted[model._meta.table_name] = model.delete().where(model.clan_gid == gid).execute()
+            qry = ClanInfo.delete().where(ClanInfo.clan_gid == gid)
+            qry.execute()
+            sync_legacy_membership(gid, members)
+        WebAuth.session_cache.invalidate()
+        return deleted
 
     @staticmethod
-    def delete_clan(gid: str):
-        qry = ClanInfo.delete().where(ClanInfo.clan_gid == gid)
-        qry.execute()
+    def insert_membership(gid: str, uid_list: List[str], role: str) -> int:
+        rows = [(gid, uid, role) for uid in dict.fromkeys(uid_list)]
+        inserted = 0
+        for i in range(0, len(rows), 100):
+            inserted += ClanMembership.insert_many(rows[i:i+100], fields=[
+                ClanMembership.clan_gid, ClanMembership.member_uid, ClanMembership.role]).on_conflict_ignore().as_rowcount().execute()
+        return inserted
+
+    def get_membership_query(self, role: str) -> ModelSelect:
+        return ClanMembership.select().where((ClanMembership.clan_gid == self.clan_info.clan_gid)
+                                             & (ClanMembership.role == role)).order_by(ClanMembership.id)
+
+    @clear_cache(ClanMembership)
+    def set_membership(self, uid_list: List[str], role: str):
+        with clanbattle_db.atomic():
+            old_uid_list = [membership.member_uid for membership in self.get_membership_query(role)]
+            ClanMembership.delete().where((ClanMembership.clan_gid == self.clan_info.clan_gid)
+                                          & (ClanMembership.role == role)).execute()
+            self.insert_membership(self.clan_info.clan_gid, uid_list, role)
+            sync_legacy_membership(self.clan_info.clan_gid, old_uid_list + uid_list if role == "member" else [])
+        WebAuth.session_cache.invalidate()
 
     @staticmethod
     def get_user_info(uid: str) -> User:
@@ -221,146 +809,129 @@ class ClanBattleData:
             return False
         user.uname = uname
         user.save()
+        ClanBattleData.clear_all_cache(User)
         return True
 
     def get_today_datetime(self) -> Tuple[datetime.datetime, datetime.datetime]:
-        start_time = None
-        end_time = None
-        detla = datetime.timedelta(
-            hours=9) if self.clan_info.clan_type == "jp" else datetime.timedelta(hours=8)
-        now_time = datetime.datetime.utcnow() + detla
-        now_time_today = datetime.datetime.strptime(
-            str(now_time.date()), "%Y-%m-%d")
-        if now_time.hour < 5:
-            start_time = now_time_today - datetime.timedelta(hours=19) - detla
-            end_time = now_time_today + datetime.timedelta(hours=5) - detla
-        else:
-            start_time = now_time_today + datetime.timedelta(hours=5) - detla
-            end_time = now_time_today + datetime.timedelta(hours=29) - detla
-        return (start_time, end_time)
+        return get_battle_day_datetime(self.get_battle_date(), self.clan_info.clan_type)
 
-    @cache_return
+    def get_battle_date(self, record_time: datetime.datetime = None) -> datetime.date:
+        return get_battle_date(record_time or datetime.datetime.utcnow(), self.clan_info.clan_type)
+
+    def get_boss_state_tracker(self) -> BossStateTracker:
+        data_num = self.clan_info.current_using_data_num
+        if not self.boss_state_tracker or self.boss_state_tracker.data_num != data_num:
+            self.boss_state_tracker = BossStateTracker(
+                self.clan_info.clan_gid, data_num)
+        return self.boss_state_tracker
+
+    @cache_return(ClanMembership)
+    @shared_return()
     def get_clan_members(self) -> List[str]:
-        return self.get_db_strlist_list(self.clan_info.clan_members)
+        return [membership.member_uid for membership in self.get_membership_query("member")]
 
-    @cache_return
+    @cache_return(ClanMembership, User)
     def get_clan_members_with_info(self) -> List[MemberInfo]:
-        member_list = self.get_db_strlist_list(self.clan_info.clan_members)
-        ret_list = []
-        for member in member_list:
-            user: User = self.get_user_info(member)
-            member_info = MemberInfo(member, str(user.uname))
-            ret_list.append(member_info)
-        return ret_list
+        query = self.get_membership_query("member").select(ClanMembership.member_uid, User.uname).join(
+            User, JOIN.LEFT_OUTER, on=(User.qq_uid == ClanMembership.member_uid)).objects()
+        return [MemberInfo(row.member_uid, str(row.uname)) for row in query]
+
+    @cache_return(ClanMembership)
+    @shared_return()
+    def get_clan_admins(self) -> List[str]:
+        return [membership.member_uid for membership in self.get_membership_query("admin")]
 
-    @cache_return
+    @cache_return(ClanInfo)
     def get_current_clanbattle_data(self) -> int:
         return self.clan_info.current_using_data_num
 
-    @clear_cache
     def set_clan_members(self, members: List[str]):
-        self.clan_info.clan_members = self.get_db_strlist_str(members)
-        self.clan_info.save()
+        self.set_membership(members, "member")
 
-    @clear_cache
+    @clear_cache(ClanInfo)
     def set_clan_name(self, clan_name: str):
         self.clan_info.clan_name = clan_name
-        self.clan_info.save()
+        self.clan_info.save(only=[ClanInfo.clan_name])
 
-    @clear_cache
+    @clear_cache(ClanInfo)
     def set_using_data_num(self, num: int):
         self.clan_info.current_using_data_num = num
-        self.clan_info.save()
+        self.clan_info.save(only=[ClanInfo.current_using_data_num])
 
-    @clear_cache
+    @clear_cache(ClanInfo)
     def set_current_clanbattle_data(self, data_num: int):
         self.clan_info.current_using_data_num = data_num
-        self.clan_info.save()
-
-    @clear_cache
-    def clear_current_clanbattle_data(self):
-        clan_record = self.get_record()
-        if clan_record:
-            for record in clan_record:
-                record.delete_instance()
-        clan_in_progress = self.get_battle_in_progress()
-        if clan_in_progress:
-            for in_progress in clan_in_progress:
-                in_progress.delete_instance()
-        clan_sl = BattleSL.select().where((BattleSL.clan_gid == self.clan_info.clan_gid)
-                                          & (BattleSL.using_data_num == self.clan_info.current_using_data_num))
-        if clan_sl:
-            for sl in clan_sl:
-                sl.delete_instance()
-        clan_battle_subscribe = self.get_battle_subscribe()
-        if clan_battle_subscribe:
-            for battle_subscribe in clan_battle_subscribe:
-                battle_subscribe.delete_instance()
-        battle_on_tree = self.get_battle_on_tree()
-        if battle_on_tree:
-            for on_tree in battle_on_tree:
-                on_tree.delete_instance()
-
-    @clear_cache
+        self.clan_info.save(only=[ClanInfo.current_using_data_num])
+
+    @clear_cache(*battle_models)
+    def clear_current_clanbattle_data(self) -> Dict[str, int]:
+        # 返回各表删除的行数
+        deleted = {}
+        with self.lock, clanbattle_db.atomic():
+            for model in battle_models:
+                deleted[model._meta.table_name] = model.delete().where(
+                    (model.clan_gid == self.clan_info.clan_gid) & (model.using_data_num == self.clan_info.current_using_data_num)).execute()
+            self.get_boss_state_tracker().reset()
+        return deleted
+
+    @clear_cache(ClanInfo)
     def rename_clan(self, name: str):
         self.clan_info.clan_name = name
-        self.clan_info.save()
+        self.clan_info.save(only=[ClanInfo.clan_name])
 
-    @clear_cache
+    @clear_cache(ClanMembership, User)
     def add_clan_member(self, uid: str, name: str) -> bool:
-        if not self.get_user_info(uid):
-            User.create(qq_uid=uid, uname=name,
-                        clan_joined=self.clan_info.clan_gid)
-            member_list = self.get_clan_members()
-            member_list.append(uid)
-            self.set_clan_members(member_list)
-            return True
-        else:
-            members = self.get_clan_members()
-            if uid in members:
-                return False
-            user = self.get_user_info(uid)
-            joined_clan = self.get_db_strlist_list(user.clan_joined)
-            joined_clan.append(self.clan_info.clan_gid)
-            user.clan_joined = self.get_db_strlist_str(joined_clan)
-            user.save()
-            members.append(uid)
-            self.set_clan_members(members)
-            return True
-
-    @clear_cache
+        with clanbattle_db.atomic():
+            if not self.get_user_info(uid):
+                User.create(qq_uid=uid, uname=name)
+            inserted = self.insert_membership(self.clan_info.clan_gid, [uid], "member") > 0
+            sync_legacy_membership(self.clan_info.clan_gid, [uid])
+        WebAuth.session_cache.invalidate(uid)
+        return inserted
+
+    @clear_cache(ClanMembership, User)
+    def add_clan_members(self, members: List[Tuple[str, str]]) -> int:
+        # 批量加入成员，members 为 (uid, 昵称) 列表，已存在的用户不修改昵称，返回新加入的人数
+        members = list(dict(members).items())
+        with clanbattle_db.atomic():
+            for i in range(0, len(members), 100):
+                User.insert_many(members[i:i+100], fields=[User.qq_uid, User.uname]).on_conflict_ignore().execute()
+            inserted = self.insert_membership(self.clan_info.clan_gid, [uid for uid, _ in members], "member")
+            sync_legacy_membership(self.clan_info.clan_gid, [uid for uid, _ in members])
+        WebAuth.session_cache.invalidate()
+        return inserted
+
+    @clear_cache(ClanMembership)
     def delete_clan_member(self, uid: str) -> bool:
-        if not (user := self.get_user_info(uid)):
-            return False
-        joined_clan = self.get_db_strlist_list(user.clan_joined)
-        if not self.clan_info.clan_gid in joined_clan:
-            return False
-        joined_clan.remove(self.clan_info.clan_gid)
-        user.clan_joined = self.get_db_strlist_str(joined_clan)
-        user.save()
-        members = self.get_clan_members()
-        members.remove(uid)
-        self.set_clan_members(members)
-        return True
+        qry = ClanMembership.delete().where((ClanMembership.clan_gid == self.clan_info.clan_gid)
+                                            & (ClanMembership.member_uid == uid)
+                                            & (ClanMembership.role == "member"))
+        with clanbattle_db.atomic():
+            deleted = qry.execute() > 0
+            sync_legacy_membership(self.clan_info.clan_gid, [uid])
+        WebAuth.session_cache.invalidate(uid)
+        return deleted
 
-    @clear_cache
     def refresh_clan_admin(self, admins: List[str]):
-        clan = self.clan_info
-        clan.clan_admin = self.get_db_strlist_str(admins)
-        clan.save()
+        self.set_membership(admins, "admin")
+
+    @clear_cache(ClanMembership)
+    def add_clan_admin(self, uid: str) -> bool:
+        with clanbattle_db.atomic():
+            inserted = self.insert_membership(self.clan_info.clan_gid, [uid], "admin") > 0
+            sync_legacy_membership(self.clan_info.clan_gid)
+        return inserted
+
+    def check_membership(self, uid: str, role: str) -> bool:
+        return ClanMembership.select().where((ClanMembership.clan_gid == self.clan_info.clan_gid)
+                                             & (ClanMembership.member_uid == uid)
+                                             & (ClanMembership.role == role)).exists()
 
-    @cache_return
+    @cache_return(ClanMembership)
     def check_joined_clan(self, uid: str) -> bool:
-        user = self.get_user_info(uid)
-        if not user:
-            return False
-        db_list = self.get_db_strlist_list(user.clan_joined)
-        if not user or not self.clan_info.clan_gid in db_list:
-            return False
-        return True
+        return self.check_membership(uid, "member")
 
-    @cache_return
-    def get_record(self, uid: str = None, boss: int = None, cycle: int = None, start_time: datetime.datetime = None, end_time: datetime.datetime = None, num: int = None, time_desc: bool = False) -> List[BattleRecord]:
+    def get_record_query(self, uid: str = None, boss: int = None, cycle: int = None, start_time: datetime.datetime = None, end_time: datetime.datetime = None, num: int = None, time_desc: bool = False) -> ModelSelect:
         res = BattleRecord.select().where((BattleRecord.clan_gid == self.clan_info.clan_gid)
                                           & (BattleRecord.using_data_num == self.clan_info.current_using_data_num))
         if uid:
@@ -377,7 +948,28 @@ class ClanBattleData:
             res = res.order_by(BattleRecord.record_time.desc())
         if num:
             res = res.limit(num)
-        return res if res else None
+        return res
+
+    @cache_return(BattleRecord)
+    def get_record(self, uid: str = None, boss: int = None, cycle: int = None, start_time: datetime.datetime = None, end_time: datetime.datetime = None, num: int = None, time_desc: bool = False) -> List[BattleRecord]:
+        records = list(self.get_record_query(
+            uid, boss, cycle, start_time, end_time, num, time_desc))
+        return records if records else None
+
+    def get_record_dicts(self, uid: str = None, boss: int = None, cycle: int = None, start_time: datetime.datetime = None, end_time: datetime.datetime = None, fields: List[str] = None, cursor: Tuple[datetime.datetime, int] = None, limit: int = None) -> List[dict]:
+        # 按 (record_time, id) 倒序读取出刀记录，cursor 为上一页最后一条记录的 (record_time, id)
+        # 直接返回字典，不创建模型实例；指定 fields 时只读取这些字段，id 和 record_time 总会返回
+        query = self.get_record_query(uid, boss, cycle, start_time, end_time)
+        if fields:
+            query = query.select(BattleRecord.id, BattleRecord.record_time,
+                                 *(BattleRecord._meta.fields[name] for name in fields if name not in ("id", "record_time")))
+        if cursor:
+            query = query.where((BattleRecord.record_time < cursor[0])
+                                | ((BattleRecord.record_time == cursor[0]) & (BattleRecord.id < cursor[1])))
+        query = query.order_by(BattleRecord.record_time.desc(), BattleRecord.id.desc())
+        if limit:
+            query = query.limit(limit)
+        return list(query.dicts())
 
     def get_today_record(self, uid: str = None, boss: int = None, cycle: int = None, num: int = None) -> List[BattleRecord]:
         start_time = None
@@ -387,12 +979,11 @@ class ClanBattleData:
         end_time = today_time[1]
         return self.get_record(uid, boss, cycle, start_time, end_time, num)
 
-    @cache_return
+    @cache_return(BattleRecord)
     def get_recent_record(self, uid: str = None, boss: int = None, num: int = 1) -> List[BattleRecord]:
         return self.get_record(uid=uid, boss=boss, num=num, time_desc=True)
 
-    @cache_return
-    def get_battle_in_progress(self, uid: str = None, boss: int = None) -> List[BattleInProgress]:
+    def get_battle_in_progress_query(self, uid: str = None, boss: int = None) -> ModelSelect:
         progresses = BattleInProgress.select().where((BattleInProgress.clan_gid == self.clan_info.clan_gid) & (
             BattleInProgress.using_data_num == self.clan_info.current_using_data_num))
         if uid:
@@ -400,13 +991,13 @@ class ClanBattleData:
         if boss:
             progresses = progresses.where(
                 (BattleInProgress.target_boss == boss))
-        ret_list = []
-        for progress in progresses:
-            ret_list.append(progress)
-        return ret_list
+        return progresses
 
-    @cache_return
-    def get_battle_subscribe(self, uid: str = None, boss: int = None, boss_cycle: int = None) -> List[BattleSubscribe]:
+    @cache_return(BattleInProgress)
+    def get_battle_in_progress(self, uid: str = None, boss: int = None) -> List[BattleInProgress]:
+        return list(self.get_battle_in_progress_query(uid, boss))
+
+    def get_battle_subscribe_query(self, uid: str = None, boss: int = None, boss_cycle: int = None) -> ModelSelect:
         subscribes = BattleSubscribe.select().where((BattleSubscribe.clan_gid == self.clan_info.clan_gid) & (
             BattleSubscribe.using_data_num == self.clan_info.current_using_data_num))
         if uid:
@@ -417,26 +1008,26 @@ class ClanBattleData:
         if boss_cycle:
             subscribes = subscribes.where(
                 (BattleSubscribe.target_cycle == boss_cycle))
-        ret_list = []
-        for subscribe in subscribes:
-            ret_list.append(subscribe)
-        return ret_list
+        return subscribes
 
-    @cache_return
-    def get_battle_on_tree(self, uid: str = None, boss: int = None) -> List[BattleOnTree]:
+    @cache_return(BattleSubscribe)
+    def get_battle_subscribe(self, uid: str = None, boss: int = None, boss_cycle: int = None) -> List[BattleSubscribe]:
+        return list(self.get_battle_subscribe_query(uid, boss, boss_cycle))
+
+    def get_battle_on_tree_query(self, uid: str = None, boss: int = None) -> ModelSelect:
         progresses = BattleOnTree.select().where((BattleOnTree.clan_gid == self.clan_info.clan_gid) & (
             BattleOnTree.using_data_num == self.clan_info.current_using_data_num))
         if uid:
             progresses = progresses.where((BattleOnTree.member_uid == uid))
         if boss:
             progresses = progresses.where((BattleOnTree.target_boss == boss))
-        ret_list = []
-        for progress in progresses:
-            ret_list.append(progress)
-        return ret_list
+        return progresses
 
-    @cache_return
-    def get_battle_sl(self, uid: str = None, boss: int = None, boss_cycle: int = None, start_time: datetime.datetime = None, end_time: datetime.datetime = None) -> List[BattleSL]:
+    @cache_return(BattleOnTree)
+    def get_battle_on_tree(self, uid: str = None, boss: int = None) -> List[BattleOnTree]:
+        return list(self.get_battle_on_tree_query(uid, boss))
+
+    def get_battle_sl_query(self, uid: str = None, boss: int = None, boss_cycle: int = None, start_time: datetime.datetime = None, end_time: datetime.datetime = None) -> ModelSelect:
         sls = BattleSL.select().where((BattleSL.clan_gid == self.clan_info.clan_gid) & (
             BattleSL.using_data_num == self.clan_info.current_using_data_num) & (BattleSL.record_time > start_time) & (BattleSL.record_time < end_time))
         if uid:
@@ -445,83 +1036,145 @@ class ClanBattleData:
             sls = sls.where((BattleSL.target_boss == boss))
         if boss_cycle:
             sls = sls.where((BattleSL.target_cycle == boss_cycle))
-        ret_list = []
-        for sl in sls:
-            ret_list.append(sl)
-        return ret_list
+        return sls
+
+    @cache_return(BattleSL)
+    def get_battle_sl(self, uid: str = None, boss: int = None, boss_cycle: int = None, start_time: datetime.datetime = None, end_time: datetime.datetime = None) -> List[BattleSL]:
+        return list(self.get_battle_sl_query(uid, boss, boss_cycle, start_time, end_time))
 
     def get_today_battle_sl(self, uid: str = None, boss: int = None, boss_cycle: int = None) -> List[BattleSL]:
         today_time = self.get_today_datetime()
         return self.get_battle_sl(uid, boss, boss_cycle, today_time[0], today_time[1])
 
-    @clear_cache
+    def log_event(self, event_type: str, uid: str, target_cycle: int = None, target_boss: int = None, comment: str = None, operator_uid: str = None, record_id: int = None):
+        # 记录不改变boss状态的事件
+        BattleEvent.create(clan_gid=self.clan_info.clan_gid, using_data_num=self.clan_info.current_using_data_num,
+                           event_type=event_type, member_uid=uid, operator_uid=operator_uid, target_cycle=target_cycle,
+                           target_boss=target_boss, record_id=record_id, comment=comment, event_time=datetime.datetime.utcnow())
+
+    @clear_cache(BattleSubscribe)
     def create_new_battle_subscribe(self, uid: str, target_cycle: int, target_boss: int, comment: str):
         BattleSubscribe.create(clan_gid=self.clan_info.clan_gid, member_uid=uid, record_time=datetime.datetime.utcnow(),
                                target_cycle=target_cycle, target_boss=target_boss,
                                using_data_num=self.clan_info.current_using_data_num, comment=comment)
+        self.log_event("subscribe", uid, target_cycle, target_boss, comment)
 
-    @clear_cache
+    @clear_cache(BattleInProgress)
     def create_new_battle_in_progress(self, uid: str, target_cycle: int, target_boss: int, comment: str):
         BattleInProgress.create(clan_gid=self.clan_info.clan_gid, member_uid=uid, record_time=datetime.datetime.utcnow(),
                                 target_cycle=target_cycle, target_boss=target_boss,
                                 using_data_num=self.clan_info.current_using_data_num, comment=comment)
+        self.log_event("queue", uid, target_cycle, target_boss, comment)
 
-    @clear_cache
+    @clear_cache(BattleOnTree)
     def create_new_battle_on_tree(self, uid: str, target_cycle: int, target_boss: int, comment: str):
         BattleOnTree.create(clan_gid=self.clan_info.clan_gid, member_uid=uid, record_time=datetime.datetime.utcnow(),
                             target_cycle=target_cycle, target_boss=target_boss,
                             using_data_num=self.clan_info.current_using_data_num, comment=comment)
+        self.log_event("on_tree", uid, target_cycle, target_boss, comment)
 
-    @clear_cache
+    @clear_cache(BattleSL, DailyMemberSummary)
     def create_new_battle_sl(self, uid: str, target_cycle: int, target_boss: int, comment: str, proxy_report_uid: str):
-        BattleSL.create(clan_gid=self.clan_info.clan_gid, member_uid=uid, record_time=datetime.datetime.utcnow(),
+        sl = BattleSL.create(clan_gid=self.clan_info.clan_gid, member_uid=uid, record_time=datetime.datetime.utcnow(),
                         using_data_num=self.clan_info.current_using_data_num, comment=comment,
                         target_cycle=target_cycle, target_boss=target_boss,
                         proxy_report_uid=proxy_report_uid)
-
-    @clear_cache
+        self.log_event("sl", uid, target_cycle, target_boss, comment, proxy_report_uid)
+        summary_filter = self.get_daily_summary_filter(self.get_battle_date(sl.record_time), uid)
+        if not DailyMemberSummary.update(use_sl=True).where(summary_filter).execute():
+            self.create_daily_summary(uid, sl.record_time, use_sl=True)
+
+    def get_daily_summary_filter(self, battle_date: datetime.date, uid: str = None):
+        summary_filter = ((DailyMemberSummary.clan_gid == self.clan_info.clan_gid)
+                          & (DailyMemberSummary.using_data_num == self.clan_info.current_using_data_num)
+                          & (DailyMemberSummary.battle_date == battle_date))
+        if uid:
+            summary_filter &= DailyMemberSummary.member_uid == uid
+        return summary_filter
+
+    def create_daily_summary(self, uid: str, record_time: datetime.datetime, **fields):
+        DailyMemberSummary.create(clan_gid=self.clan_info.clan_gid, using_data_num=self.clan_info.current_using_data_num,
+                                  battle_date=self.get_battle_date(record_time), member_uid=uid, **fields)
+
+    def add_record_to_daily_summary(self, record: BattleRecord):
+        addition = 1 if record.is_extra_time else 0
+        remain_addition = (1 if record.remain_next_chance else 0) - addition
+        updated = (DailyMemberSummary
+                   .update(total_challenge=DailyMemberSummary.total_challenge + 1 - addition,
+                           addition_challenge=DailyMemberSummary.addition_challenge + addition,
+                           remain_addition_challenge=DailyMemberSummary.remain_addition_challenge + remain_addition,
+                           total_damage=DailyMemberSummary.total_damage + record.damage,
+                           last_is_extra_time=record.is_extra_time, last_record_id=record.id)
+                   .where(self.get_daily_summary_filter(self.get_battle_date(record.record_time), record.member_uid))
+                   .execute())
+        if not updated:
+            self.create_daily_summary(record.member_uid, record.record_time, total_challenge=1 - addition,
+                                      addition_challenge=addition, remain_addition_challenge=remain_addition,
+                                      total_damage=record.damage, last_is_extra_time=record.is_extra_time, last_record_id=record.id)
+
+    @clear_cache(BattleRecord, BattleEvent, DailyMemberSummary)
     def create_new_record(self, uid: str, target_cycle: int, target_boss: int, damage: int, boss_hp: int, comment: str, is_extra_time: bool, remain_next_chance: bool, proxy_report_uid: str):
-        BattleRecord.create(clan_gid=self.clan_info.clan_gid, member_uid=uid, record_time=datetime.datetime.utcnow(),
-                            target_cycle=target_cycle, target_boss=target_boss, using_data_num=self.clan_info.current_using_data_num, damage=damage, boss_hp=boss_hp, comment=comment,
-                            is_extra_time=is_extra_time, remain_next_chance=remain_next_chance, proxy_report_uid=proxy_report_uid)
-
-    @clear_cache
+        record = BattleRecord.create(clan_gid=self.clan_info.clan_gid, member_uid=uid, record_time=datetime.datetime.utcnow(),
+                                     target_cycle=target_cycle, target_boss=target_boss, using_data_num=self.clan_info.current_using_data_num, damage=damage, boss_hp=boss_hp, comment=comment,
+                                     is_extra_time=is_extra_time, remain_next_chance=remain_next_chance, proxy_report_uid=proxy_report_uid)
+        self.get_boss_state_tracker().append_event(
+            "kill" if damage == boss_hp else "report", target_boss, BossRecordState.from_record(record),
+            member_uid=uid, operator_uid=proxy_report_uid, target_cycle=target_cycle, record_id=record.id, comment=comment)
+        self.add_record_to_daily_summary(record)
+
+    @serialized_commit
+    @clear_cache(BattleRecord, BattleEvent, DailyMemberSummary)
     def delete_recent_record(self, uid: str) -> bool:
         record = self.get_recent_record(uid=uid)
         if not record:
             return False
         else:
-            record[0].delete_instance()
+            record: BattleRecord = record[0]
+            tracker = self.get_boss_state_tracker()
+            current = tracker.get_boss_record(record.target_boss)
+            record.delete_instance()
+            if current and current.id == record.id:
+                # 撤销的记录是该boss的当前状态时，追加恢复到该记录之前状态的补偿事件
+                tracker.append_event("undo", record.target_boss, tracker.get_state_before_record(record),
+                                     member_uid=record.member_uid, target_cycle=record.target_cycle, record_id=record.id)
+            else:
+                self.log_event("undo", record.member_uid, record.target_cycle, record.target_boss, record_id=record.id)
+            # 撤销后该成员当天的统计按剩余记录重新生成，与删除记录在同一事务中完成
+            rebuild_daily_summary(self.clan_info.clan_gid, self.clan_info.current_using_data_num,
+                                  record.member_uid, self.get_battle_date(record.record_time))
             return True
 
-    @clear_cache
+    @clear_cache(BattleInProgress)
     def delete_battle_in_progress(self, uid: str) -> bool:
         progress = self.get_battle_in_progress(uid)
         if not progress:
             return False
         for proc in progress:
             proc.delete_instance()
+        self.log_event("unqueue", uid)
         return True
 
-    @clear_cache
+    @clear_cache(BattleSubscribe)
     def delete_battle_subscribe(self, uid: str, boss: int, cycle: int = None) -> bool:
         subs = self.get_battle_subscribe(uid, boss, cycle)
         if not subs:
             return False
         for sub in subs:
             sub.delete_instance()
+        self.log_event("unsubscribe", uid, cycle, boss)
         return True
 
-    @clear_cache
+    @clear_cache(BattleOnTree)
     def delete_battle_on_tree(self, uid: str) -> bool:
         on_tree = self.get_battle_on_tree(uid)
         if not on_tree:
             return False
         for proc in on_tree:
             proc.delete_instance()
+        self.log_event("off_tree", uid)
         return True
 
-    @clear_cache
+    @clear_cache(BattleInProgress)
     def update_battle_in_progress_record(self, uid: str, comment: str) -> bool:
         progress = self.get_battle_in_progress(uid)
         if not progress:
@@ -531,7 +1184,7 @@ class ClanBattleData:
             proc.save()
         return True
 
-    @clear_cache
+    @clear_cache(BattleOnTree)
     def update_on_tree_record(self, uid: str, comment: str) -> bool:
         on_treee_list = self.get_battle_on_tree(uid)
         if not on_treee_list:
@@ -541,128 +1194,107 @@ class ClanBattleData:
             on_tree_item.save()
         return True
 
-    def get_record_status(self, uid: str, start_time: datetime.datetime = None, end_time: datetime.datetime = None) -> TodayBattleStatus:
-        records = self.get_record(uid=uid, start_time=start_time, end_time=end_time) if (
-            start_time and end_time) else self.get_today_record(uid)
-        total_challenge = 0
-        addition_challeng = 0
-        remain_addition_challeng = 0
-        is_exta_time = False
-        if start_time and end_time:
-            is_sl = True if self.get_battle_sl(
-                uid=uid, start_time=start_time, end_time=end_time) else False
-        else:
-            is_sl = True if self.get_today_battle_sl(uid=uid) else False
-        if not records or len(records) == 0:
-            return TodayBattleStatus(uid, 0, 0, 0, False, is_sl)
-        for record in records:
-            if record.remain_next_chance:
-                remain_addition_challeng += 1
-            if not record.is_extra_time:
-                total_challenge += 1
-            else:
-                addition_challeng += 1
-                remain_addition_challeng -= 1
-        if records[len(records)-1].is_extra_time:
-            is_exta_time = True
-        return TodayBattleStatus(uid, total_challenge, addition_challeng, remain_addition_challeng, is_exta_time, is_sl)
-
     def get_today_record_status(self, uid: str) -> TodayBattleStatus:
-        return self.get_record_status(uid)
+        return self.get_member_day_status(uid, self.get_battle_date())
+
+    @staticmethod
+    def get_status_from_summary(uid: str, summary: Optional[DailyMemberSummary]) -> TodayBattleStatus:
+        if not summary:
+            return TodayBattleStatus(uid, 0, 0, 0, False, False)
+        return TodayBattleStatus(uid, summary.total_challenge, summary.addition_challenge,
+                                 summary.remain_addition_challenge, summary.last_is_extra_time, summary.use_sl)
+
+    @cache_return(DailyMemberSummary)
+    def get_member_day_status(self, uid: str, battle_date: datetime.date) -> TodayBattleStatus:
+        return self.get_status_from_summary(uid, DailyMemberSummary.get_or_none(self.get_daily_summary_filter(battle_date, uid)))
+
+    @cache_return(ClanMembership, DailyMemberSummary)
+    def get_members_day_status(self, battle_date: datetime.date) -> List[TodayBattleStatus]:
+        summaries = {summary.member_uid: summary for summary in DailyMemberSummary.select().where(
+            self.get_daily_summary_filter(battle_date))}
+        return [self.get_status_from_summary(member, summaries.get(member)) for member in self.get_clan_members()]
+
+    @cache_return(BattleRecord)
+    def get_clan_statistics(self) -> dict:
+        # 当前档案的出刀统计，强制修改进度产生的旧记录不计入
+        rows = (BattleRecord
+                .select(BattleRecord.member_uid, BattleRecord.target_boss, BattleRecord.damage, BattleRecord.boss_hp,
+                        BattleRecord.is_extra_time, BattleRecord.remain_next_chance, BattleRecord.record_time)
+                .where((BattleRecord.clan_gid == self.clan_info.clan_gid)
+                       & (BattleRecord.using_data_num == self.clan_info.current_using_data_num)
+                       & (BattleRecord.member_uid != "admin"))
+                .tuples())
+        return compute_statistics(list(rows), self.clan_info.clan_type)
 
     def get_today_member_status(self) -> List[TodayBattleStatus]:
-        ret_status = []
-        members = self.get_clan_members()
-        for member in members:
-            status = self.get_today_record_status(member)
-            ret_status.append(status)
-        return ret_status
+        return self.get_members_day_status(self.get_battle_date())
 
     # 完整刀 补偿刀
+    @cache_return(DailyMemberSummary)
+    def get_day_record_status_total(self, battle_date: datetime.date) -> Tuple[int, int]:
+        total_challenge, next_chance_challenge = (DailyMemberSummary
+                                                  .select(fn.SUM(DailyMemberSummary.total_challenge),
+                                                          fn.SUM(DailyMemberSummary.remain_addition_challenge))
+                                                  .where(self.get_daily_summary_filter(battle_date)
+                                                         & (DailyMemberSummary.member_uid != "admin"))
+                                                  .scalar(as_tuple=True))
+        return (int(total_challenge or 0), int(next_chance_challenge or 0))
+
     def get_today_record_status_total(self) -> Tuple[int, int]:
-        today_record = self.get_today_record()
-        total_challenge = 0
-        next_chance_challenge = 0
-        if not today_record or len(today_record) == 0:
-            return (0, 0)
-        for record in today_record:
-            if record.member_uid == "admin":
-                continue
-            if not record.is_extra_time:
-                total_challenge += 1
-            if record.remain_next_chance:
-                next_chance_challenge += 1
-            if record.is_extra_time:
-                next_chance_challenge -= 1
-        return (total_challenge, next_chance_challenge)
-
-    @cache_return
+        return self.get_day_record_status_total(self.get_battle_date())
+
+    @cache_return(ClanMembership)
     def check_admin_permission(self, uid: str) -> bool:
-        admins = self.get_db_strlist_list(self.clan_info.clan_admin)
-        if uid in admins:
-            return True
-        return False
+        return self.check_membership(uid, "admin")
+
+    @property
+    def stage_table(self) -> StageTable:
+        return stage_tables[self.clan_info.clan_type]
 
-    @cache_return
     def get_cycle_stage(self, cycle: int) -> int:
-        max_cycle = len(boss_info["cycle"][self.clan_info.clan_type])
-        for i in range(len(boss_info["cycle"][self.clan_info.clan_type])):
-            if max_cycle - 1 == i and cycle >= boss_info["cycle"][self.clan_info.clan_type][i]:
-                return i+1
-            elif max_cycle != i and cycle >= boss_info["cycle"][self.clan_info.clan_type][i] and cycle < boss_info["cycle"][self.clan_info.clan_type][i+1]:
-                return i+1
-        raise ClanBattleException("cycle error")
-
-    @cache_return
+        return self.stage_table.get_stage(cycle)
+
+    def get_boss_status_from_record(self, boss: int, record: BossRecordState) -> BossStatus:
+        stage_table = self.stage_table
+        if not record:
+            return BossStatus(boss, 1, 1, stage_table.get_boss_hp(1, boss), stage_table.get_boss_hp(1, boss))
+        if record.boss_hp == record.damage:
+            boss_cycle = record.target_cycle + 1
+            boss_stage = stage_table.get_stage(boss_cycle)
+            max_hp = stage_table.get_boss_hp(boss_stage, boss)
+            return BossStatus(boss, boss_cycle, boss_stage, max_hp, max_hp)
+        boss_cycle = record.target_cycle
+        boss_stage = stage_table.get_stage(boss_cycle)
+        return BossStatus(boss, boss_cycle, boss_stage, record.boss_hp-record.damage, stage_table.get_boss_hp(boss_stage, boss))
+
+    @shared_return(dump=lambda status_list: [vars(status) for status in status_list],
+                   load=lambda data: [BossStatus(item["target_boss"], item["target_cycle"], item["stage"], item["boss_hp"], item["max_boss_hp"]) for item in data])
     def get_current_boss_state(self) -> List[BossStatus]:
-        ret_list = []
-        for i in range(1, 6):
-            result: BattleRecord = BattleRecord.select().where((BattleRecord.target_boss == i)
-                                                               & (BattleRecord.using_data_num == self.clan_info.current_using_data_num)
-                                                               & (BattleRecord.clan_gid == self.clan_info.clan_gid)
-                                                               ).order_by(BattleRecord.record_time.desc()).limit(1)
-            if not result:
-                ret_list.append(BossStatus(
-                    i, 1, 1, boss_info["boss"][self.clan_info.clan_type][0][i-1], boss_info["boss"][self.clan_info.clan_type][0][i-1]))
-            else:
-                result = result[0]
-                if result.boss_hp == result.damage:
-                    boss_cycle = result.target_cycle+1
-                    boss_stage = self.get_cycle_stage(boss_cycle)
-                    ret_list.append(BossStatus(result.target_boss, boss_cycle, boss_stage,
-                                    boss_info["boss"][self.clan_info.clan_type][boss_stage-1][result.target_boss-1], boss_info["boss"][self.clan_info.clan_type][boss_stage-1][result.target_boss-1]))
-                else:
-                    boss_cycle = result.target_cycle
-                    boss_stage = self.get_cycle_stage(boss_cycle)
-                    ret_list.append(BossStatus(
-                        result.target_boss, boss_cycle, boss_stage, result.boss_hp-result.damage, boss_info["boss"][self.clan_info.clan_type][boss_stage-1][result.target_boss-1]))
-        return ret_list
+        tracker = self.get_boss_state_tracker()
+        return [self.get_boss_status_from_record(i, tracker.get_boss_record(i)) for i in range(1, 6)]
 
-    @cache_return
     def get_current_boss_state_cn(self) -> BossStatus:
         if self.clan_info.clan_type != "cn":
             raise Exception()
         else:
-            recent_record = self.get_recent_record()
-            if not recent_record:
-                return BossStatus(1, 1, 1, boss_info["boss"][self.clan_info.clan_type][0][0], boss_info["boss"][self.clan_info.clan_type][0][0])
+            result = self.get_boss_state_tracker().get_latest_record()
+            stage_table = self.stage_table
+            if not result:
+                return BossStatus(1, 1, 1, stage_table.get_boss_hp(1, 1), stage_table.get_boss_hp(1, 1))
             else:
-                result = recent_record[0]
                 if result.boss_hp == result.damage:
                     target_boss = result.target_boss + 1 if result.target_boss < 5 else 1
                     boss_cycle = result.target_cycle if target_boss != 1 else result.target_cycle + 1
-                    boss_stage = self.get_cycle_stage(boss_cycle)
+                    boss_stage = stage_table.get_stage(boss_cycle)
                     return BossStatus(target_boss, boss_cycle, boss_stage,
-                                      boss_info["boss"][self.clan_info.clan_type][boss_stage-1][target_boss-1], boss_info["boss"][self.clan_info.clan_type][boss_stage-1][target_boss-1])
+                                      stage_table.get_boss_hp(boss_stage, target_boss), stage_table.get_boss_hp(boss_stage, target_boss))
                 else:
                     boss_cycle = result.target_cycle
-                    boss_stage = self.get_cycle_stage(boss_cycle)
+                    boss_stage = stage_table.get_stage(boss_cycle)
                     return BossStatus(
-                        result.target_boss, boss_cycle, boss_stage, result.boss_hp-result.damage, boss_info["boss"][self.clan_info.clan_type][boss_stage-1][result.target_boss-1])
+                        result.target_boss, boss_cycle, boss_stage, result.boss_hp-result.damage, stage_table.get_boss_hp(boss_stage, result.target_boss))
 
-    async def boss_kill_process(self, uid: str, boss: int, proxy_report_uid: str):
-        bot: Bot = list(nonebot.get_bots().values())[0]
-        gid = self.clan_info.clan_gid
+    def process_boss_killed(self, uid: str, boss: int, proxy_report_uid: str) -> Tuple[set, set, set, set]:
         current_boss_status = self.get_current_boss_state()
         on_tree_list = self.get_battle_on_tree(boss=boss)
         battle_subscribe_list = self.get_battle_subscribe(boss=boss)
@@ -681,18 +1313,18 @@ class ClanBattleData:
         # 处理挂树
         for on_tree in on_tree_list:
             on_tree_mention_set.add(on_tree.member_uid)
-            on_tree.delete_instance()
+            self.delete_model_instance(on_tree, proxy_report_uid or uid)
         # 处理当前boss正在出刀和预约
         for battle_subscribe in battle_subscribe_list:
             if battle_subscribe.target_cycle != current_boss_status[boss-1].target_cycle - 1:
                 continue
             battle_subscribe_mention_qq_set.add(
                 str(battle_subscribe.member_uid))
-            battle_subscribe.delete_instance()
+            self.delete_model_instance(battle_subscribe, proxy_report_uid or uid)
         for battle_in_progress in battle_in_progress_list:
             battle_in_progress_mention_qq_set.add(
                 battle_in_progress.member_uid)
-            battle_in_progress.delete_instance()
+            self.delete_model_instance(battle_in_progress, proxy_report_uid or uid)
         # 处理可以出刀提醒
         if self.clan_info.clan_type != "cn":
             for boss_state in current_boss_status:
@@ -711,44 +1343,27 @@ class ClanBattleData:
         battle_subscribe_able_challenge_set -= no_report_uid_set
         battle_in_progress_mention_qq_set -= no_report_uid_set
         battle_subscribe_able_challenge_set -= no_report_uid_set
+        return on_tree_mention_set, battle_subscribe_mention_qq_set, battle_in_progress_mention_qq_set, battle_subscribe_able_challenge_set
+
+    def boss_kill_batch_process(self, kills: List[Tuple[int, Tuple[set, set, set, set]]]):
+        # 多次击杀的提醒合并为一次发送
+        bosses = "、".join(str(boss) for boss in dict.fromkeys(boss for boss, _ in kills))
+        merged_sets = tuple(set().union(*(mention_sets[i] for _, mention_sets in kills)) for i in range(4))
+        # 预约已在之后的击杀中被处理的成员无需再提醒可以出刀
+        merged_sets[3].difference_update(merged_sets[1])
+        self.boss_kill_process(bosses, merged_sets)
+
+    def boss_kill_process(self, boss: Union[int, str], mention_sets: Tuple[set, set, set, set]):
+        gid = self.clan_info.clan_gid
+        on_tree_mention_set, battle_subscribe_mention_qq_set, battle_in_progress_mention_qq_set, battle_subscribe_able_challenge_set = mention_sets
+        # 提醒消息交由发送队列限速发送，不阻塞报刀回复
         #预约当前和正在挑战提醒
-        memtion_boss_killed_msg = Message()
-        if battle_subscribe_mention_qq_set or battle_in_progress_mention_qq_set:
-            memtion_boss_killed_msg += MessageSegment.text(f"{boss}王已被击败，无需继续挑战\n")
-            if battle_subscribe_mention_qq_set:
-               memtion_boss_killed_msg += Message(
-                map(MessageSegment.at, battle_subscribe_mention_qq_set))
-            if battle_in_progress_mention_qq_set:
-               memtion_boss_killed_msg += Message(
-                map(MessageSegment.at, battle_subscribe_mention_qq_set))
-        if len(memtion_boss_killed_msg) > 0:
-            try:
-                await bot.send_group_msg(group_id=gid, message=memtion_boss_killed_msg)
-                await asyncio.sleep(0.5)
-            except:
-                pass
+        message_dispatcher.mention(gid, f"{boss}王已被击败，无需继续挑战\n",
+                                   battle_subscribe_mention_qq_set | battle_in_progress_mention_qq_set)
         #下树提醒
-        on_tree_mention_msg = Message()
-        if on_tree_mention_set:
-            on_tree_mention_msg += MessageSegment.text("下树啦\n") + \
-                Message(map(MessageSegment.at, on_tree_mention_set))
-        if len(on_tree_mention_msg) > 0:
-            try:
-                await bot.send_group_msg(group_id=gid, message=on_tree_mention_msg)
-                await asyncio.sleep(0.5)
-            except:
-                pass
+        message_dispatcher.mention(gid, "下树啦\n", on_tree_mention_set)
         #预约可挑战提醒
-        battle_subscribe_able_challenge_msg = Message()
-        if battle_subscribe_able_challenge_set:
-            battle_subscribe_able_challenge_msg += MessageSegment.text("现在可以出刀了\n") + Message(
-                map(MessageSegment.at, battle_subscribe_able_challenge_set))
-        if len(battle_subscribe_able_challenge_msg) > 0:
-            try:
-                await bot.send_group_msg(group_id=gid, message=battle_subscribe_able_challenge_msg)
-                await asyncio.sleep(0.5)
-            except:
-                pass
+        message_dispatcher.mention(gid, "现在可以出刀了\n", battle_subscribe_able_challenge_set)
 
     def get_max_challenge_boss_cycle(self, boss_data: List[BossStatus]) -> int:
         current_stage = self.get_cycle_stage(boss_data[0].target_cycle)
@@ -763,9 +1378,9 @@ class ClanBattleData:
         if current_max_cycle - current_min_cycle == 2:
             return current_max_cycle - 1
         elif current_max_cycle - current_min_cycle == 1:
-            if next_stage == len(boss_info["cycle"][self.clan_info.clan_type]) + 1:
+            if next_stage == self.stage_table.stage_count + 1:
                 return current_max_cycle
-            if current_max_cycle == boss_info["cycle"][self.clan_info.clan_type][next_stage - 1]:
+            if current_max_cycle == self.stage_table.stage_start_cycles[next_stage - 1]:
                 return current_min_cycle
             else:
                 return current_max_cycle
@@ -802,37 +1417,82 @@ class ClanBattleData:
             return NewRecordLegalCheckResult.success
         return NewRecordLegalCheckResult.boss_not_challengeable
 
-    async def commit_record(self, uid: str, target_boss: int, damage: str, comment: str, proxy_report_uid: str = None, force_use_full_chance: bool = False) -> CommitRecordResult:
+    async def commit_record(self, uid: str, target_boss: int, damage: str, comment: str, proxy_report_uid: str = None, force_use_full_chance: bool = False, is_kill_boss: bool = False, target_cycle: int = None) -> CommitRecordResult:
+        result, boss_killed_mention = await self.run_locked(
+            self.save_record, uid, target_boss, damage, comment, proxy_report_uid, force_use_full_chance, is_kill_boss, target_cycle)
+        if boss_killed_mention:
+            self.boss_kill_process(target_boss, boss_killed_mention)
+        return result
+
+    async def commit_records(self, records: List[Tuple[str, Optional[int], Optional[str], bool]], proxy_report_uid: str = None) -> Tuple[CommitRecordResult, Optional[int]]:
+        # 返回 (结果, 失败记录的序号)
+        try:
+            kills = await self.run_locked(self.save_records, records, proxy_report_uid)
+        except ClanBattleBatchRecordException as e:
+            return e.result, e.index
+        if kills:
+            self.boss_kill_batch_process(kills)
+        return CommitRecordResult.success, None
+
+    @serialized_commit
+    def save_record(self, uid: str, target_boss: int, damage: str, comment: str, proxy_report_uid: str = None, force_use_full_chance: bool = False, is_kill_boss: bool = False, target_cycle: int = None) -> Tuple[CommitRecordResult, Optional[Tuple[set, set, set, set]]]:
+        # 尾刀的伤害在持有锁后按当前boss血量计算，上报者看到的周目已被击破时不会再击破下一周目
+        if is_kill_boss:
+            boss = self.get_current_boss_state()[target_boss-1]
+            if target_cycle and boss.target_cycle != target_cycle:
+                return CommitRecordResult.boss_cycle_already_killed, None
+            damage = str(boss.boss_hp)
+        return self.apply_record(uid, target_boss, damage, comment, proxy_report_uid, force_use_full_chance)
+
+    @serialized_commit
+    def save_records(self, records: List[Tuple[str, Optional[int], Optional[str], bool]], proxy_report_uid: str = None) -> List[Tuple[int, Tuple[set, set, set, set]]]:
+        # 按顺序补报多条 (成员, boss, 伤害, 是否尾刀) 记录，每条记录基于之前记录提交后的boss状态校验，任意一条失败时整批回滚
+        kills = []
+        for index, (uid, target_boss, damage, is_kill_boss) in enumerate(records):
+            if self.clan_info.clan_type == "cn":
+                target_boss = self.get_current_boss_state_cn().target_boss
+            elif not target_boss:
+                raise ClanBattleBatchRecordException(index, CommitRecordResult.check_record_legal_failed)
+            if is_kill_boss:
+                damage = str(self.get_current_boss_state()[target_boss-1].boss_hp)
+            result, mention_sets = self.apply_record(uid, target_boss, damage, None, proxy_report_uid)
+            if result != CommitRecordResult.success:
+                raise ClanBattleBatchRecordException(index, result)
+            if mention_sets:
+                kills.append((target_boss, mention_sets))
+        return kills
+
+    def apply_record(self, uid: str, target_boss: int, damage: str, comment: str, proxy_report_uid: str = None, force_use_full_chance: bool = False) -> Tuple[CommitRecordResult, Optional[Tuple[set, set, set, set]]]:
         damage_num = 0
         try:
             damage_num = self.parse_damage(damage)
         except ClanBattleDamageParseException:
-            return CommitRecordResult.illegal_damage_inpiut
+            return CommitRecordResult.illegal_damage_inpiut, None
         boss_status = self.get_current_boss_state()
         boss = boss_status[target_boss-1]
         record_status = self.get_today_record_status(uid)
         if damage_num > boss.boss_hp:
-            return CommitRecordResult.damage_out_of_hp
+            return CommitRecordResult.damage_out_of_hp, None
         if (check_result := self.check_new_record_legal(uid, boss.target_cycle, boss.target_boss, damage_num)) == NewRecordLegalCheckResult.boss_not_challengeable:
-            return CommitRecordResult.boss_not_challengeable
+            return CommitRecordResult.boss_not_challengeable, None
         if check_result == NewRecordLegalCheckResult.on_another_tree:
-            return CommitRecordResult.on_another_tree
+            return CommitRecordResult.on_another_tree, None
         if not self.check_joined_clan(uid):
-            return CommitRecordResult.member_not_in_clan
+            return CommitRecordResult.member_not_in_clan, None
         if on_tree := self.get_battle_on_tree(uid=uid):
-            on_tree[0].delete_instance()
+            self.delete_model_instance(on_tree[0], proxy_report_uid or uid)
         if on_sub := self.get_battle_subscribe(uid=uid, boss=target_boss, boss_cycle=boss.target_cycle):
-            on_sub[0].delete_instance()
+            self.delete_model_instance(on_sub[0], proxy_report_uid or uid)
         if in_progress := self.get_battle_in_progress(uid, target_boss):
-            in_progress[0].delete_instance()
+            self.delete_model_instance(in_progress[0], proxy_report_uid or uid)
         # process proxy reporter
         if proxy_report_uid:
             if on_tree := self.get_battle_on_tree(uid=proxy_report_uid):
-                on_tree[0].delete_instance()
+                self.delete_model_instance(on_tree[0], proxy_report_uid)
             if on_sub := self.get_battle_subscribe(uid=proxy_report_uid, boss=target_boss, boss_cycle=boss.target_cycle):
-                on_sub[0].delete_instance()
+                self.delete_model_instance(on_sub[0], proxy_report_uid)
             if in_progress := self.get_battle_in_progress(proxy_report_uid, target_boss):
-                in_progress[0].delete_instance()
+                self.delete_model_instance(in_progress[0], proxy_report_uid)
         if record_status.remain_addition_challeng > 0 and not force_use_full_chance:
             self.create_new_record(uid, boss.target_cycle,
                                    target_boss, damage_num, boss.boss_hp, comment, True, False, proxy_report_uid)
@@ -843,9 +1503,11 @@ class ClanBattleData:
             self.create_new_record(uid, boss.target_cycle,
                                    target_boss, damage_num, boss.boss_hp, comment, False, False, proxy_report_uid)
         if damage_num == boss.boss_hp:
-            await self.boss_kill_process(uid, target_boss, proxy_report_uid)
-        return CommitRecordResult.success
+            # 击杀处理与出刀记录在同一事务中完成
+            return CommitRecordResult.success, self.process_boss_killed(uid, target_boss, proxy_report_uid)
+        return CommitRecordResult.success, None
 
+    @serialized_commit
     def commit_battle_in_progress(self, uid: str, target_boss: int, comment: str) -> CommitInProgressResult:
         boss_status = self.get_current_boss_state()
         boss = boss_status[target_boss-1]
@@ -860,11 +1522,12 @@ class ClanBattleData:
         if in_proc := self.get_battle_in_progress(uid):
             return CommitInProgressResult.already_in_battle
         if sub := self.get_battle_subscribe(uid, target_boss, boss.target_cycle):
-            sub[0].delete_instance()
+            self.delete_model_instance(sub[0], uid)
         self.create_new_battle_in_progress(
             uid, boss.target_cycle, target_boss, comment)
         return CommitInProgressResult.success
 
+    @serialized_commit
     def commit_batle_subscribe(self, uid: str, target_boss: int, target_cycle: int = None, comment: str = None) -> CommitSubscribeResult:
         boss_status = self.get_current_boss_state()
         boss = boss_status[target_boss-1]
@@ -890,6 +1553,7 @@ class ClanBattleData:
             uid, cycle, target_boss, comment)
         return CommitSubscribeResult.success
 
+    @serialized_commit
     def commit_battle_on_tree(self, uid: str, target_boss: int, comment: str) -> CommitBattlrOnTreeResult:
         boss_status = self.get_current_boss_state()
         boss = boss_status[target_boss-1]
@@ -902,13 +1566,14 @@ class ClanBattleData:
         if self.get_battle_on_tree(uid):
             return CommitBattlrOnTreeResult.already_on_tree
         if sub := self.get_battle_subscribe(uid, target_boss, boss.target_cycle):
-            sub[0].delete_instance()
+            self.delete_model_instance(sub[0], uid)
         if in_progress := self.get_battle_in_progress(uid, target_boss):
-            in_progress[0].delete_instance()
+            self.delete_model_instance(in_progress[0], uid)
         self.create_new_battle_on_tree(
             uid, boss.target_cycle, target_boss, comment)
         return CommitBattlrOnTreeResult.success
 
+    @serialized_commit
     def commit_battle_sl(self, uid: str,  target_boss: int = None, comment: str = None, proxy_report_uid: str = None) -> CommitSLResult:
         if not self.check_joined_clan(uid):
             return CommitSLResult.member_not_in_clan
@@ -920,7 +1585,7 @@ class ClanBattleData:
             if not self.check_new_record_legal(uid, boss.target_cycle, boss.target_boss, 1):
                 return CommitSLResult.illegal_target_boss
             if on_tree := self.get_battle_on_tree(uid=uid):
-                on_tree[0].delete_instance()
+                self.delete_model_instance(on_tree[0], proxy_report_uid or uid)
             self.create_new_battle_sl(
                 uid, boss.target_cycle, target_boss, comment, proxy_report_uid)
         else:
@@ -928,68 +1593,199 @@ class ClanBattleData:
                 uid, None, None, comment, proxy_report_uid)
         return CommitSLResult.success
 
-    def commit_force_change_boss_status(self, target_boss: int, target_cycle: int, target_hp: str) -> bool:
+    @serialized_commit
+    @clear_cache(BattleEvent)
+    def commit_force_change_boss_status(self, target_boss: int, target_cycle: int, target_hp: str, operator_uid: str = None) -> bool:
+        # 强制修改进度只追加状态事件，不再创建出刀记录
         try:
-            if self.clan_info.clan_type != "cn":
-                boss_hp = self.parse_damage(target_hp)
-                self.create_new_record("admin", target_cycle, target_boss,
-                            0, boss_hp, "本条记录为会战管理员强制修改进度所创建", False, False, None)
-            else:
-                boss_hp = self.parse_damage(target_hp)
-                for i in range(1,6):
-                    if i == target_boss:
-                        continue
-                    else:
-                        boss_cycle = target_cycle if i < target_boss else target_cycle - 1
-                        if boss_cycle > 0:
-                            boss_stage = self.get_cycle_stage(boss_cycle)
-                            self.create_new_record("admin", boss_cycle, i,
-                                        boss_info["boss"][self.clan_info.clan_type][boss_stage-1][i-1], boss_info["boss"][self.clan_info.clan_type][boss_stage-1][i-1], "本条记录为会战管理员强制修改进度所创建", False, False, None)
-                self.create_new_record("admin", target_cycle, target_boss,
-                            0, boss_hp, "本条记录为会战管理员强制修改进度所创建", False, False, None)
+            boss_hp = self.parse_damage(target_hp)
         except ClanBattleDamageParseException:
             return False
+        tracker = self.get_boss_state_tracker()
+        now = datetime.datetime.utcnow()
+        if self.clan_info.clan_type == "cn":
+            stage_table = self.stage_table
+            for i in range(1,6):
+                if i == target_boss:
+                    continue
+                boss_cycle = target_cycle if i < target_boss else target_cycle - 1
+                if boss_cycle > 0:
+                    # 该周目已击败
+                    max_hp = stage_table.get_boss_hp(stage_table.get_stage(boss_cycle), i)
+                    tracker.append_event("force_change", i, BossRecordState(i, boss_cycle, max_hp, max_hp, now),
+                                         operator_uid=operator_uid, target_cycle=boss_cycle)
+        tracker.append_event("force_change", target_boss, BossRecordState(target_boss, target_cycle, boss_hp, 0, now),
+                             operator_uid=operator_uid, target_cycle=target_cycle)
         return True
 
 
+class AsyncClanBattleData:
+
+    # ClanBattleData 的异步包装，同步方法在数据库线程池中持锁执行
+    def __init__(self, clan_data: ClanBattleData) -> None:
+        self.clan_data = clan_data
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.clan_data, name)
+        if not callable(attr) or asyncio.iscoroutinefunction(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            return await self.clan_data.run_locked(attr, *args, **kwargs)
+
+        return call
+
+
+class ClanDataRegistry:
+    # 按最近使用顺序保存各公会的 ClanBattleData，超出数量上限或长时间未使用的公会会被移出
+    # 被移出时仍在使用的实例由弱引用保留，再次访问时继续使用，保证每个公会同时只有一个实例
+
+    def __init__(self) -> None:
+        self.entries: "OrderedDict[str, ClanBattleData]" = OrderedDict()
+        self.evicted: "weakref.WeakValueDictionary[str, ClanBattleData]" = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted_count = 0
+
+    def get(self, gid: str) -> Optional[ClanBattleData]:
+        with self.lock:
+            clan_data = self.entries.get(gid)
+            if clan_data is None and (clan_data := self.evicted.pop(gid, None)) is not None:
+                self.entries[gid] = clan_data
+                self.evict()
+            if clan_data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(gid)
+            clan_data.last_access = time.monotonic()
+            self.hits += 1
+            return clan_data
+
+    def peek(self, gid: str) -> Optional[ClanBattleData]:
+        with self.lock:
+            clan_data = self.entries.get(gid)
+            return clan_data if clan_data is not None else self.evicted.get(gid)
+
+    def add(self, clan_data: ClanBattleData) -> ClanBattleData:
+        gid = clan_data.clan_info.clan_gid
+        with self.lock:
+            # 其它线程可能已经加载了同一个公会
+            if (exist := self.entries.get(gid)) is not None:
+                return exist
+            clan_data.last_access = time.monotonic()
+            self.entries[gid] = clan_data
+            self.evict()
+            return clan_data
+
+    def evict(self):
+        config = get_config()
+        now = time.monotonic()
+        for _ in range(len(self.entries)):
+            gid, clan_data = next(iter(self.entries.items()))
+            is_idle = config.clan_data_idle_timeout > 0 and now - clan_data.last_access >= config.clan_data_idle_timeout
+            if len(self.entries) <= config.clan_data_cache_size and not is_idle:
+                break
+            if clan_data.in_use():
+                # 正在使用的公会不移出
+                clan_data.last_access = now
+                self.entries.move_to_end(gid)
+                continue
+            del self.entries[gid]
+            self.evicted[gid] = clan_data
+            self.evicted_count += 1
+
+    def remove(self, gid: str) -> Optional[ClanBattleData]:
+        with self.lock:
+            self.evicted.pop(gid, None)
+            return self.entries.pop(gid, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"resident": len(self.entries), "max_size": get_config().clan_data_cache_size,
+                "hits": self.hits, "misses": self.misses, "evicted": self.evicted_count}
+
+
 class ClanBattle:
 
-    clan_data_dict: Dict[str, ClanBattleData] = {}
+    clan_registry = ClanDataRegistry()
 
     def __init__(self) -> None:
-        pass
+        shared_state.add_listener(self.on_shared_event)
 
-    def get_joined_clan(self, uid: str) -> List[str]:
-        user: User = User.select().where(User.qq_uid == uid).get()
-        return ClanBattleData.get_db_strlist_list(user.clan_joined)
+    @staticmethod
+    def get_joined_clan(uid: str) -> List[str]:
+        query = ClanMembership.select(ClanMembership.clan_gid).where(
+            (ClanMembership.member_uid == uid) & (ClanMembership.role == "member")).order_by(ClanMembership.id)
+        return [membership.clan_gid for membership in query]
 
     def get_clan_data(self, gid: str) -> ClanBattleData:
-        if not gid in list(self.clan_data_dict.keys()):
-            try:
-                clan_data = ClanBattleData(gid)
-                self.clan_data_dict[gid] = clan_data
-                return clan_data
-            except:
-                return None
-        else:
-            return self.clan_data_dict[gid]
+        if (clan_data := self.clan_registry.get(gid)) is not None:
+            return clan_data
+        try:
+            clan_data = ClanBattleData(gid)
+        except:
+            return None
+        return self.clan_registry.add(clan_data)
+
+    async def get_clan_data_async(self, gid: str) -> AsyncClanBattleData:
+        if (clan_data := self.clan_registry.get(gid)) is not None:
+            return AsyncClanBattleData(clan_data)
+        clan_data = await run_in_db_thread(self.get_clan_data, gid)
+        return AsyncClanBattleData(clan_data) if clan_data else None
 
     def create_clan(self, gid: str, clan_name: str, clan_type: str, clan_admin: List[str]):
         ClanBattleData.create_clan(gid, clan_name, clan_type, clan_admin)
         self.get_clan_data(gid)
 
-    def delete_clan(self, gid: str):
+    def delete_clan(self, gid: str) -> Dict[str, int]:
         clan = self.get_clan_data(gid)
-        clan.clear_current_clanbattle_data()
-        members = clan.get_clan_members()
-        for member in members:
-            clan.delete_clan_member(member)
-        ClanBattleData.delete_clan(gid)
-        del self.clan_data_dict[gid]
+        with clan.lock:
+            deleted = ClanBattleData.delete_clan(gid)
+            clan.boss_state_tracker = None
+            clan.tables_changed(frozenset(battle_models + [ClanInfo, ClanMembership]))
+        self.clan_registry.remove(gid)
+        return deleted
+
+    def reload_clan(self, gid: str, notify: bool = False):
+        # 公会信息被其它途径修改后调用，未加载的公会无需处理；notify 为 True 时同时通知网页和其它进程
+        if not (clan_data := self.clan_registry.peek(gid)):
+            return
+        if not clan_data.reload_clan_info():
+            self.clan_registry.remove(gid)
+        elif notify:
+            clan_data.tables_changed(frozenset(battle_models + [ClanInfo, ClanMembership]))
+
+    def invalidate_clan(self, gid: str, tables: frozenset = None):
+        if clan_data := self.clan_registry.peek(gid):
+            clan_data.invalidate(tables)
+
+    def get_registry_stats(self) -> Dict[str, int]:
+        return self.clan_registry.stats()
+
+    def on_shared_event(self, event: dict):
+        # 处理其它进程发出的失效通知，在共享缓存的订阅线程中执行
+        tables = frozenset(table_models[name] for name in event.get("tables", ()) if name in table_models)
+        if event["type"] == "session":
+            WebAuth.session_cache.invalidate_local(event["uid"])
+        elif event["type"] == "all_clans":
+            for clan_data in list(ClanBattleData.instances):
+                clan_data.cache.invalidate(tables)
+        elif event["type"] == "clan":
+            clan_gid = event["clan_gid"]
+            if ClanMembership in tables:
+                WebAuth.session_cache.invalidate_local()
+            if ClanInfo in tables:
+                # 公会名称、当前档案等可能已修改
+                run_with_connection(self.reload_clan, clan_gid)
+            else:
+                self.invalidate_clan(clan_gid, tables)
+            push_hub.notify_tables(clan_gid, tables)
 
 
 class WebAuth:
 
+    session_cache = SessionCache()
+
     @staticmethod
     def check_password(uid: str, password: str) -> bool:
         user: User = User.get(User.qq_uid == uid)
@@ -1015,6 +1811,19 @@ class WebAuth:
         user = User.select().where(User.web_session == session)
         return user[0].qq_uid if user else None
 
+    @staticmethod
+    def load_session(session: str) -> Tuple[str, List[str]]:
+        # 返回 (uid, 已加入的公会列表)，会话无效时 uid 为 None
+        if not session:
+            return None, []
+        if cached := WebAuth.session_cache.get(session):
+            return cached
+        if not (uid := WebAuth.check_session_valid(session)):
+            return None, []
+        joined_clan = ClanBattle.get_joined_clan(uid)
+        WebAuth.session_cache.set(session, uid, joined_clan)
+        return uid, joined_clan
+
     @staticmethod
     def create_session(uid: str) -> str:
         session = str(uuid.uuid4()).replace("-", "")
@@ -1023,6 +1832,8 @@ class WebAuth:
         user: User = User.select().where(User.qq_uid == uid).get()
         user.web_session = session
         user.save()
+        # 旧会话已失效
+        WebAuth.session_cache.invalidate(uid)
         return session
 
     @staticmethod
@@ -1070,5 +1881,9 @@ class Tools:
 
     @staticmethod
     def update_boss_info():
-        global boss_info
+        # 校验配置并生成各服务器的阶段表
+        global boss_info, stage_tables
         boss_info = get_config().boss_info
+        parsed_info = BossInfo.parse_obj(boss_info)
+        stage_tables = {clan_type: StageTable(getattr(parsed_info.cycle, clan_type), getattr(parsed_info.boss, clan_type))
+                        for clan_type in ("jp", "tw", "cn")}